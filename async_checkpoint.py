@@ -0,0 +1,157 @@
+"""Background checkpointing and evaluation for the training scripts
+
+AsyncCheckpointer takes a snapshot of the model variables (one sess.run copying them to
+host memory) and hands it to a worker thread, so training continues while the snapshot
+is written as a checkpoint and evaluated. The worker has its own graph and session,
+imported from the original meta graph, so evaluation does not touch the training graph or
+its input pipeline. Results are logged when they are ready, and with keep_best > 0 only
+the keep_best checkpoints with the best value of metric are kept on disk (instead of the
+5 most recent).
+
+Metrics are given as 'sens' or 'ppv', the mean over classes, or 'sens:<class>' /
+'ppv:<class>' for a single class of the label mapping, e.g. 'sens:positive'.
+"""
+import glob
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+
+def metric_value(metric, mapping, sens, ppvs):
+    name, _, cls = metric.partition(':')
+    if name not in ('sens', 'ppv'):
+        raise ValueError('Unknown metric {}, expected sens, ppv, sens:<class> or ppv:<class>'.format(metric))
+    values = sens if name == 'sens' else ppvs
+    if cls:
+        if cls not in mapping:
+            raise ValueError('Unknown class {} in metric {}'.format(cls, metric))
+        return float(values[mapping[cls]])
+    return float(np.mean(values))
+
+
+class AsyncCheckpointer:
+    """Writes checkpoints and evaluates them on a worker thread
+
+    eval_fn(sess, graph) evaluates the worker's session, with graph as the default graph,
+    prints its metrics and returns (sensitivities, ppvs) or a tuple starting with them, like
+    eval.eval. Only the variables of the meta graph are checkpointed, not optimizer slots.
+    At most max_pending snapshots wait for the worker; submit blocks beyond that so host
+    memory stays bounded if evaluation is slower than an epoch of training. With resume=True
+    the results of best_checkpoints.json, ranked by the same metric, are ranked along the
+    new ones.
+    """
+    def __init__(self, sess, meta_file, run_path, eval_fn, mapping, keep_best=0, metric='sens',
+                 max_pending=1, name='model', resume=False):
+        self.sess = sess
+        self.run_path = run_path
+        self.eval_fn = eval_fn
+        self.mapping = mapping
+        self.keep_best = keep_best
+        self.metric = metric
+        self.prefix = os.path.join(run_path, name)
+        metric_value(metric, mapping, [0.] * len(mapping), [0.] * len(mapping))
+
+        self.eval_graph = tf.Graph()
+        with self.eval_graph.as_default():
+            tf.train.import_meta_graph(meta_file)
+            eval_vars = tf.global_variables()
+            self.placeholders = [tf.placeholder(v.dtype.base_dtype, v.shape) for v in eval_vars]
+            self.assign_op = tf.group(*[v.assign(p) for v, p in zip(eval_vars, self.placeholders)])
+            self.saver = tf.train.Saver(eval_vars, max_to_keep=None if keep_best else 5)
+        self.eval_sess = tf.Session(graph=self.eval_graph)
+
+        # The same variables in the training graph, which may also hold optimizer variables
+        train_graph = sess.graph
+        self.train_vars = [train_graph.get_tensor_by_name(v.name) for v in eval_vars]
+
+        self.results = self._load_results() if resume else []
+        self.queue = queue.Queue(maxsize=max(max_pending, 1))
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _load_results(self):
+        'Results of best_checkpoints.json whose checkpoints still exist'
+        path = os.path.join(self.run_path, 'best_checkpoints.json')
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            best = json.load(f)
+        if best['metric'] != self.metric:
+            print('Ignoring {}, it ranks checkpoints by {}'.format(path, best['metric']))
+            return []
+        return [r for r in best['checkpoints'] if os.path.exists(r['path'] + '.index')]
+
+    def submit(self, step):
+        'Snapshots the current weights, to be saved as <name>-<step> and evaluated'
+        values = self.sess.run(self.train_vars)
+        self.queue.put((step, values))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            step, values = item
+            try:
+                self._save_and_eval(step, values)
+            except Exception as e:
+                print('Checkpoint {} failed: {!r}'.format(step, e))
+
+    def _save_and_eval(self, step, values):
+        self.eval_sess.run(self.assign_op, feed_dict=dict(zip(self.placeholders, values)))
+        del values
+        path = self.saver.save(self.eval_sess, self.prefix, global_step=step, write_meta_graph=False)
+        print('Saved checkpoint {}, evaluating it in the background'.format(path))
+        try:
+            with self.eval_graph.as_default():
+                result = self.eval_fn(self.eval_sess, self.eval_graph)
+        except Exception:
+            if self.keep_best:
+                self._discard(path)
+            raise
+        sens, ppvs = result[0], result[1]
+        value = metric_value(self.metric, self.mapping, sens, ppvs)
+        print('Checkpoint {}: {} {:.3f}'.format(path, self.metric, value))
+        self.results.append({'step': step, 'path': path, self.metric: value,
+                             'sens': [float(x) for x in sens], 'ppv': [float(x) for x in ppvs]})
+        if self.keep_best:
+            self._retain()
+
+    def _discard(self, path):
+        'Deletes a checkpoint that could not be evaluated, _retain would never rank it'
+        for f in glob.glob(path + '.*'):
+            os.remove(f)
+        if self.results:
+            self._retain()
+        elif os.path.exists(os.path.join(self.run_path, 'checkpoint')):
+            os.remove(os.path.join(self.run_path, 'checkpoint'))
+        print('Deleted checkpoint {}, its evaluation failed'.format(path))
+
+    def _retain(self):
+        # Best first, later checkpoints win ties
+        ranked = sorted(self.results, key=lambda r: (r[self.metric], r['step']), reverse=True)
+        kept, dropped = ranked[:self.keep_best], ranked[self.keep_best:]
+        for result in dropped:
+            if os.path.exists(result['path'] + '.index'):
+                for f in glob.glob(result['path'] + '.*'):
+                    os.remove(f)
+        self.results = kept
+        # The checkpoint state points at the best checkpoint, for tf.train.latest_checkpoint
+        tf.train.update_checkpoint_state(self.run_path, kept[0]['path'],
+                                         all_model_checkpoint_paths=[r['path'] for r in reversed(kept)])
+        with open(os.path.join(self.run_path, 'best_checkpoints.json'), 'w') as f:
+            json.dump({'metric': self.metric, 'checkpoints': kept}, f, indent=1)
+
+    def close(self):
+        'Waits for the pending checkpoints and evaluations'
+        self.queue.put(None)
+        self.thread.join()
+        self.eval_sess.close()
+        if self.keep_best and self.results:
+            print('Best checkpoints by {}:'.format(self.metric))
+            for result in self.results:
+                print('    {}: {:.3f}'.format(result['path'], result[self.metric]))
@@ -0,0 +1,180 @@
+"""Streaming bulk inference used by inference.py
+
+Images from a folder, glob or list file are decoded on a bounded thread pool and scored
+in batches, and each batch of results is appended to a CSV or JSONL file as soon as it
+is ready, so memory use does not grow with the number of images. Files already present
+in the output file are skipped, which makes runs resumable, and in watch mode the input
+folder is polled for new files.
+"""
+import csv
+import glob
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+def list_image_paths(imagedir=None, imagelist=None, imageglob=None):
+    if imagelist:
+        with open(imagelist, 'r') as f:
+            return [l.strip() for l in f if l.strip()]
+    if imageglob:
+        return sorted(glob.glob(imageglob))
+    return sorted(os.path.join(imagedir, name) for name in os.listdir(imagedir)
+                  if name.lower().endswith(IMAGE_EXTENSIONS))
+
+
+class ResultWriter:
+    'Appends one CSV row or JSON line per scored image and remembers what is already done'
+
+    def __init__(self, path, mapping, fmt='csv'):
+        self.path = path
+        self.fmt = fmt
+        self.classes = list(mapping.keys())
+        self.done = set()
+
+        if path is None:
+            self.file = sys.stdout
+            is_new = True
+        else:
+            if os.path.exists(path):
+                self._drop_partial_line()
+            is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+            if not is_new:
+                self.done = self._read_done()
+            self.file = open(path, 'a', newline='')
+
+        if fmt == 'csv':
+            self.writer = csv.writer(self.file)
+            if is_new:
+                self.writer.writerow(['file', 'prediction'] + self.classes)
+                self.file.flush()
+
+    def _drop_partial_line(self, chunk_size=65536):
+        'Truncates a last line left incomplete by a killed run, so appends start on a fresh line'
+        with open(self.path, 'rb+') as f:
+            end = f.seek(0, os.SEEK_END)
+            pos = end
+            while pos > 0:
+                start = max(pos - chunk_size, 0)
+                f.seek(start)
+                chunk = f.read(pos - start)
+                if pos == end and chunk.endswith(b'\n'):
+                    return
+                newline = chunk.rfind(b'\n')
+                if newline >= 0:
+                    f.truncate(start + newline + 1)
+                    return
+                pos = start
+            f.truncate(0)
+
+    def _read_done(self):
+        with open(self.path, 'r', newline='') as f:
+            if self.fmt == 'csv':
+                return {row['file'] for row in csv.DictReader(f)}
+            return {json.loads(line)['file'] for line in f if line.strip()}
+
+    def write(self, path, prediction, confidence):
+        if self.fmt == 'csv':
+            self.writer.writerow([path, prediction] + ['{:.6f}'.format(confidence[cls]) for cls in self.classes])
+        else:
+            self.file.write(json.dumps({'file': path, 'prediction': prediction, 'confidence': confidence}) + '\n')
+        self.done.add(path)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+def _load(preprocess, path):
+    try:
+        return path, preprocess(path)
+    except Exception as e:
+        return path, e
+
+
+def stream_batches(paths, preprocess, batch_size=16, num_workers=4, max_pending_batches=2):
+    """Yields (paths, inputs) batches, decoding at most max_pending_batches batches ahead
+
+    preprocess(path) returns a tuple of per-input arrays for one image; images that fail to
+    decode are reported and left out of the batch.
+    """
+    max_pending = batch_size * max_pending_batches
+    paths = iter(paths)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        def fill():
+            while len(pending) < max_pending:
+                path = next(paths, None)
+                if path is None:
+                    return
+                pending.append(executor.submit(_load, preprocess, path))
+
+        fill()
+        batch_paths, batch_inputs = [], []
+        while pending:
+            path, inputs = pending.popleft().result()
+            fill()
+            if isinstance(inputs, Exception):
+                print('Skipping {}: {}'.format(path, inputs), file=sys.stderr)
+                continue
+            batch_paths.append(path)
+            batch_inputs.append(inputs)
+            if len(batch_paths) == batch_size:
+                yield batch_paths, [np.stack(arrays) for arrays in zip(*batch_inputs)]
+                batch_paths, batch_inputs = [], []
+        if batch_paths:
+            yield batch_paths, [np.stack(arrays) for arrays in zip(*batch_inputs)]
+
+
+def score_paths(paths, preprocess, predict, writer, inv_mapping, batch_size=16, num_workers=4):
+    'Scores the given image paths and writes each batch of results as soon as it is ready'
+    num_scored = 0
+    for batch_paths, inputs in stream_batches(paths, preprocess, batch_size, num_workers):
+        pred = predict(inputs)
+        for i, path in enumerate(batch_paths):
+            confidence = {inv_mapping[j]: float(pred[i][j]) for j in range(len(inv_mapping))}
+            writer.write(path, inv_mapping[int(pred[i].argmax())], confidence)
+        writer.flush()
+        num_scored += len(batch_paths)
+    return num_scored
+
+
+def run_bulk(preprocess, predict, inv_mapping, writer, imagedir=None, imagelist=None, imageglob=None,
+             batch_size=16, num_workers=4, watch=False, poll_interval=5.):
+    """Scores every image not yet in writer, then optionally keeps polling for new files
+
+    In watch mode a file is only scored once its size is unchanged between two polls, so
+    that files still being copied into the folder are not read half-written.
+    """
+    sizes = {}
+    while True:
+        todo = []
+        for path in list_image_paths(imagedir, imagelist, imageglob):
+            if path in writer.done:
+                continue
+            if watch:
+                size = os.path.getsize(path) if os.path.exists(path) else None
+                if size is None or sizes.get(path) != size:
+                    sizes[path] = size
+                    continue
+            todo.append(path)
+
+        if todo:
+            num_scored = score_paths(todo, preprocess, predict, writer, inv_mapping, batch_size, num_workers)
+            print('Scored {} of {} new images'.format(num_scored, len(todo)), file=sys.stderr)
+            # Images that failed to decode are not retried on every poll
+            writer.done.update(todo)
+
+        if not watch:
+            return
+        time.sleep(poll_interval)
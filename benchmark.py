@@ -0,0 +1,209 @@
+"""Throughput and latency benchmarks for preprocessing and inference
+
+Runs without checkpoints or datasets: synthetic chest X-ray-like images are written to a
+temporary folder and inference is timed on a small stand-in graph that has the same
+input and output tensors as COVIDNet-CXR-3 (input_2:0, MEDUSA input_1:0, softmax/Softmax:0).
+Results are written as JSON so they can be compared across releases.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import tensorflow as tf
+
+from data import (
+    BalanceCovidDataset,
+    apply_augmentation,
+    augment_batch,
+    process_image_file,
+    process_image_file_dual,
+    process_image_file_medusa,
+)
+
+# To remove TF Warnings
+tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+
+def synthetic_cxr(rng, height, width):
+    """Grayscale image with a bright border, two darker lung fields and noise, stored as BGR"""
+    yy, xx = np.mgrid[0:height, 0:width]
+    img = np.full((height, width), 200., dtype='float32')
+    for cx in (0.3, 0.7):
+        lung = ((xx / width - cx) / 0.17) ** 2 + ((yy / height - 0.5) / 0.35) ** 2
+        img[lung < 1] = 70.
+    img += rng.normal(0, 12, size=img.shape)
+    img = cv2.GaussianBlur(np.clip(img, 0, 255).astype('uint8'), (0, 0), 3)
+    return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+
+
+def write_dataset(root, num_images, rng, size_range=(800, 1400)):
+    """Writes synthetic images to root/train and returns the path of a matching labels file"""
+    os.makedirs(os.path.join(root, 'train'))
+    lines = []
+    for i in range(num_images):
+        height, width = rng.randint(*size_range, size=2)
+        name = 'synthetic_{}.png'.format(i)
+        cv2.imwrite(os.path.join(root, 'train', name), synthetic_cxr(rng, height, width))
+        label = 'positive' if i % 4 == 0 else 'negative'
+        lines.append('{} {} {} synthetic\n'.format(i, name, label))
+    labels_file = os.path.join(root, 'labels.txt')
+    with open(labels_file, 'w') as f:
+        f.writelines(lines)
+    return labels_file
+
+
+def build_stand_in_graph(input_size=480, medusa_input_size=256, n_classes=2, seed=0):
+    """Small conv net with the tensor names and shapes of COVIDNet-CXR-3"""
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.set_random_seed(seed)
+        medusa_x = tf.placeholder(tf.float32, [None, medusa_input_size, medusa_input_size, 1], name='input_1')
+        x = tf.placeholder(tf.float32, [None, input_size, input_size, 3], name='input_2')
+
+        def features(inputs, filters, name):
+            with tf.variable_scope(name):
+                for i, f in enumerate(filters):
+                    inputs = tf.layers.conv2d(inputs, f, 3, strides=2, activation=tf.nn.relu, name='conv{}'.format(i))
+                return tf.reduce_mean(inputs, axis=[1, 2])
+
+        merged = tf.concat([features(x, [16, 32, 64, 64], 'covidnet'),
+                            features(medusa_x, [8, 16, 32], 'medusa')], axis=-1)
+        logits = tf.layers.dense(merged, n_classes, name='final_output')
+        with tf.name_scope('softmax'):
+            tf.nn.softmax(logits, name='Softmax')
+        init = tf.global_variables_initializer()
+    sess = tf.Session(graph=graph)
+    sess.run(init)
+    return graph, sess
+
+
+def summarize(latencies, items_per_call=1):
+    latencies = np.array(latencies)
+    return {
+        'calls': len(latencies),
+        'items_per_call': items_per_call,
+        'images_per_sec': float(items_per_call * len(latencies) / latencies.sum()),
+        'latency_ms': {
+            'mean': float(latencies.mean() * 1000),
+            'p50': float(np.percentile(latencies, 50) * 1000),
+            'p90': float(np.percentile(latencies, 90) * 1000),
+            'p99': float(np.percentile(latencies, 99) * 1000),
+        },
+    }
+
+
+def time_calls(fn, args_list, warmup=2):
+    for args in args_list[:warmup]:
+        fn(*args)
+    latencies = []
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_preprocessing(image_files, input_size, medusa_input_size, batch_sizes, rng):
+    results = {}
+    args = [(f,) for f in image_files]
+    results['process_image_file'] = summarize(time_calls(
+        lambda f: process_image_file(f, input_size, top_percent=0.08), args))
+    results['process_image_file_medusa'] = summarize(time_calls(
+        lambda f: process_image_file_medusa(f, medusa_input_size), args))
+    results['process_image_file_dual'] = summarize(time_calls(
+        lambda f: process_image_file_dual(f, input_size, medusa_input_size), args))
+
+    images = [(process_image_file(f, input_size, top_percent=0.08),) for f in image_files]
+    results['apply_augmentation'] = summarize(time_calls(lambda img: apply_augmentation(img, rng=rng), images))
+
+    batch = np.stack([img for img, in images])
+    for batch_size in batch_sizes:
+        batches = [(batch[s:s + batch_size],) for s in range(0, len(batch) - batch_size + 1, batch_size)]
+        results['augment_batch_{}'.format(batch_size)] = summarize(
+            time_calls(lambda b: augment_batch(b, rng=rng), batches, warmup=1), items_per_call=batch_size)
+    return results
+
+
+def bench_dataset(data_dir, labels_file, input_size, batch_sizes, num_batches, seed):
+    results = {}
+    for batch_size in batch_sizes:
+        dataset = BalanceCovidDataset(data_dir=data_dir, csv_file=labels_file, batch_size=batch_size,
+                                      input_shape=(input_size, input_size), seed=seed)
+        idxs = [(i % len(dataset),) for i in range(num_batches)]
+        results['batch_size_{}'.format(batch_size)] = summarize(
+            time_calls(dataset.__getitem__, idxs, warmup=1), items_per_call=batch_size)
+    return results
+
+
+def bench_session(sess, num_images, batch_sizes, input_size, medusa_input_size, rng):
+    x = rng.rand(num_images, input_size, input_size, 3).astype('float32')
+    medusa_x = rng.randn(num_images, medusa_input_size, medusa_input_size, 1).astype('float32')
+
+    results = {}
+    for batch_size in batch_sizes:
+        def run(start):
+            sess.run('softmax/Softmax:0', feed_dict={'input_2:0': x[start:start + batch_size],
+                                                     'input_1:0': medusa_x[start:start + batch_size]})
+        starts = [(s,) for s in range(0, num_images - batch_size + 1, batch_size)]
+        results['batch_size_{}'.format(batch_size)] = summarize(
+            time_calls(run, starts, warmup=1), items_per_call=batch_size)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='COVID-Net Preprocessing and Inference Benchmarks')
+    parser.add_argument('--num_images', default=64, type=int, help='Number of synthetic images to generate')
+    parser.add_argument('--batch_sizes', default=[1, 8, 32], type=int, nargs='+', help='Batch sizes to benchmark')
+    parser.add_argument('--num_batches', default=10, type=int, help='Number of dataset batches timed per batch size')
+    parser.add_argument('--input_size', default=480, type=int, help='Size of input (ex: if 480x480, --input_size 480)')
+    parser.add_argument('--input_size_medusa', default=256, type=int, help='Size of input to MEDUSA graph')
+    parser.add_argument('--seed', default=0, type=int, help='Seed for the synthetic data and sampling')
+    parser.add_argument('--output', default=None, type=str, help='JSON file to write results to, defaults to stdout')
+
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    root = tempfile.mkdtemp(prefix='covidnet_bench_')
+    # Progress prints (e.g. from BalanceCovidDataset) go to stderr, stdout only holds the report
+    with contextlib.redirect_stdout(sys.stderr):
+        try:
+            labels_file = write_dataset(root, args.num_images, rng)
+            image_files = sorted(os.path.join(root, 'train', f) for f in os.listdir(os.path.join(root, 'train')))
+
+            graph, sess = build_stand_in_graph(args.input_size, args.input_size_medusa, seed=args.seed)
+            results = {
+                'meta': {
+                    'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'python': platform.python_version(),
+                    'tensorflow': tf.__version__,
+                    'opencv': cv2.__version__,
+                    'numpy': np.__version__,
+                    'cpu_count': os.cpu_count(),
+                    'args': vars(args),
+                },
+                'preprocessing': bench_preprocessing(image_files, args.input_size, args.input_size_medusa,
+                                                     args.batch_sizes, rng),
+                'dataset_getitem': bench_dataset(root, labels_file, args.input_size, args.batch_sizes,
+                                                 args.num_batches, args.seed),
+                'session_run': bench_session(sess, max(args.batch_sizes) * 4, args.batch_sizes,
+                                             args.input_size, args.input_size_medusa, rng),
+            }
+            sess.close()
+        finally:
+            shutil.rmtree(root)
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
@@ -0,0 +1,454 @@
+"""Builds the COVIDx dataset from its source datasets
+
+Script version of create_ricord_dataset/create_ricord_dataset.ipynb followed by
+create_COVIDx.ipynb (or create_COVIDx_binary.ipynb with --binary), producing the same
+images and train/test label files (patientid filename label source) for the same seed.
+
+Parsing the source metadata and choosing the train/test split is cheap and done up front.
+Every image to write (RICORD DICOM conversion, copies, sirm grayscale conversion, RSNA DICOM
+conversion) is then a job run in a process pool. Outputs are written to a temporary file and
+renamed into place, so an interrupted build never leaves a truncated image, and a manifest in
+savepath records the sha256 of each job's source and output. On a rerun, jobs whose source
+and output still match the manifest are skipped, so a build can be resumed or refreshed
+without redoing the images that are already done.
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import random
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cv2
+import numpy as np
+import pandas as pd
+import pydicom as dicom
+from pydicom.pixel_data_handlers import apply_modality_lut, apply_voi_lut
+
+MANIFEST_NAME = 'build_manifest.json'
+
+MAPPING = {
+    'COVID-19': 'COVID-19',
+    'SARS': 'pneumonia',
+    'MERS': 'pneumonia',
+    'Streptococcus': 'pneumonia',
+    'Klebsiella': 'pneumonia',
+    'Chlamydophila': 'pneumonia',
+    'Legionella': 'pneumonia',
+    'E.Coli': 'pneumonia',
+    'Normal': 'normal',
+    'Lung Opacity': 'pneumonia',
+    '1': 'pneumonia',
+}
+
+COHEN_VIEWS = ['PA', 'AP', 'AP Supine', 'AP semi erect', 'AP erect']
+SIRM_DISCARD = ['100', '101', '102', '103', '104', '105',
+                '110', '111', '112', '113', '122', '123',
+                '124', '125', '126', '217']
+
+# Test patients of covid-chestxray-dataset, figure1, actualmed and sirm. '191' and
+# 'COVID-00024' are joined by a missing comma in the notebooks, kept to reproduce their split
+TEST_PATIENTS = {
+    'pneumonia': ['8', '31'],
+    'COVID-19': ['19', '20', '36', '42', '86',
+                 '94', '97', '117', '132',
+                 '138', '144', '150', '163', '169', '174', '175', '179', '190', '191'
+                 'COVID-00024', 'COVID-00025', 'COVID-00026', 'COVID-00027', 'COVID-00029',
+                 'COVID-00030', 'COVID-00032', 'COVID-00033', 'COVID-00035', 'COVID-00036',
+                 'COVID-00037', 'COVID-00038',
+                 'ANON24', 'ANON45', 'ANON126', 'ANON106', 'ANON67',
+                 'ANON153', 'ANON135', 'ANON44', 'ANON29', 'ANON201',
+                 'ANON191', 'ANON234', 'ANON110', 'ANON112', 'ANON73',
+                 'ANON220', 'ANON189', 'ANON30', 'ANON53', 'ANON46',
+                 'ANON218', 'ANON240', 'ANON100', 'ANON237', 'ANON158',
+                 'ANON174', 'ANON19', 'ANON195',
+                 'COVID 119', 'COVID 87', 'COVID 70', 'COVID 94',
+                 'COVID 215', 'COVID 77', 'COVID 213', 'COVID 81',
+                 'COVID 216', 'COVID 72', 'COVID 106', 'COVID 131',
+                 'COVID 107', 'COVID 116', 'COVID 95', 'COVID 214',
+                 'COVID 129',
+                 '419639-000025', '419639-001464'],
+}
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def write_atomic(path, data):
+    'Writes bytes to path through a temporary file in the same directory'
+    tmp = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def encode_image(path, image):
+    ok, buf = cv2.imencode(os.path.splitext(path)[1], image)
+    if not ok:
+        raise IOError('Could not encode {}'.format(path))
+    return buf.tobytes()
+
+
+# RICORD conversion, from create_ricord_dataset.ipynb
+
+def load_ricord_metadata(ricord_meta_file):
+    df = pd.read_excel(ricord_meta_file, sheet_name='CR Pos - TCIA Submission')
+    return [(row['Anon MRN'], row['Anon TCIA Study Date'], row['Anon Exam Description'], row['Anon Study UID'])
+            for row in df.to_dict('records')]
+
+
+def make_ricord_dict(ricord_data_set_file):
+    """Loads bboxes from the given text file"""
+    ricord_dict = {}
+    with open(ricord_data_set_file, 'r') as f:
+        for line in f:
+            # Values after file name are crop dimensions
+            values = line.split()
+            if len(values) > 1:
+                ricord_dict[values[0]] = tuple(int(c) for c in values[1:5])
+            elif values:
+                ricord_dict[values[0]] = None
+    return ricord_dict
+
+
+def ricord_image(ds):
+    'Converts a RICORD DICOM dataset to a uint8 image'
+    if ds.pixel_array.dtype != np.uint8:
+        # Apply LUT transforms
+        arr = apply_modality_lut(ds.pixel_array, ds)
+        if arr.dtype == np.float64 and ds.RescaleSlope == 1 and ds.RescaleIntercept == 0:
+            arr = arr.astype(np.uint16)
+        arr = apply_voi_lut(arr, ds)
+        arr = arr.astype(np.float64)
+
+        # Normalize to [0, 1]
+        arr = (arr - arr.min())/arr.ptp()
+
+        # Invert MONOCHROME1 images
+        if ds.PhotometricInterpretation == 'MONOCHROME1':
+            arr = 1. - arr
+        return np.uint8(255.*arr)
+    if ds.PhotometricInterpretation == 'MONOCHROME1':
+        return 255 - ds.pixel_array
+    return ds.pixel_array
+
+
+def ricord_jobs(ricord_dir, ricord_meta_file, ricord_set_file, out_dir):
+    'Returns the (kind, source, output, params) jobs converting the usable RICORD DICOM files'
+    ricord_dict = make_ricord_dict(ricord_set_file)
+    jobs = []
+    for mrn, date, desc, uid in load_ricord_metadata(ricord_meta_file):
+        uid = uid[-5:]
+        study_dir = os.path.join(ricord_dir, 'MIDRC-RICORD-1C-{}'.format(mrn), '*-{}'.format(uid))
+        dcm_files = sorted(glob.glob(os.path.join(study_dir, '*', '*.dcm')))
+        for i, dcm_file in enumerate(dcm_files):
+            out_fname = 'MIDRC-RICORD-1C-{}-{}-{}.png'.format(mrn, uid, i)
+            if out_fname in ricord_dict:
+                jobs.append(('ricord', dcm_file, os.path.join(out_dir, out_fname), ricord_dict[out_fname]))
+    return jobs
+
+
+# COVIDx split, from create_COVIDx.ipynb and create_COVIDx_binary.ipynb
+
+def collect_entries(args):
+    """Returns {label: [[patientid, filename, label, source], ...]} for the cohen, fig1,
+    actmed, sirm and ricord COVID datasets, in the order the notebooks visit them"""
+    labels = (['negative'] if args.binary else []) + ['normal', 'pneumonia', 'COVID-19']
+    filename_label = {label: [] for label in labels}
+    # The last entry added, see the fig1 loop
+    entry = None
+
+    cohen_csv = pd.read_csv(os.path.join(args.cohen_dir, 'metadata.csv'))
+    cohen_csv = cohen_csv[cohen_csv.view.isin(COHEN_VIEWS)]
+    for row in cohen_csv.to_dict('records'):
+        f = row['finding'].split('/')[-1]  # take final finding in hierarchy, for the case of COVID-19, ARDS
+        url = str(row['url'])
+        if f == 'COVID-19' and ('eurorad.org' in url or 'ml-workgroup' in url or 'sirm.org' in url):
+            # skip COVID-19 positive images from eurorad to not duplicate sirm images
+            pass
+        elif f in MAPPING:
+            entry = [str(row['patientid']), row['filename'], MAPPING[f], 'cohen']
+            filename_label[MAPPING[f]].append(entry)
+        elif args.binary:
+            entry = [str(row['patientid']), row['filename'], 'negative', 'cohen']
+            filename_label['negative'].append(entry)
+
+    fig1_imgpath = os.path.join(args.fig1_dir, 'images')
+    fig1_csv = pd.read_csv(os.path.join(args.fig1_dir, 'metadata.csv'), encoding='ISO-8859-1')
+    for row in fig1_csv.to_dict('records'):
+        if str(row['finding']) == 'nan':
+            continue
+        f = row['finding'].split(',')[0]  # take the first finding
+        if f not in MAPPING:
+            continue
+        for ext in ('.jpg', '.png'):
+            if os.path.exists(os.path.join(fig1_imgpath, row['patientid'] + ext)):
+                entry = [row['patientid'], row['patientid'] + ext, MAPPING[f], 'fig1']
+                break
+        else:
+            # Without a .jpg or .png image the notebooks add the previous entry again, kept to
+            # reproduce their split
+            if entry is None:
+                raise FileNotFoundError('No .jpg or .png image for fig1 patient {}'.format(row['patientid']))
+        filename_label[MAPPING[f]].append(entry)
+
+    actmed_csv = pd.read_csv(os.path.join(args.actmed_dir, 'metadata.csv'))
+    for row in actmed_csv.to_dict('records'):
+        if str(row['finding']) == 'nan':
+            continue
+        f = row['finding'].split(',')[0]
+        if f in MAPPING:
+            filename_label[MAPPING[f]].append([row['patientid'], row['imagename'], MAPPING[f], 'actmed'])
+        elif args.binary:
+            filename_label['negative'].append([row['patientid'], row['imagename'], 'negative', 'actmed'])
+
+    sirm_imgpath = os.path.join(args.sirm_dir, 'COVID')
+    sirm_csv = pd.read_excel(os.path.join(args.sirm_dir, 'COVID.metadata.xlsx'))
+    # Add base URL to remove sirm images from ieee dataset
+    cohen_urls = set(cohen_csv['url']) | {'https://github.com/ieee8023/covid-chestxray-dataset'}
+    for row in sirm_csv.to_dict('records'):
+        patientid = row['FILE NAME']
+        if row['URL'] in cohen_urls or patientid[patientid.find('(')+1:patientid.find(')')] in SIRM_DISCARD:
+            continue
+        imagename = patientid + '.' + row['FORMAT'].lower()
+        if not os.path.exists(os.path.join(sirm_imgpath, imagename)):
+            imagename = 'COVID ({}).png'.format(imagename.rsplit('.png')[0].split('COVID ')[1])
+        filename_label['COVID-19'].append([patientid, imagename, 'COVID-19', 'sirm'])
+
+    with open(args.ricord_set_file) as f:
+        for line in f:
+            if line.split():
+                imagename = line.split()[0]
+                patientid = imagename.split('-')[3] + '-' + imagename.split('-')[4]
+                filename_label['COVID-19'].append([patientid, imagename, 'COVID-19', 'ricord'])
+    return filename_label
+
+
+def patients_with_one_image(entries, source):
+    counts = Counter(entry[0] for entry in entries if entry[3] == source)
+    return [patient for patient, count in counts.items() if count == 1]
+
+
+def split_covidx(args, filename_label, rng):
+    'Returns the train and test entries and the (kind, source, output, params) jobs writing their images'
+    ds_imgpath = {'cohen': os.path.join(args.cohen_dir, 'images'),
+                  'fig1': os.path.join(args.fig1_dir, 'images'),
+                  'actmed': os.path.join(args.actmed_dir, 'images'),
+                  'sirm': os.path.join(args.sirm_dir, 'COVID'),
+                  'ricord': args.ricord_imgpath}
+    test_patients = {key: set(patients) for key, patients in TEST_PATIENTS.items()}
+    # RICORD patients with a single image go to test, 176 patients
+    test_patients['COVID-19'].update(patients_with_one_image(filename_label['COVID-19'], 'ricord'))
+    if args.binary:
+        # A random sample of 20 'negative' actmed patients with a single image go to test
+        test_patients['negative'] = set(rng.sample(patients_with_one_image(filename_label['negative'], 'actmed'), 20))
+
+    train, test, jobs = [], [], []
+    # to avoid duplicates
+    patient_imgpath = {}
+    for key, entries in filename_label.items():
+        for patient in entries:
+            images = patient_imgpath.setdefault(patient[0], [])
+            if patient[1] in images:
+                continue  # skip since image has already been written
+            images.append(patient[1])
+
+            split = 'test' if patient[0] in test_patients.get(key, ()) else 'train'
+            src = os.path.join(ds_imgpath[patient[3]], patient[1])
+            if patient[3] == 'sirm':
+                patient = [patient[0], patient[1].replace(' ', '')] + patient[2:]
+                jobs.append(('gray', src, os.path.join(args.savepath, split, patient[1]), None))
+            else:
+                jobs.append(('copy', src, os.path.join(args.savepath, split, patient[1]), None))
+            (test if split == 'test' else train).append(patient)
+
+    # add normal and rest of pneumonia cases from the RSNA pneumonia detection challenge
+    csv_normal = pd.read_csv(os.path.join(args.rsna_dir, 'stage_2_detailed_class_info.csv'))
+    # images that are neither pneumonia nor normal have Target 0, so only 1s are used
+    csv_pneu = pd.read_csv(os.path.join(args.rsna_dir, 'stage_2_train_labels.csv'))
+    patients = {'normal': csv_normal.patientId[csv_normal['class'] == 'Normal'].tolist(),
+                'pneumonia': csv_pneu.patientId[csv_pneu.Target.astype(int) == 1].tolist()}
+    for key, arr in patients.items():
+        rsna_test = set(np.load(os.path.join(args.rsna_test_dir, 'rsna_test_patients_{}.npy'.format(key))).tolist())
+        for patient in arr:
+            if patient in patient_imgpath:
+                continue  # skip since image has already been written
+            patient_imgpath[patient] = [patient]
+
+            split = 'test' if patient in rsna_test else 'train'
+            imgname = patient + '.png'
+            jobs.append(('rsna', os.path.join(args.rsna_dir, 'stage_2_train_images', patient + '.dcm'),
+                         os.path.join(args.savepath, split, imgname), None))
+            (test if split == 'test' else train).append([patient, imgname, key, 'rsna'])
+
+    if args.binary:
+        # The test set keeps the COVID-19 and actmed negative test samples and a random selection
+        # of 10 normal and 70 pneumonia cases
+        final_test = [entry for entry in test if entry[2] == 'COVID-19' or
+                      (entry[3] == 'actmed' and entry[2] == 'negative')]
+        normal_cases = [entry for entry in test if entry[2] == 'normal']
+        pneumonia_cases = [entry for entry in test if entry[2] == 'pneumonia']
+        test = final_test + rng.sample(normal_cases, 10) + rng.sample(pneumonia_cases, 70)
+    return train, test, jobs
+
+
+def write_labels(path, entries, binary=False):
+    'Writes entries in the labels file format, patientid filename label source'
+    lines = []
+    for patient, filename, label, source in entries:
+        if binary:
+            label = 'positive' if label == 'COVID-19' else 'negative'
+        lines.append('{} {} {} {}\n'.format(patient, filename, label, source))
+    write_atomic(path, ''.join(lines).encode())
+
+
+# Jobs, run in worker processes
+
+def _convert(kind, src, dst, params):
+    'Returns the encoded output image, or None if src is excluded'
+    if kind == 'copy':
+        with open(src, 'rb') as f:
+            return f.read()
+    if kind == 'gray':
+        return encode_image(dst, cv2.cvtColor(cv2.imread(src), cv2.COLOR_BGR2GRAY))
+    ds = dicom.dcmread(src)
+    if kind == 'rsna':
+        return encode_image(dst, ds.pixel_array)
+    # Verify orientation
+    if ds.ViewPosition != 'AP' and ds.ViewPosition != 'PA':
+        return None
+    image = ricord_image(ds)
+    if params is not None:
+        image = image[params[1]:params[3], params[0]:params[2]]
+    return encode_image(dst, image)
+
+
+def run_job(job, known=None):
+    """Runs a job unless the manifest entry known still matches its source and output
+
+    Returns (manifest entry, status), status being 'unchanged', 'written' or 'excluded'.
+    """
+    kind, src, dst, params = job
+    source_hash = file_sha256(src)
+    entry = {'kind': kind, 'params': None if params is None else list(params), 'source': source_hash}
+    if known is not None and all(known.get(k) == v for k, v in entry.items()):
+        if known['output'] is None:
+            return known, 'excluded'
+        if os.path.exists(dst) and file_sha256(dst) == known['output']:
+            return known, 'unchanged'
+
+    data = _convert(kind, src, dst, params)
+    if data is None:
+        entry['output'] = None
+        return entry, 'excluded'
+    write_atomic(dst, data)
+    entry['output'] = hashlib.sha256(data).hexdigest()
+    return entry, 'written'
+
+
+class Manifest:
+    'sha256 of the source and output of every job, saved in savepath'
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
+
+    def get(self, dst):
+        return self.entries.get(os.path.normpath(dst))
+
+    def set(self, dst, entry):
+        self.entries[os.path.normpath(dst)] = entry
+
+    def save(self):
+        write_atomic(self.path, json.dumps(self.entries).encode())
+
+
+def run_jobs(jobs, manifest, executor, save_every=500):
+    'Runs jobs in executor, saving the manifest every save_every jobs, and returns the status counts'
+    for kind, src, dst, params in jobs:
+        os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+    futures = {executor.submit(run_job, job, manifest.get(job[2])): job for job in jobs}
+    counts = Counter()
+    failed = []
+    for n, future in enumerate(as_completed(futures)):
+        job = futures[future]
+        try:
+            entry, status = future.result()
+        except Exception as e:
+            # Other images are still written, the failed ones are retried on the next run
+            print('Failed to convert {}: {}'.format(job[1], e))
+            failed.append(job[1])
+            continue
+        manifest.set(job[2], entry)
+        counts[status] += 1
+        if status == 'excluded':
+            print('Excluded {}, not an AP/PA view'.format(job[1]))
+        if (n + 1) % save_every == 0:
+            manifest.save()
+            print('{}/{} images done'.format(n + 1, len(jobs)))
+    manifest.save()
+    if failed:
+        raise RuntimeError('{} images failed to convert, rerun to retry them'.format(len(failed)))
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='COVIDx Dataset Builder')
+    parser.add_argument('--savepath', default='data', type=str, help='Folder the train and test folders are created in')
+    parser.add_argument('--binary', action='store_true',
+                        help='Build the COVID-19 positive/negative dataset of create_COVIDx_binary.ipynb')
+    parser.add_argument('--trainfile', default='train_split.txt', type=str, help='Train labels file to write')
+    parser.add_argument('--testfile', default='test_split.txt', type=str, help='Test labels file to write')
+    parser.add_argument('--seed', default=0, type=int, help='Seed of the random test selections')
+    parser.add_argument('--num_workers', default=os.cpu_count() or 1, type=int, help='Number of worker processes')
+    parser.add_argument('--cohen_dir', default='../covid-chestxray-dataset', type=str,
+                        help='Path to https://github.com/ieee8023/covid-chestxray-dataset')
+    parser.add_argument('--fig1_dir', default='../Figure1-COVID-chestxray-dataset', type=str,
+                        help='Path to https://github.com/agchung/Figure1-COVID-chestxray-dataset')
+    parser.add_argument('--actmed_dir', default='../Actualmed-COVID-chestxray-dataset', type=str,
+                        help='Path to https://github.com/agchung/Actualmed-COVID-chestxray-dataset')
+    parser.add_argument('--sirm_dir', default='../COVID-19-Radiography-Database', type=str,
+                        help='Path to https://www.kaggle.com/tawsifurrahman/covid19-radiography-database')
+    parser.add_argument('--rsna_dir', default='../rsna-pneumonia-detection-challenge', type=str,
+                        help='Path to https://www.kaggle.com/c/rsna-pneumonia-detection-challenge')
+    parser.add_argument('--rsna_test_dir', default='.', type=str,
+                        help='Folder of the rsna_test_patients_{normal,pneumonia}.npy files')
+    parser.add_argument('--ricord_dir', default=None, type=str,
+                        help='Path to the RICORD DICOM_images, converts them before building COVIDx if given')
+    parser.add_argument('--ricord_meta_file', default=None, type=str,
+                        help='Path to the RICORD clinical data xlsx, required with --ricord_dir')
+    parser.add_argument('--ricord_set_file', default='create_ricord_dataset/ricord_data_set.txt', type=str,
+                        help='Usable RICORD images and their crops')
+    parser.add_argument('--ricord_imgpath', default='create_ricord_dataset/ricord_images', type=str,
+                        help='Folder of the converted RICORD images')
+
+    args = parser.parse_args()
+
+    if args.ricord_dir and not args.ricord_meta_file:
+        parser.error('--ricord_meta_file is required with --ricord_dir')
+
+    rng = random.Random(args.seed)
+    os.makedirs(args.savepath, exist_ok=True)
+    manifest = Manifest(os.path.join(args.savepath, MANIFEST_NAME))
+    with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+        if args.ricord_dir:
+            jobs = ricord_jobs(args.ricord_dir, args.ricord_meta_file, args.ricord_set_file, args.ricord_imgpath)
+            print('RICORD: {}'.format(dict(run_jobs(jobs, manifest, executor))))
+
+        train, test, jobs = split_covidx(args, collect_entries(args), rng)
+        print('COVIDx: {}'.format(dict(run_jobs(jobs, manifest, executor))))
+
+    write_labels(args.trainfile, train, binary=args.binary)
+    write_labels(args.testfile, test, binary=args.binary)
+    print('Train count: ', dict(Counter(entry[2] for entry in train)))
+    print('Test count: ', dict(Counter(entry[2] for entry in test)))
@@ -0,0 +1,208 @@
+"""Duplicate image and train/test leakage check across the COVIDx label files
+
+Every image referenced by the label files (train_* files in <datadir>/train, test_* files in
+<datadir>/test) is hashed twice: a sha256 of the file content finds exact duplicates, and a
+64-bit difference hash (dHash) of the downscaled grayscale image finds near duplicates such
+as re-encoded or resized copies. Hashes are kept in an index keyed by image path and only
+recomputed for new files or files whose mtime or size changed, so checking a new split only
+hashes the images it adds.
+
+For every train/test pair of label files the report lists patients present in both splits
+and test images whose content (exact or near duplicate) is also in train. Near duplicates
+are found with the pigeonhole principle: two hashes within max_distance bits agree exactly on
+at least one of max_distance + 1 bands, so only images sharing a band are compared, which
+keeps the search near-linear instead of comparing all pairs.
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from data import LabelIndex
+
+INDEX_NAME = 'content_index.json'
+
+
+def image_hashes(path):
+    'Returns the sha256 of the file and the dHash of its image (None if it cannot be decoded)'
+    with open(path, 'rb') as f:
+        data = f.read()
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE)
+    dhash = None
+    if img is not None:
+        small = cv2.resize(img, (9, 8), interpolation=cv2.INTER_AREA)
+        bits = (small[:, 1:] > small[:, :-1]).flatten()
+        dhash = int(np.packbits(bits).view('>u8')[0])
+    return hashlib.sha256(data).hexdigest(), dhash
+
+
+def update_index(index_file, paths, num_workers=8):
+    """Adds the hashes of paths to the index in index_file, hashing only new or modified files
+
+    Returns {path: [mtime, size, sha256, dhash]} for the paths that exist, and the missing paths.
+    """
+    files = {}
+    if os.path.exists(index_file):
+        with open(index_file, 'r') as f:
+            files = json.load(f)
+
+    stale, missing = [], []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            missing.append(path)
+            continue
+        stat = [st.st_mtime, st.st_size]
+        if path not in files or files[path][:2] != stat:
+            files[path] = stat + [None, None]
+            stale.append(path)
+
+    if stale:
+        print('Hashing {} of {} images'.format(len(stale), len(paths) - len(missing)))
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            for path, hashes in zip(stale, executor.map(image_hashes, stale)):
+                files[path][2:] = hashes
+        os.makedirs(os.path.dirname(index_file) or '.', exist_ok=True)
+        with open(index_file + '.tmp', 'w') as f:
+            json.dump(files, f)
+        os.replace(index_file + '.tmp', index_file)
+
+    existing = set(paths).difference(missing)
+    return {path: entry for path, entry in files.items() if path in existing}, missing
+
+
+def split_pairs(label_files):
+    'Returns {version: (train labels file, test labels file)} matching train_<version>/test_<version>'
+    names = {os.path.basename(f): f for f in label_files}
+    pairs = {}
+    for name, path in sorted(names.items()):
+        if name.startswith('train_') and 'test_' + name[len('train_'):] in names:
+            pairs[os.path.splitext(name[len('train_'):])[0]] = (path, names['test_' + name[len('train_'):]])
+    return pairs
+
+
+def near_duplicates(dhashes, max_distance=4, max_bucket=1000):
+    """Returns the pairs (i, j), i < j, of dhashes within max_distance bits of each other
+
+    Buckets with more than max_bucket hashes (e.g. blank images) are skipped rather than
+    compared pairwise.
+    """
+    bands = np.array_split(np.arange(64), max_distance + 1)
+    masks = [sum(1 << int(b) for b in band) for band in bands]
+    pairs = set()
+    for mask in masks:
+        buckets = defaultdict(list)
+        for i, h in enumerate(dhashes):
+            if h is not None:
+                buckets[h & mask].append(i)
+        for bucket in buckets.values():
+            if len(bucket) > max_bucket:
+                print('Skipping {} images sharing a hash band'.format(len(bucket)))
+                continue
+            for a in range(len(bucket)):
+                for b in range(a + 1, len(bucket)):
+                    i, j = bucket[a], bucket[b]
+                    if bin(dhashes[i] ^ dhashes[j]).count('1') <= max_distance:
+                        pairs.add((i, j))
+    return sorted(pairs)
+
+
+def content_groups(files, max_distance=4):
+    """Groups paths of identical or near-identical images
+
+    Returns (exact, near): lists of path groups sharing a sha256, and list of path group pairs
+    whose dHashes are within max_distance bits but whose content differs.
+    """
+    by_sha = defaultdict(list)
+    for path, (mtime, size, sha, dhash) in files.items():
+        by_sha[sha].append(path)
+    shas = list(by_sha)
+    dhashes = [files[by_sha[sha][0]][3] for sha in shas]
+    exact = [paths for paths in by_sha.values() if len(paths) > 1]
+    near = [(by_sha[shas[i]], by_sha[shas[j]]) for i, j in near_duplicates(dhashes, max_distance)]
+    return exact, near
+
+
+def check_split(train_index, test_index, train_paths, test_paths, files, near):
+    """Returns the patients in both splits and the (test, train) image path pairs with the
+    same or near-identical content"""
+    patients = np.intersect1d(train_index.patient_ids, test_index.patient_ids).tolist()
+
+    train_by_sha = defaultdict(list)
+    for path in train_paths:
+        if path in files:
+            train_by_sha[files[path][2]].append(path)
+    near_by_path = defaultdict(list)
+    for a, b in near:
+        for path in a:
+            near_by_path[path].extend(b)
+        for path in b:
+            near_by_path[path].extend(a)
+    train_set = set(train_paths)
+
+    leaks = []
+    for path in dict.fromkeys(test_paths):
+        if path not in files:
+            continue
+        matches = train_by_sha.get(files[path][2], []) + [p for p in near_by_path.get(path, []) if p in train_set]
+        leaks.extend((path, match) for match in dict.fromkeys(matches) if match != path)
+    return patients, leaks
+
+
+def label_paths(labels_file, index, datadir):
+    split = 'test' if os.path.basename(labels_file).startswith('test_') else 'train'
+    return [os.path.join(datadir, split, name) for name in index.filenames]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='COVIDx Duplicate and Leakage Check')
+    parser.add_argument('--labels', default='labels/*.txt', type=str,
+                        help='Glob of the train_*/test_* label files to check')
+    parser.add_argument('--datadir', default='data', type=str, help='Folder with the train and test image folders')
+    parser.add_argument('--index', default=None, type=str,
+                        help='Hash index file, defaults to <datadir>/' + INDEX_NAME)
+    parser.add_argument('--max_distance', default=4, type=int,
+                        help='Max dHash bit difference for images to count as near duplicates')
+    parser.add_argument('--num_workers', default=8, type=int, help='Number of hashing threads')
+    parser.add_argument('--report', default=None, type=str, help='Write the full report to this JSON file')
+
+    args = parser.parse_args()
+
+    label_files = sorted(glob.glob(args.labels))
+    indexes = {f: LabelIndex.load(f) for f in label_files}
+    paths = {f: label_paths(f, index, args.datadir) for f, index in indexes.items()}
+    all_paths = list(dict.fromkeys(p for f in label_files for p in paths[f]))
+
+    files, missing = update_index(args.index or os.path.join(args.datadir, INDEX_NAME), all_paths,
+                                  num_workers=args.num_workers)
+    if missing:
+        print('{} of {} images are missing from {}'.format(len(missing), len(all_paths), args.datadir))
+    undecodable = [path for path, entry in files.items() if entry[3] is None]
+    if undecodable:
+        print('{} images could not be decoded, e.g. {}'.format(len(undecodable), undecodable[0]))
+
+    exact, near = content_groups(files, args.max_distance)
+    print('{} images: {} groups of identical files ({} images), {} near-duplicate pairs'.format(
+        len(files), len(exact), sum(len(g) for g in exact), len(near)))
+
+    report = {'missing': missing, 'undecodable': undecodable, 'identical': exact,
+              'near_duplicates': near, 'splits': {}}
+    print('{:<12}{:>10}{:>10}{:>18}{:>14}'.format('split', 'train', 'test', 'shared patients', 'leaked images'))
+    for version, (train_file, test_file) in split_pairs(label_files).items():
+        patients, leaks = check_split(indexes[train_file], indexes[test_file], paths[train_file],
+                                      paths[test_file], files, near)
+        print('{:<12}{:>10}{:>10}{:>18}{:>14}'.format(version, len(indexes[train_file]), len(indexes[test_file]),
+                                                      len(patients), len(set(t for t, _ in leaks))))
+        report['splits'][version] = {'shared_patients': patients, 'leaked_images': leaks}
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=1)
+        print('Wrote report to {}'.format(args.report))
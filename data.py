@@ -1,13 +1,13 @@
 import tensorflow as tf
 from tensorflow import keras
 
-from functools import partial
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import os
+import time
 import cv2
 
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
-
 def crop_top(img, percent=0.15):
     offset = int(img.shape[0] * percent)
     return img[offset:]
@@ -18,27 +18,67 @@ def central_crop(img):
     offset_w = int((img.shape[1] - size) / 2)
     return img[offset_h:offset_h + size, offset_w:offset_w + size]
 
-def process_image_file(filepath, size, top_percent=0.08, crop=True):
-    img = cv2.imread(filepath)
+def process_image(img, size, top_percent=0.08, crop=True):
     img = crop_top(img, percent=top_percent)
     if crop:
         img = central_crop(img)
     img = cv2.resize(img, (size, size))
     return img
 
-def process_image_file_medusa(filepath, size):
-    img = cv2.imread(filepath, cv2.IMREAD_GRAYSCALE)
+def read_image(filepath, flags=cv2.IMREAD_COLOR):
+    # cv2.imread returns None instead of raising for missing or corrupt files
+    img = cv2.imread(filepath, flags)
+    if img is None:
+        raise IOError('Could not read image {}'.format(filepath))
+    return img
+
+def process_image_file(filepath, size, top_percent=0.08, crop=True):
+    img = read_image(filepath)
+    return process_image(img, size, top_percent=top_percent, crop=crop)
+
+def process_image_medusa(img, size):
     img = cv2.resize(img, (size, size))
-    img = img.astype('float64')
+    img = img.astype('float32')
     img -= img.mean()
     img /= img.std()
     return np.expand_dims(img, -1)
 
-def random_ratio_resize(img, prob=0.3, delta=0.1):
-    if np.random.rand() >= prob:
+def process_image_file_medusa(filepath, size):
+    img = read_image(filepath, cv2.IMREAD_GRAYSCALE)
+    return process_image_medusa(img, size)
+
+def process_image_dual(img, size, medusa_size):
+    # COVIDNet CXR-3 inputs from a single decoded BGR image: the uncropped color image for
+    # COVID-Net and the standardized grayscale image for MEDUSA
+    x = process_image(img, size, top_percent=0, crop=False)
+    medusa_x = process_image_medusa(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), medusa_size)
+    return x, medusa_x
+
+def process_image_file_dual(filepath, size, medusa_size):
+    img = read_image(filepath)
+    return process_image_dual(img, size, medusa_size)
+
+def pad_batch(batch, batch_size):
+    """Zero-pads the leading (batch) dimension of an array up to batch_size"""
+    if len(batch) >= batch_size:
+        return batch
+    pad = np.zeros((batch_size - len(batch), *batch.shape[1:]), dtype=batch.dtype)
+    return np.concatenate([batch, pad], axis=0)
+
+def merge_pneumonia(pred, mapping):
+    # Normal/pneumonia probabilities of 3-class softmax outputs, combining COVID-19 and
+    # non-COVID-19 pneumonia as COVIDNet-P does
+    pred = np.asarray(pred)
+    merged = np.stack([pred[..., mapping['normal']],
+                       np.maximum(pred[..., mapping['pneumonia']], pred[..., mapping['COVID-19']])], axis=-1)
+    return merged / np.sum(merged, axis=-1, keepdims=True)
+
+def random_ratio_resize(img, prob=0.3, delta=0.1, rng=np.random):
+    if rng.rand() >= prob:
         return img
+    shape = img.shape
     ratio = img.shape[0] / img.shape[1]
-    ratio = np.random.uniform(max(ratio - delta, 0.01), ratio + delta)
+    ratio = rng.uniform(max(ratio - delta, 0.01), ratio + delta)
 
     if ratio * img.shape[1] <= img.shape[1]:
         size = (int(img.shape[1] * ratio), img.shape[1])
@@ -50,34 +90,90 @@ def random_ratio_resize(img, prob=0.3, delta=0.1):
     dw = img.shape[1] - size[0]
     left, right = dw // 2, dw - dw // 2
 
-    if size[0] > 480 or size[1] > 480:
-        print(img.shape, size, ratio)
-
     img = cv2.resize(img, size)
     img = cv2.copyMakeBorder(img, top, bot, left, right, cv2.BORDER_CONSTANT,
                              (0, 0, 0))
 
-    if img.shape[0] != 480 or img.shape[1] != 480:
+    if img.shape != shape:
         raise ValueError(img.shape, size)
     return img
 
-_augmentation_transform = ImageDataGenerator(
-    featurewise_center=False,
-    featurewise_std_normalization=False,
-    rotation_range=10,
-    width_shift_range=0.1,
-    height_shift_range=0.1,
-    horizontal_flip=True,
-    brightness_range=(0.9, 1.1),
-    zoom_range=(0.85, 1.15),
-    fill_mode='constant',
-    cval=0.,
-)
-
-def apply_augmentation(img):
-    img = random_ratio_resize(img)
-    img = _augmentation_transform.random_transform(img)
-    return img
+# Same ranges as the ImageDataGenerator previously used for training, plus random_ratio_resize
+AUGMENTATION_RANGES = {
+    'ratio_prob': 0.3,
+    'ratio_delta': 0.1,
+    'rotation_range': 10,
+    'width_shift_range': 0.1,
+    'height_shift_range': 0.1,
+    'horizontal_flip': True,
+    'brightness_range': (0.9, 1.1),
+    'zoom_range': (0.85, 1.15),
+}
+
+def sample_augmentation_params(batch_size, img_shape, rng=np.random, ranges=AUGMENTATION_RANGES):
+    'Draws the augmentation parameters of a whole batch at once'
+    n = batch_size
+    ratio = img_shape[0] / img_shape[1]
+    new_ratio = rng.uniform(max(ratio - ranges['ratio_delta'], 0.01), ratio + ranges['ratio_delta'], size=n)
+    use_ratio = rng.rand(n) < ranges['ratio_prob']
+    return {
+        # random_ratio_resize shrinks one side so that the content has the sampled aspect ratio
+        'ratio_x': np.where(use_ratio, np.minimum(1., new_ratio / ratio), 1.),
+        'ratio_y': np.where(use_ratio, np.minimum(1., ratio / new_ratio), 1.),
+        'theta': rng.uniform(-ranges['rotation_range'], ranges['rotation_range'], size=n),
+        'tx': rng.uniform(-ranges['width_shift_range'], ranges['width_shift_range'], size=n) * img_shape[1],
+        'ty': rng.uniform(-ranges['height_shift_range'], ranges['height_shift_range'], size=n) * img_shape[0],
+        'zx': rng.uniform(ranges['zoom_range'][0], ranges['zoom_range'][1], size=n),
+        'zy': rng.uniform(ranges['zoom_range'][0], ranges['zoom_range'][1], size=n),
+        'flip': (rng.rand(n) < 0.5) & ranges['horizontal_flip'],
+        'brightness': rng.uniform(ranges['brightness_range'][0], ranges['brightness_range'][1], size=n),
+    }
+
+def augmentation_matrices(params, img_shape):
+    """Composes ratio resize, zoom, rotation, flip and shift about the image center into one
+    forward 2x3 affine matrix per image"""
+    theta = np.deg2rad(params['theta'])
+    cos, sin = np.cos(theta), np.sin(theta)
+    # A zoom factor above 1 shows a larger field of view, as in ImageDataGenerator
+    kx = params['ratio_x'] / params['zx']
+    ky = params['ratio_y'] / params['zy']
+    f = np.where(params['flip'], -1., 1.)
+
+    a00, a01 = f * cos * kx, -f * sin * ky
+    a10, a11 = sin * kx, cos * ky
+    cx, cy = (img_shape[1] - 1) / 2., (img_shape[0] - 1) / 2.
+
+    matrices = np.empty((len(theta), 2, 3))
+    matrices[:, 0] = np.stack([a00, a01, cx - a00 * cx - a01 * cy + params['tx']], axis=-1)
+    matrices[:, 1] = np.stack([a10, a11, cy - a10 * cx - a11 * cy + params['ty']], axis=-1)
+    return matrices
+
+def augment_batch(images, rng=np.random, ranges=AUGMENTATION_RANGES):
+    'Augments a (N, H, W, C) batch with a single affine warp and brightness scale per image'
+    img_shape = images.shape[1:3]
+    params = sample_augmentation_params(len(images), img_shape, rng=rng, ranges=ranges)
+    matrices = augmentation_matrices(params, img_shape)
+
+    out = np.empty_like(images)
+    for i in range(len(images)):
+        warped = cv2.warpAffine(images[i], matrices[i], (img_shape[1], img_shape[0]), flags=cv2.INTER_LINEAR,
+                                borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        out[i] = warped.reshape(out[i].shape)
+
+    brightness = params['brightness'].reshape(-1, 1, 1, 1)
+    if np.issubdtype(images.dtype, np.integer):
+        out = np.clip(out * brightness, 0, np.iinfo(images.dtype).max).astype(images.dtype)
+    else:
+        out = (out * brightness).astype(images.dtype)
+    return out
+
+def apply_augmentation(img, rng=np.random):
+    return augment_batch(np.expand_dims(img, axis=0), rng=rng)[0]
+
+
+# Stored in the .index.npz stamp, bumped when parsing changes so older caches are rebuilt
+LABEL_INDEX_VERSION = 2
+
 
 def _process_csv_file(file):
     with open(file, 'r') as fr:
@@ -85,6 +181,106 @@ def _process_csv_file(file):
     return files
 
 
+class LabelIndex:
+    """Parsed labels file stored as arrays
+
+    Each line of a labels file is `<patient id> <filename> <label> [<source>]`. Labels and
+    sources are stored as small integer codes into the `labels`/`sources` vocabularies,
+    so selecting the rows of a class or looking up a sample is an array operation.
+    """
+    def __init__(self, patient_ids, filenames, label_codes, labels, source_codes, sources):
+        self.patient_ids = patient_ids
+        self.filenames = filenames
+        self.label_codes = label_codes
+        self.labels = list(labels)
+        self.source_codes = source_codes
+        self.sources = list(sources)
+
+    @classmethod
+    def from_lines(cls, lines):
+        rows = [l.split() for l in lines if l.strip()]
+        # Some sirm patient ids contain a space (e.g. `COVID 70 COVID(70).png COVID-19 sirm`)
+        rows = [[' '.join(r[:-3])] + r[-3:] if len(r) > 4 else r for r in rows]
+        labels, label_codes = np.unique([r[2] for r in rows], return_inverse=True)
+        sources, source_codes = np.unique([r[3] if len(r) > 3 else '' for r in rows], return_inverse=True)
+        return cls(
+            np.array([r[0] for r in rows]),
+            np.array([r[1] for r in rows]),
+            label_codes.astype('int16'),
+            labels.tolist(),
+            source_codes.astype('int16'),
+            sources.tolist(),
+        )
+
+    @classmethod
+    def load(cls, labels_file, cache=True):
+        """Parses labels_file, reusing <labels_file>.index.npz if it is newer than the labels"""
+        cache_file = labels_file + '.index.npz'
+        st = os.stat(labels_file)
+        stamp = np.array([st.st_mtime, st.st_size, LABEL_INDEX_VERSION])
+        if cache and os.path.exists(cache_file):
+            try:
+                with np.load(cache_file) as f:
+                    if np.array_equal(f['stamp'], stamp):
+                        return cls(f['patient_ids'], f['filenames'], f['label_codes'], f['labels'].tolist(),
+                                   f['source_codes'], f['sources'].tolist())
+            except Exception:
+                # A corrupt or incomplete cache is rebuilt below
+                pass
+
+        index = cls.from_lines(_process_csv_file(labels_file))
+        if cache:
+            # Written under a per-process name and renamed into place, so concurrent loads
+            # (e.g. the --dp_workers processes) never read a partial file
+            tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+            try:
+                with open(tmp_file, 'wb') as f:
+                    np.savez_compressed(f, stamp=stamp, patient_ids=index.patient_ids,
+                                        filenames=index.filenames, label_codes=index.label_codes,
+                                        labels=np.array(index.labels), source_codes=index.source_codes,
+                                        sources=np.array(index.sources))
+                os.replace(tmp_file, cache_file)
+            except OSError:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+        return index
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def rows_of(self, label):
+        'Row indices of all samples with the given label'
+        if label not in self.labels:
+            return np.zeros(0, dtype='int64')
+        return np.flatnonzero(self.label_codes == self.labels.index(label))
+
+    def targets(self, mapping):
+        'Class index of every row according to mapping, -1 for labels not in mapping'
+        codes = np.array([mapping.get(label, -1) for label in self.labels], dtype='int64')
+        return codes[self.label_codes]
+
+
+def balance_buckets(index, mapping, n_classes=2, is_severity_model=False):
+    'Row indices of the non-covid and covid samples of a LabelIndex, in that order'
+    datasets = {key: index.rows_of(key) for key in mapping.keys()}
+
+    if is_severity_model:
+        return [
+            datasets['level2'], datasets['level1']
+        ]
+    elif n_classes == 2:
+        return [
+            datasets['negative'], datasets['positive']
+        ]
+    elif n_classes == 3:
+        return [
+            np.concatenate([datasets['normal'], datasets['pneumonia']]),
+            datasets['COVID-19'],
+        ]
+    else:
+        raise Exception('Only binary or 3 class classification currently supported.')
+
+
 class BalanceCovidDataset(keras.utils.Sequence):
     'Generates data for Keras'
 
@@ -103,19 +299,26 @@ class BalanceCovidDataset(keras.utils.Sequence):
                 'positive': 1,
             },
             shuffle=True,
-            augmentation=apply_augmentation,
+            augmentation=augment_batch,
             covid_percent=0.5,
             class_weights=[1., 1.],
             top_percent=0.08,
             is_severity_model=False,
             is_medusa_backbone=False,
+            seed=None,
+            image_cache=None,
+            num_shards=1,
+            shard_index=0,
+            normalize=True,
+            profiler=None,
+            covid_size=None,
     ):
         'Initialization'
         self.datadir = data_dir
-        self.dataset = _process_csv_file(csv_file)
+        self.index = LabelIndex.load(csv_file)
         self.is_training = is_training
         self.batch_size = batch_size
-        self.N = len(self.dataset)
+        self.N = len(self.index)
         self.medusa_input_shape = medusa_input_shape
         self.input_shape = input_shape
         self.n_classes = n_classes
@@ -123,48 +326,54 @@ class BalanceCovidDataset(keras.utils.Sequence):
         self.mapping = mapping
         self.shuffle = shuffle
         self.covid_percent = covid_percent
+        # Fixed number of covid samples per batch, used by data-parallel workers to split the
+        # covid samples of a global batch exactly; by default it follows covid_percent
+        self.covid_size = covid_size
         self.class_weights = class_weights
         self.n = 0
+        # Called as augmentation(batch, rng=...) on the uint8 (N, H, W, C) batch, None to disable
         self.augmentation = augmentation
         self.top_percent = top_percent
         self.is_severity_model = is_severity_model
         self.is_medusa_backbone = is_medusa_backbone
-
-        # If using MEDUSA backbone load images without crop
-        if self.is_medusa_backbone:
-            self.load_image = partial(process_image_file, top_percent=0, crop=False)
-        else:
-            self.load_image = process_image_file
-
-        datasets = {}
-        for key in self.mapping.keys():
-            datasets[key] = []
-
-        for l in self.dataset:
-            datasets[l.split()[2]].append(l)
-        
-        if self.is_severity_model:
-            self.datasets = [
-                datasets['level2'], datasets['level1']
-            ]
-        elif self.n_classes == 2:
-            self.datasets = [
-                datasets['negative'], datasets['positive']
-            ]
-        elif self.n_classes == 3:
-            self.datasets = [
-                datasets['normal'] + datasets['pneumonia'],
-                datasets['COVID-19'],
-            ]
-        else:
-            raise Exception('Only binary or 3 class classification currently supported.')
+        # All sampling (shuffling, covid upsampling, augmentation seeds) goes through this RNG
+        self.rng = np.random.RandomState(seed)
+        # Optional image_cache.ImageCache holding images already cropped/resized like load_image
+        self.image_cache = image_cache
+        # With normalize=False batches are returned as uint8, for graphs that normalize on-graph
+        self.normalize = normalize
+        # Optional instrumentation.TrainingProfiler recording the time spent in load_batch
+        self.profiler = profiler
+
+        # MEDUSA backbone images are loaded without crop by process_image_file_dual
+        self.load_image = process_image_file
+
+        # Class index of each row of the labels file, the datasets below hold row indices
+        self.targets = self.index.targets(self.mapping)
+        self.datasets = balance_buckets(self.index, self.mapping, self.n_classes, self.is_severity_model)
+        # For data-parallel training each worker iterates over its own shard of the
+        # non-covid samples, covid samples are still drawn from the whole split
+        self.datasets[0] = self.datasets[0][shard_index::num_shards]
         print(len(self.datasets[0]), len(self.datasets[1]))
 
         self.on_epoch_end()
 
     def __next__(self):
         # Get one batch of data
-        model_inputs = self.__getitem__(self.n)
+        return self.load_batch(*self.next_batch_plan())
+
+    def __len__(self):
+        return int(np.ceil(len(self.datasets[0]) / float(self.batch_size)))
+
+    def on_epoch_end(self):
+        'Updates indexes after each epoch'
+        if self.shuffle == True:
+            for v in self.datasets:
+                self.rng.shuffle(v)
+
+    def next_batch_plan(self):
+        'Samples the next batch plan and advances the batch index'
+        plan = self.batch_plan(self.n)
         # Batch index
         self.n += 1
 
@@ -173,66 +382,97 @@ class BalanceCovidDataset(keras.utils.Sequence):
             self.on_epoch_end()
             self.n = 0
 
-        return model_inputs
+        return plan
 
-    def __len__(self):
-        return int(np.ceil(len(self.datasets[0]) / float(self.batch_size)))
+    def get_state(self):
+        'Sampling state (batch index, shuffled orders and RNG), see training_state.py'
+        return {'n': self.n, 'datasets': [v.copy() for v in self.datasets], 'rng': self.rng.get_state(), 'pending': []}
 
-    def on_epoch_end(self):
-        'Updates indexes after each epoch'
-        if self.shuffle == True:
-            for v in self.datasets:
-                np.random.shuffle(v)
+    def set_state(self, state):
+        if state['pending']:
+            raise ValueError('The state has prefetched batch plans, restore it into a PrefetchGenerator')
+        if [len(v) for v in state['datasets']] != [len(v) for v in self.datasets]:
+            raise ValueError('The state does not match the labels file')
+        self.n = state['n']
+        self.datasets = [np.array(v) for v in state['datasets']]
+        self.rng.set_state(state['rng'])
+
+    def batch_plan(self, idx):
+        'Selects the label file rows and augmentation seed of a batch'
+        batch_rows = self.datasets[0][idx * self.batch_size:(idx + 1) * self.batch_size].copy()
+
+        # upsample covid cases
+        if self.covid_size is None:
+            covid_size = max(int(len(batch_rows) * self.covid_percent), 1)
+        else:
+            covid_size = min(self.covid_size, len(batch_rows))
+        covid_inds = self.rng.choice(len(batch_rows),
+                                     size=covid_size,
+                                     replace=False)
+        covid_rows = self.rng.choice(len(self.datasets[1]),
+                                     size=covid_size,
+                                     replace=False)
+        batch_rows[covid_inds] = self.datasets[1][covid_rows]
+
+        seed = self.rng.randint(np.iinfo(np.int32).max)
+        return batch_rows, seed
 
     def __getitem__(self, idx):
-        batch_x = np.zeros((self.batch_size, *self.input_shape, self.num_channels))
+        return self.load_batch(*self.batch_plan(idx))
+
+    def load_batch(self, batch_rows, seed):
+        'Decodes, augments and stacks the samples of a batch plan'
+        if self.profiler is None:
+            return self._load_batch(batch_rows, seed)
+        start = time.time()
+        batch = self._load_batch(batch_rows, seed)
+        self.profiler.record('batch_assembly', time.time() - start, start)
+        return batch
+
+    def _load_batch(self, batch_rows, seed):
+        batch_img = np.zeros((self.batch_size, *self.input_shape, self.num_channels), dtype='uint8')
         batch_y = np.zeros(self.batch_size)
 
         if self.is_medusa_backbone:
-            batch_sem_x = np.zeros((self.batch_size, *self.medusa_input_shape, 1))
-
-        batch_files = self.datasets[0][idx * self.batch_size:(idx + 1) * self.batch_size]
+            batch_sem_x = np.zeros((self.batch_size, *self.medusa_input_shape, 1), dtype='float32')
 
-        # upsample covid cases
-        covid_size = max(int(len(batch_files) * self.covid_percent), 1)
-        covid_inds = np.random.choice(np.arange(len(batch_files)),
-                                      size=covid_size,
-                                      replace=False)
-        covid_files = np.random.choice(self.datasets[1],
-                                       size=covid_size,
-                                       replace=False)
-        for i in range(covid_size):
-            batch_files[covid_inds[i]] = covid_files[i]
-
-        for i in range(len(batch_files)):
-            sample = batch_files[i].split()
-
-            if self.is_training:
-                folder = 'train'
+        if self.is_training:
+            folder = 'train'
+        else:
+            folder = 'test'
+
+        for i, row in enumerate(batch_rows):
+            filename = self.index.filenames[row]
+            image_file = os.path.join(self.datadir, folder, filename)
+            sem_x = None
+            if self.image_cache is not None and filename in self.image_cache:
+                x = self.image_cache.get(filename)
+            elif self.is_medusa_backbone:
+                # Decode once and derive both the COVID-Net and MEDUSA inputs
+                x, sem_x = process_image_file_dual(
+                    image_file, self.input_shape[0], self.medusa_input_shape[0])
             else:
-                folder = 'test'
-
-            image_file = os.path.join(self.datadir, folder, sample[1])
-            x = self.load_image(
-                image_file,
-                self.input_shape[0],
-                top_percent=self.top_percent,
-            )
-
-            if self.is_training and hasattr(self, 'augmentation'):
-                x = self.augmentation(x)
-
-            x = x.astype('float32') / 255.0
+                x = self.load_image(
+                    image_file,
+                    self.input_shape[0],
+                    top_percent=self.top_percent,
+                )
 
             if self.is_medusa_backbone:
-                sem_x = process_image_file_medusa(image_file, self.medusa_input_shape[0])
+                if sem_x is None:
+                    sem_x = process_image_file_medusa(image_file, self.medusa_input_shape[0])
                 batch_sem_x[i] = sem_x
             
-            y = self.mapping[sample[2]]
+            y = self.targets[row]
 
-            batch_x[i] = x
+            batch_img[i] = x
             batch_y[i] = y
 
+        if self.is_training and self.augmentation is not None:
+            n = len(batch_rows)
+            batch_img[:n] = self.augmentation(batch_img[:n], rng=np.random.RandomState(seed))
+        batch_x = batch_img.astype('float32') / 255.0 if self.normalize else batch_img
+
         class_weights = self.class_weights
         weights = np.take(class_weights, batch_y.astype('int64'))
         batch_y = keras.utils.to_categorical(batch_y, num_classes=self.n_classes)
@@ -241,4 +481,56 @@ class BalanceCovidDataset(keras.utils.Sequence):
             return batch_sem_x, batch_x, batch_y, weights, self.is_training
         else:
             return batch_x, batch_y, weights, self.is_training
-        
\ No newline at end of file
+        
+
+class PrefetchGenerator:
+    'Overlaps batch decoding and augmentation with training'
+
+    def __init__(self, dataset, num_workers=4, max_prefetch=8):
+        # Batch plans are sampled here on the calling thread, in order, so the sequence of
+        # batches is identical to iterating the dataset directly; only loading is parallel
+        self.dataset = dataset
+        self.max_prefetch = max(max_prefetch, 1)
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        # (plan, future) of the batches sampled from dataset but not returned yet
+        self.pending = deque()
+        for _ in range(self.max_prefetch):
+            self._submit()
+
+    def _submit(self, plan=None):
+        if plan is None:
+            plan = self.dataset.next_batch_plan()
+        self.pending.append((plan, self.executor.submit(self.dataset.load_batch, *plan)))
+
+    def get_state(self):
+        'The dataset state and the plans of the batches prefetched but not returned yet'
+        state = self.dataset.get_state()
+        state['pending'] = [plan for plan, _ in self.pending]
+        return state
+
+    def set_state(self, state):
+        for _, future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.dataset.set_state(dict(state, pending=[]))
+        for plan in state['pending']:
+            self._submit(plan)
+        while len(self.pending) < self.max_prefetch:
+            self._submit()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        _, future = self.pending.popleft()
+        self._submit()
+        return future.result()
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def close(self):
+        for _, future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=True)
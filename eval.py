@@ -1,12 +1,20 @@
-from sklearn.metrics import confusion_matrix
 import numpy as np
 import tensorflow as tf
-import os, argparse
+import os, argparse, time
+import multiprocessing
+from queue import Empty
 
 from data import (
+    LabelIndex,
+    pad_batch,
     process_image_file, 
-    process_image_file_medusa,
+    process_image_file_dual,
+    read_image,
 )
+from export_graph import TFLiteSession
+from metrics import StreamingMetrics
+from precision import PRECISIONS, load_model, print_metric_deltas
+from tta import average_views, select_views, tta_views, tta_views_dual
 
 # To remove TF Warnings
 tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
@@ -14,15 +22,116 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
 
 def print_metrics(y_test, pred, mapping):
-    matrix = confusion_matrix(y_test, pred)
-    matrix = matrix.astype('float')
-    print(matrix)
+    metrics = StreamingMetrics(len(mapping))
+    metrics.update(y_test, pred)
+    return metrics.report(mapping)
 
-    class_acc = [matrix[i,i]/np.sum(matrix[i,:]) if np.sum(matrix[i,:]) else 0 for i in range(len(matrix))]
-    ppvs = [matrix[i,i]/np.sum(matrix[:,i]) if np.sum(matrix[:,i]) else 0 for i in range(len(matrix))]
 
-    print('Sens', ', '.join('{}: {:.3f}'.format(cls.capitalize(), class_acc[i]) for cls, i in mapping.items()))
-    print('PPV', ', '.join('{}: {:.3f}'.format(cls.capitalize(), ppvs[i]) for cls, i in mapping.items()))
+def eval_targets(testfile, mapping):
+    'Class index of every row of a LabelIndex, raises ValueError for labels not in mapping'
+    y_test = testfile.targets(mapping)
+    if (y_test < 0).any():
+        unknown = sorted(set(testfile.labels[code] for code in testfile.label_codes[y_test < 0]))
+        raise ValueError('The labels file has labels not in the class mapping {}: {}'.format(
+            ', '.join(mapping), ', '.join(unknown)))
+    return y_test
+
+
+def preprocess_views(image_file, input_size, is_medusa_backbone=False, medusa_input_size=256, tta=1):
+    'Returns the (tta, ...) views of an image and of its MEDUSA input (None for other models)'
+    if tta > 1:
+        img = read_image(image_file)
+        if is_medusa_backbone:
+            return tta_views_dual(img, input_size, medusa_input_size, tta)
+        return tta_views(img, input_size, tta, top_percent=0.08), None
+    if is_medusa_backbone:
+        x, medusa_x = process_image_file_dual(image_file, input_size, medusa_input_size)
+        return x[None], medusa_x[None]
+    return process_image_file(image_file, input_size, top_percent=0.08)[None], None
+
+
+def load_batch(filenames, testfolder, input_size, is_medusa_backbone=False, medusa_input_size=256,
+               input_dtype='float32', tta=1):
+    """Preprocesses the images of filenames, returns (batch_x, batch_medusa_x, loaded, failures)
+
+    Images that cannot be read or preprocessed are left out of the batch and returned in
+    failures as (filename, error) rather than failing the evaluation. loaded holds the
+    indices into filenames of the images in the batch. With tta > 1, each image takes tta
+    consecutive rows of the batch, one per test-time augmentation view.
+    """
+    batch_x = np.zeros((len(filenames) * tta, input_size, input_size, 3), dtype=input_dtype)
+    batch_medusa_x = None
+    if is_medusa_backbone:
+        batch_medusa_x = np.zeros((len(filenames) * tta, medusa_input_size, medusa_input_size, 1), dtype='float32')
+
+    loaded, failures = [], []
+    for i, filename in enumerate(filenames):
+        image_file = os.path.join(testfolder, filename)
+        try:
+            x, medusa_x = preprocess_views(image_file, input_size, is_medusa_backbone, medusa_input_size, tta)
+        except Exception as e:
+            failures.append((filename, str(e)))
+            continue
+
+        rows = slice(len(loaded) * tta, (len(loaded) + 1) * tta)
+        batch_x[rows] = x if input_dtype == 'uint8' else x.astype('float32') / 255.0
+        if is_medusa_backbone:
+            batch_medusa_x[rows] = medusa_x
+        loaded.append(i)
+
+    n = len(loaded) * tta
+    return batch_x[:n], None if batch_medusa_x is None else batch_medusa_x[:n], loaded, failures
+
+
+def predict_batches(
+    sess,
+    filenames,
+    testfolder,
+    input_tensor,
+    output_tensor,
+    input_size,
+    is_medusa_backbone=False,
+    medusa_input_tensor="input_1:0",
+    medusa_input_size=256,
+    batch_size=8,
+    input_dtype='float32',
+    tta=1,
+):
+    """Yields (end, rows, outputs, failures) for each batch of filenames
+
+    end is the number of filenames processed so far, rows the indices into filenames of the
+    images outputs were computed for, and failures the (filename, error) of the others.
+    With tta > 1, the views of all images of a batch go through one sess.run of
+    batch_size * tta inputs and outputs are their averaged softmax.
+    """
+    for start in range(0, len(filenames), batch_size):
+        batch_x, batch_medusa_x, loaded, failures = load_batch(
+            filenames[start:start + batch_size], testfolder, input_size, is_medusa_backbone=is_medusa_backbone,
+            medusa_input_size=medusa_input_size, input_dtype=input_dtype, tta=tta)
+        end = min(start + batch_size, len(filenames))
+        if not loaded:
+            yield end, np.zeros(0, dtype='int64'), None, failures
+            continue
+
+        # Pad the ragged final batch so every sess.run sees the same batch shape
+        feed_dict = {input_tensor: pad_batch(batch_x, batch_size * tta)}
+        if is_medusa_backbone:
+            feed_dict[medusa_input_tensor] = pad_batch(batch_medusa_x, batch_size * tta)
+
+        outputs = np.array(sess.run(output_tensor, feed_dict=feed_dict))[:len(loaded) * tta]
+        if tta > 1:
+            outputs = average_views(outputs, tta)
+        yield end, start + np.array(loaded), outputs, failures
+
+
+def print_failures(failures, max_shown=10):
+    if not failures:
+        return
+    print('Skipped {} images that could not be evaluated:'.format(len(failures)))
+    for filename, error in failures[:max_shown]:
+        print('    {}: {}'.format(filename, error))
+    if len(failures) > max_shown:
+        print('    ...')
 
 
 def eval(
@@ -37,35 +146,157 @@ def eval(
     is_medusa_backbone=False,
     medusa_input_tensor="input_1:0",
     medusa_input_size=256, 
+    batch_size=8,
+    input_dtype='float32',
+    metrics=None,
+    report_every=0,
+    tta=1,
 ):
-    y_test = []
-    pred = []
+    """Prints metrics on testfile and returns (sensitivities, ppvs, images/sec)
 
-    for i in range(len(testfile)):
-        line = testfile[i].split()
-        image_file = os.path.join(testfolder, line[1])
+    With input_dtype='uint8', input_tensor takes unnormalized uint8 images (see precision.py).
+    Predictions are added to metrics (a new metrics.StreamingMetrics by default) as they
+    come, and running metrics are printed every report_every images if it is set. Images
+    that cannot be read are skipped and listed after the metrics. tta > 1 averages the
+    predictions of that many test-time augmentation views of each image (see tta.py).
+    """
+    # testfile is a data.LabelIndex, or the lines of a labels file
+    if not isinstance(testfile, LabelIndex):
+        testfile = LabelIndex.from_lines(testfile)
+    y_test = eval_targets(testfile, mapping)
+    if metrics is None:
+        metrics = StreamingMetrics(len(mapping))
 
-        y_test.append(mapping[line[2]])
+    failures = []
+    start = 0
+    start_time = time.time()
+    for end, rows, outputs, batch_failures in predict_batches(
+            sess, testfile.filenames, testfolder, input_tensor, output_tensor, input_size,
+            is_medusa_backbone=is_medusa_backbone, medusa_input_tensor=medusa_input_tensor,
+            medusa_input_size=medusa_input_size, batch_size=batch_size, input_dtype=input_dtype, tta=tta):
+        failures.extend(batch_failures)
+        if len(rows):
+            metrics.update(y_test[rows], outputs)
 
-        if is_medusa_backbone:
-            x = process_image_file(image_file, input_size, top_percent=0, crop=False)
-            x = x.astype('float32') / 255.0
-            medusa_x = process_image_file_medusa(image_file, medusa_input_size)
-            feed_dict = {
-                medusa_input_tensor: np.expand_dims(medusa_x, axis=0),
-                input_tensor: np.expand_dims(x, axis=0),
-            }
-        else:
-            x = process_image_file(image_file, input_size, top_percent=0.08)
-            x = x.astype('float32') / 255.0
-            feed_dict = {input_tensor: np.expand_dims(x, axis=0)}
-        
-        pred.append(np.array(sess.run(output_tensor, feed_dict=feed_dict)).argmax(axis=1))
-    
-    y_test = np.array(y_test)
-    pred = np.array(pred)
-
-    print_metrics(y_test, pred, mapping)
+        if report_every and end < len(testfile) and end // report_every > start // report_every:
+            print('After {} of {} images:'.format(end, len(testfile)))
+            metrics.report(mapping)
+        start = end
+    elapsed = time.time() - start_time
+
+    class_acc, ppvs = metrics.report(mapping)
+    print_failures(failures)
+    num_scored = len(testfile) - len(failures)
+    throughput = num_scored / elapsed if elapsed else 0.
+    print('Throughput: {:.2f} images/sec ({} images, batch size {}{})'.format(
+        throughput, num_scored, batch_size, ', {} views'.format(tta) if tta > 1 else ''))
+    return class_acc, ppvs, throughput
+
+
+def open_model(args, uint8_input, precision, tflite=None, num_threads=None):
+    """Loads the model described by the eval.py arguments, returns (graph, sess, input tensor
+    name, input dtype). num_threads limits the threads of the session."""
+    if tflite:
+        return None, TFLiteSession(tflite, num_threads=num_threads), args.in_tensorname, 'float32'
+    config = tf.ConfigProto(intra_op_parallelism_threads=num_threads) if num_threads else None
+    graph, sess, in_tensorname = load_model(args.weightspath, args.metaname, args.ckptname,
+                                            args.in_tensorname, args.input_size, uint8=uint8_input,
+                                            precision=precision, frozen_graph=args.frozen_graph, config=config)
+    return graph, sess, in_tensorname, 'uint8' if uint8_input else 'float32'
+
+
+def _eval_shard(shard, args, uint8_input, precision, tflite, tta, filenames, targets, n_classes, num_threads,
+                queue):
+    # Runs in a worker process, sends progress, then the shard's metrics or its error
+    try:
+        graph, sess, in_tensorname, input_dtype = open_model(args, uint8_input, precision, tflite, num_threads)
+        metrics = StreamingMetrics(n_classes, auc_bins=args.auc_bins, calibration_bins=args.calibration_bins)
+        failures = []
+        for end, rows, outputs, batch_failures in predict_batches(
+                sess, filenames, args.testfolder, in_tensorname, args.out_tensorname, args.input_size,
+                is_medusa_backbone=args.is_medusa_backbone, medusa_input_tensor=args.in_tensorname_medusa,
+                medusa_input_size=args.input_size_medusa, batch_size=args.batch_size, input_dtype=input_dtype,
+                tta=tta):
+            failures.extend(batch_failures)
+            if len(rows):
+                metrics.update(targets[rows], outputs)
+            queue.put(('progress', shard, end, len(failures)))
+        sess.close()
+        queue.put(('done', shard, metrics, failures))
+    except Exception as e:
+        queue.put(('error', shard, repr(e)))
+
+
+def eval_sharded(args, testfile, mapping, num_shards, uint8_input=False, precision='float32', tflite=None,
+                 tta=1, progress_interval=10.):
+    """Evaluates testfile split into num_shards contiguous shards, each in its own process
+
+    Every worker loads the model once and runs batched inference over its shard. Per-shard
+    progress is printed every progress_interval seconds, and the shard metrics are merged
+    into one report. Unreadable images are skipped. A shard whose worker fails does not
+    stop the others, but after the report of the completed shards RuntimeError is raised,
+    as the metrics do not cover the whole test file. Returns (sensitivities, ppvs, images/sec).
+    """
+    # Workers are spawned rather than forked, TensorFlow does not survive a fork
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    y_test = eval_targets(testfile, mapping)
+    shards = np.array_split(np.arange(len(testfile)), num_shards)
+    num_threads = max(1, (os.cpu_count() or 1) // num_shards)
+
+    start_time = time.time()
+    procs = []
+    for shard, rows in enumerate(shards):
+        proc = ctx.Process(target=_eval_shard, args=(
+            shard, args, uint8_input, precision, tflite, tta, testfile.filenames[rows], y_test[rows], len(mapping),
+            num_threads, queue))
+        proc.start()
+        procs.append(proc)
+
+    metrics = StreamingMetrics(len(mapping), auc_bins=args.auc_bins, calibration_bins=args.calibration_bins)
+    progress = [(0, 0)] * num_shards
+    results, errors = {}, {}
+    last_print = time.time()
+    while len(results) + len(errors) < num_shards:
+        try:
+            message = queue.get(timeout=1.)
+        except Empty:
+            message = None
+        if message is not None:
+            kind, shard = message[:2]
+            if kind == 'progress':
+                progress[shard] = message[2:]
+            elif kind == 'done':
+                results[shard] = message[2:]
+            else:
+                errors[shard] = message[2]
+        for shard, proc in enumerate(procs):
+            # A worker killed by a crash in native code exits without sending anything
+            if shard not in results and shard not in errors and proc.exitcode not in (None, 0):
+                errors[shard] = 'worker exited with code {}'.format(proc.exitcode)
+        if time.time() - last_print >= progress_interval:
+            last_print = time.time()
+            print(', '.join('shard {}: {}/{}'.format(shard, done, len(rows))
+                            for shard, ((done, _), rows) in enumerate(zip(progress, shards))))
+    for proc in procs:
+        proc.join()
+    elapsed = time.time() - start_time
+
+    failures = []
+    for shard in sorted(results):
+        shard_metrics, shard_failures = results[shard]
+        metrics.merge(shard_metrics)
+        failures.extend(shard_failures)
+    class_acc, ppvs = metrics.report(mapping)
+    print_failures(failures)
+    for shard in sorted(errors):
+        print('Shard {} ({} images) failed: {}'.format(shard, len(shards[shard]), errors[shard]))
+    throughput = len(metrics) / elapsed if elapsed else 0.
+    print('Throughput: {:.2f} images/sec ({} images, {} shards, batch size {})'.format(
+        throughput, len(metrics), num_shards, args.batch_size))
+    if errors:
+        raise RuntimeError('{} of {} shards failed, the metrics above are incomplete'.format(len(errors), num_shards))
+    return class_acc, ppvs, throughput
 
 
 if __name__ == '__main__':
@@ -87,18 +318,39 @@ if __name__ == '__main__':
     parser.add_argument('--is_severity_model', action='store_true', help='Add flag if training COVIDNet CXR-S model')
     parser.add_argument('--is_medusa_backbone', action='store_true', 
                     help='Add flag if training COVIDNet CXR-3 model, do not include for other versions')
+    parser.add_argument('--batch_size', default=8, type=int, help='Number of test images per sess.run, defaults to 8')
+    parser.add_argument('--frozen_graph', default=None, type=str,
+                    help='Path to a graph written by export_graph.py, used instead of the meta/ckpt files')
+    parser.add_argument('--uint8_input', action='store_true',
+                    help='Feed uint8 images and normalize them on-graph instead of feeding float32 images')
+    parser.add_argument('--precision', default='float32', choices=PRECISIONS,
+                    help='Compute precision, float16 applies to GPU ops and bfloat16 needs a TF build that supports it')
+    parser.add_argument('--tflite', default=None, type=str,
+                    help='Path to an int8 model written by quantize.py, used instead of the meta/ckpt files')
+    parser.add_argument('--compare_precision', action='store_true',
+                    help='Also evaluate the float32 baseline and report per-class deltas of the reduced precision or int8 run')
+    parser.add_argument('--report_every', default=0, type=int, help='Print running metrics every N images')
+    parser.add_argument('--tta', default=1, type=int,
+                    help='Average the predictions of this many test-time augmentation views (1 to 8, 1 disables it)')
+    parser.add_argument('--compare_tta', action='store_true',
+                    help='Also evaluate without test-time augmentation and report the per-class deltas and throughput cost')
+    parser.add_argument('--num_shards', default=1, type=int,
+                    help='Split the test file across this many worker processes, each loading the model once')
+    parser.add_argument('--auc_bins', default=0, type=int,
+                    help='Also report per-class one-vs-rest AUC, from score histograms with this many bins')
+    parser.add_argument('--calibration_bins', default=0, type=int,
+                    help='Also report the expected calibration error over this many confidence bins')
 
     args = parser.parse_args()
+    # Checked up front, per image it would only make every image fail to load
+    try:
+        select_views(args.tta, args.is_medusa_backbone)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.report_every and args.num_shards > 1:
+        parser.error('--report_every is not supported with --num_shards, shards print their progress instead')
 
-    sess = tf.Session()
-    tf.get_default_graph()
-    saver = tf.train.import_meta_graph(os.path.join(args.weightspath, args.metaname))
-    saver.restore(sess, os.path.join(args.weightspath, args.ckptname))
-
-    graph = tf.get_default_graph()
-
-    file = open(args.testfile, 'r')
-    testfile = file.readlines()
+    testfile = LabelIndex.load(args.testfile)
 
     if args.is_severity_model:
         # For COVIDNet CXR-S training with COVIDxSev level 1 and level 2 air space seveirty grading
@@ -123,16 +375,49 @@ if __name__ == '__main__':
         raise Exception('''COVID-Net currently only supports 2 class COVID-19 positive/negative detection
             or 3 class detection of no pneumonia/non-COVID-19 pneumonia/COVID-19 pneumonia''')
 
-    eval(
-        sess, 
-        graph, 
-        testfile, 
-        args.testfolder,
-        args.in_tensorname, 
-        args.out_tensorname,
-        args.input_size, 
-        mapping,
-        is_medusa_backbone=args.is_medusa_backbone,
-        medusa_input_tensor=args.in_tensorname_medusa,
-        medusa_input_size=args.input_size_medusa,
-    )
+    def run_eval(uint8_input, precision, tflite=None, tta=1):
+        if args.num_shards > 1:
+            return eval_sharded(args, testfile, mapping, args.num_shards, uint8_input=uint8_input,
+                                precision=precision, tflite=tflite, tta=tta)
+
+        graph, sess, in_tensorname, input_dtype = open_model(args, uint8_input, precision, tflite)
+        result = eval(
+            sess, 
+            graph, 
+            testfile, 
+            args.testfolder,
+            in_tensorname, 
+            args.out_tensorname,
+            args.input_size, 
+            mapping,
+            is_medusa_backbone=args.is_medusa_backbone,
+            medusa_input_tensor=args.in_tensorname_medusa,
+            medusa_input_size=args.input_size_medusa,
+            batch_size=args.batch_size,
+            input_dtype=input_dtype,
+            metrics=StreamingMetrics(len(mapping), auc_bins=args.auc_bins, calibration_bins=args.calibration_bins),
+            report_every=args.report_every,
+            tta=tta,
+        )
+        sess.close()
+        return result
+
+    if args.compare_precision:
+        reduced_name = 'int8' if args.tflite else '{}{}'.format(args.precision, '/uint8' if args.uint8_input else '')
+        print('Baseline (float32):')
+        baseline = run_eval(False, 'float32', tta=args.tta)
+        print('Reduced ({}):'.format(reduced_name))
+        reduced = run_eval(args.uint8_input, args.precision, args.tflite, tta=args.tta)
+        print_metric_deltas(mapping, baseline, reduced, names=('float32', reduced_name))
+    elif args.compare_tta:
+        tta_name = 'tta{}'.format(args.tta)
+        print('Single view:')
+        baseline = run_eval(args.uint8_input, args.precision, args.tflite)
+        print('Test-time augmentation ({} views):'.format(args.tta))
+        augmented = run_eval(args.uint8_input, args.precision, args.tflite, tta=args.tta)
+        print_metric_deltas(mapping, baseline, augmented, names=('single', tta_name))
+        if baseline[2] and augmented[2]:
+            print('Latency: {:.1f} -> {:.1f} ms/image ({:.2f}x)'.format(
+                1000. / baseline[2], 1000. / augmented[2], baseline[2] / augmented[2]))
+    else:
+        run_eval(args.uint8_input, args.precision, args.tflite, tta=args.tta)
@@ -1,26 +1,31 @@
 from sklearn.metrics import confusion_matrix
 import numpy as np
 import tensorflow as tf
-import os, argparse
+import os, argparse, time
 import cv2
 
-from data import process_image_file
+from data import pad_batch, process_image_file
 
 #Combine the COVID and non-COVID pneumonia cases
 mapping = {'normal': 0, 'pneumonia': 1, 'COVID-19': 1}
 
-def eval(sess, graph, testfile, testfolder, input_tensor, output_tensor, input_size):
+def eval(sess, graph, testfile, testfolder, input_tensor, output_tensor, input_size, batch_size=8):
     image_tensor = graph.get_tensor_by_name(input_tensor)
     pred_tensor = graph.get_tensor_by_name(output_tensor)
 
     y_test = []
     pred = []
-    for i in range(len(testfile)):
-        line = testfile[i].split()
-        x = process_image_file(os.path.join(testfolder, line[1]), input_size, top_percent=0.08)
-        x = x.astype('float32') / 255.0
-        y_test.append(mapping[line[2]])
-        pred.append(np.array(sess.run(pred_tensor, feed_dict={image_tensor: np.expand_dims(x, axis=0)})).argmax(axis=1))
+    start_time = time.time()
+    for start in range(0, len(testfile), batch_size):
+        lines = [l.split() for l in testfile[start:start + batch_size]]
+        batch_x = np.zeros((len(lines), input_size, input_size, 3), dtype='float32')
+        for i, line in enumerate(lines):
+            x = process_image_file(os.path.join(testfolder, line[1]), input_size, top_percent=0.08)
+            batch_x[i] = x.astype('float32') / 255.0
+            y_test.append(mapping[line[2]])
+        outputs = np.array(sess.run(pred_tensor, feed_dict={image_tensor: pad_batch(batch_x, batch_size)}))
+        pred.extend(outputs[:len(lines)].argmax(axis=1))
+    elapsed = time.time() - start_time
     y_test = np.array(y_test)
     pred = np.array(pred)
     pred[np.where(pred == 2)] = 1
@@ -34,6 +39,8 @@ def eval(sess, graph, testfile, testfolder, input_tensor, output_tensor, input_s
     print('Sens Normal: {0:.3f}, Pneumonia: {1:.3f}'.format(class_acc[0], class_acc[1]))
     ppvs = [matrix[i,i]/np.sum(matrix[:,i]) if np.sum(matrix[:,i]) else 0 for i in range(len(matrix))]
     print('PPV Normal: {0:.3f}, Pneumonia {1:.3f}'.format(ppvs[0], ppvs[1]))
+    print('Throughput: {:.2f} images/sec ({} images, batch size {})'.format(
+        len(testfile) / elapsed if elapsed else 0., len(testfile), batch_size))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='COVID-Net Evaluation')
@@ -45,6 +52,7 @@ if __name__ == '__main__':
     parser.add_argument('--in_tensorname', default='input_1:0', type=str, help='Name of input tensor to graph')
     parser.add_argument('--out_tensorname', default='norm_dense_1/Softmax:0', type=str, help='Name of output tensor from graph')
     parser.add_argument('--input_size', default=480, type=int, help='Size of input (ex: if 480x480, --input_size 480)')
+    parser.add_argument('--batch_size', default=8, type=int, help='Number of test images per sess.run, defaults to 8')
 
     args = parser.parse_args()
 
@@ -58,4 +66,5 @@ if __name__ == '__main__':
     file = open(args.testfile, 'r')
     testfile = file.readlines()
 
-    eval(sess, graph, testfile, args.testfolder, args.in_tensorname, args.out_tensorname, args.input_size)
+    eval(sess, graph, testfile, args.testfolder, args.in_tensorname, args.out_tensorname, args.input_size,
+         batch_size=args.batch_size)
@@ -0,0 +1,176 @@
+"""Export a COVID-Net checkpoint as a frozen, inference-only graph
+
+The scripts normally rebuild the full training graph with import_meta_graph and restore
+every variable, including optimizer slots. This tool freezes the variables into
+constants, strips nodes that are not needed to compute the output tensor, removes
+training-only nodes and folds constant and batch-norm subgraphs, then writes a single
+.pb file that eval.py and inference.py can load with --frozen_graph. TFLiteSession runs
+the .tflite models written by quantize.py.
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+
+# To remove TF Warnings
+tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+TRANSFORMS = [
+    'strip_unused_nodes',
+    'remove_nodes(op=Identity, op=CheckNumerics)',
+    'fold_constants(ignore_errors=true)',
+    'fold_batch_norms',
+    'fold_old_batch_norms',
+    'sort_by_execution_order',
+]
+
+
+def node_name(tensor):
+    'Node name of a tensor or tensor name (input_1:0 -> input_1)'
+    return getattr(tensor, 'name', tensor).split(':')[0]
+
+
+def freeze_graph(meta_file, ckpt_file, input_tensors, output_tensors, constants=None):
+    """Returns an optimized GraphDef computing output_tensors from input_tensors
+
+    constants optionally maps tensor names (e.g. keras_learning_phase:0) to fixed values.
+    """
+    input_nodes = [node_name(name) for name in input_tensors]
+    output_nodes = [node_name(name) for name in output_tensors]
+
+    graph = tf.Graph()
+    with graph.as_default(), tf.Session(graph=graph) as sess:
+        with tf.name_scope('frozen_constants'):
+            input_map = {name: tf.constant(value) for name, value in (constants or {}).items()}
+        saver = tf.train.import_meta_graph(meta_file, clear_devices=True, input_map=input_map)
+        saver.restore(sess, ckpt_file)
+        graph_def = tf.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(), output_nodes)
+
+    graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=input_nodes + output_nodes)
+    return TransformGraph(graph_def, input_nodes, output_nodes, TRANSFORMS)
+
+
+def read_graph_def(path):
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    return graph_def
+
+
+def load_frozen_graph(path):
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(read_graph_def(path), name='')
+    return graph
+
+
+class TFLiteSession:
+    """Runs a .tflite model with a tf.Session-like run(fetches, feed_dict)
+
+    Feeds and fetches are tensor names (or tensors) of the original graph. Images are run
+    one at a time since the converted model has a batch size of 1; feeds that are not model
+    inputs (e.g. keras_learning_phase) are ignored.
+    """
+    def __init__(self, model_path, num_threads=None):
+        self.interpreter = tf.lite.Interpreter(model_path=model_path)
+        if num_threads is not None:
+            self.interpreter.set_num_threads(num_threads)
+        self.interpreter.allocate_tensors()
+        self.inputs = {d['name']: d for d in self.interpreter.get_input_details()}
+        self.outputs = {d['name']: d for d in self.interpreter.get_output_details()}
+
+    def run(self, fetches, feed_dict):
+        feeds = {node_name(k): np.asarray(v) for k, v in feed_dict.items() if node_name(k) in self.inputs}
+        output = self.outputs[node_name(fetches)]
+        batch_size = len(next(iter(feeds.values())))
+
+        results = []
+        for i in range(batch_size):
+            for name, value in feeds.items():
+                detail = self.inputs[name]
+                self.interpreter.set_tensor(detail['index'], value[i:i + 1].astype(detail['dtype']))
+            self.interpreter.invoke()
+            results.append(self.interpreter.get_tensor(output['index']))
+        return np.concatenate(results, axis=0)
+
+    def close(self):
+        self.interpreter = None
+
+
+def load_checkpoint_graph(meta_file, ckpt_file):
+    graph = tf.Graph()
+    with graph.as_default():
+        saver = tf.train.import_meta_graph(meta_file)
+        sess = tf.Session(graph=graph)
+        saver.restore(sess, ckpt_file)
+    return graph, sess
+
+
+def time_inference(sess, input_tensors, output_tensor, batch_size=1, num_runs=20):
+    """Runs num_runs batches of zeros and returns the mean seconds per image"""
+    feed_dict = {}
+    for name in input_tensors:
+        tensor = sess.graph.get_tensor_by_name(name)
+        shape = [batch_size] + tensor.shape.as_list()[1:]
+        feed_dict[tensor] = np.zeros(shape, dtype=tensor.dtype.as_numpy_dtype)
+
+    # First run includes one-off graph optimization and memory allocation
+    sess.run(output_tensor, feed_dict=feed_dict)
+    start = time.time()
+    for _ in range(num_runs):
+        sess.run(output_tensor, feed_dict=feed_dict)
+    return (time.time() - start) / (num_runs * batch_size)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='COVID-Net Frozen Graph Export')
+    parser.add_argument('--weightspath', default='models/COVIDNet-CXR-3', type=str,
+                        help='Path to model files, defaults to \'models/COVIDNet-CXR-3\'')
+    parser.add_argument('--metaname', default='model.meta', type=str, help='Name of ckpt meta file')
+    parser.add_argument('--ckptname', default='model', type=str, help='Name of model ckpts')
+    parser.add_argument('--in_tensorname', default='input_2:0', type=str, help='Name of input tensor to graph')
+    parser.add_argument('--in_tensorname_medusa', default='input_1:0', type=str,
+                        help='Name of input tensor to MEDUSA graph for COVIDNet-CXR-3')
+    parser.add_argument('--out_tensorname', default='softmax/Softmax:0', type=str, help='Name of output tensor from graph')
+    parser.add_argument('--is_medusa_backbone', action='store_true',
+                        help='Add flag if exporting COVIDNet CXR-3 model, do not include for other versions')
+    parser.add_argument('--output', default=None, type=str,
+                        help='Path of the frozen graph, defaults to <weightspath>/frozen_model.pb')
+    parser.add_argument('--num_runs', default=20, type=int, help='Number of timed runs when comparing latency')
+    parser.add_argument('--no_benchmark', action='store_true', help='Skip the before/after load time and latency report')
+
+    args = parser.parse_args()
+
+    meta_file = os.path.join(args.weightspath, args.metaname)
+    ckpt_file = os.path.join(args.weightspath, args.ckptname)
+    output = args.output or os.path.join(args.weightspath, 'frozen_model.pb')
+    input_tensors = [args.in_tensorname]
+    if args.is_medusa_backbone:
+        input_tensors.append(args.in_tensorname_medusa)
+
+    graph_def = freeze_graph(meta_file, ckpt_file, input_tensors, [args.out_tensorname])
+    tf.io.write_graph(graph_def, os.path.dirname(os.path.abspath(output)), os.path.basename(output), as_text=False)
+    print('Wrote frozen graph with {} nodes to {} ({:.1f} MB)'.format(
+        len(graph_def.node), output, os.path.getsize(output) / 2**20))
+
+    if not args.no_benchmark:
+        start = time.time()
+        graph, sess = load_checkpoint_graph(meta_file, ckpt_file)
+        ckpt_load = time.time() - start
+        ckpt_latency = time_inference(sess, input_tensors, args.out_tensorname, num_runs=args.num_runs)
+        sess.close()
+
+        start = time.time()
+        graph = load_frozen_graph(output)
+        sess = tf.Session(graph=graph)
+        frozen_load = time.time() - start
+        frozen_latency = time_inference(sess, input_tensors, args.out_tensorname, num_runs=args.num_runs)
+        sess.close()
+
+        print('{:<12}{:>14}{:>22}'.format('', 'load time (s)', 'latency (ms/image)'))
+        print('{:<12}{:>14.2f}{:>22.2f}'.format('checkpoint', ckpt_load, ckpt_latency * 1000))
+        print('{:<12}{:>14.2f}{:>22.2f}'.format('frozen', frozen_load, frozen_latency * 1000))
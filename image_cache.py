@@ -0,0 +1,130 @@
+"""Memory-mapped cache of preprocessed COVIDx images
+
+Cropping and resizing in process_image_file are deterministic, so they only need to be
+done once per image. build_cache writes the cropped/resized uint8 images listed in a
+labels file into a single .npy array that is memory-mapped at training time, with a
+JSON index mapping each filename to its row. Each combination of preprocessing
+parameters gets its own sub-directory, and rows are only re-decoded when the source
+image's mtime or size changes.
+"""
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from data import LabelIndex, process_image_file
+
+IMAGES_NAME = 'images.npy'
+INDEX_NAME = 'index.json'
+
+
+def cache_path(cache_dir, size, top_percent, crop):
+    return os.path.join(cache_dir, 'size{}_top{}_crop{}'.format(size, top_percent, int(crop)))
+
+
+def _source_stat(filepath):
+    st = os.stat(filepath)
+    return [st.st_mtime, st.st_size]
+
+
+class ImageCache:
+    'Read-only view of a built image cache'
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_NAME), 'r') as f:
+            index = json.load(f)
+        self.params = index['params']
+        self.rows = {name: entry[0] for name, entry in index['files'].items()}
+        self.images = np.load(os.path.join(path, IMAGES_NAME), mmap_mode='r')
+
+    def __contains__(self, filename):
+        return filename in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, filename):
+        # Zero-copy view into the memory-mapped array
+        return self.images[self.rows[filename]]
+
+
+def build_cache(labels_file, image_dir, cache_dir, size=480, top_percent=0.08, crop=True, num_workers=4):
+    """Adds the images of labels_file to the cache, re-decoding only new or modified ones"""
+    path = cache_path(cache_dir, size, top_percent, crop)
+    os.makedirs(path, exist_ok=True)
+    index_file = os.path.join(path, INDEX_NAME)
+    images_file = os.path.join(path, IMAGES_NAME)
+
+    files = {}
+    if os.path.exists(index_file) and os.path.exists(images_file):
+        with open(index_file, 'r') as f:
+            files = json.load(f)['files']
+
+    filenames = list(dict.fromkeys(LabelIndex.load(labels_file).filenames.tolist()))
+
+    stale = []
+    num_rows = len(files)
+    for name in filenames:
+        stat = _source_stat(os.path.join(image_dir, name))
+        if name not in files:
+            files[name] = [num_rows] + stat
+            num_rows += 1
+            stale.append(name)
+        elif files[name][1:] != stat:
+            files[name] = [files[name][0]] + stat
+            stale.append(name)
+
+    if not stale:
+        print('Cache {} is up to date ({} images)'.format(path, len(files)))
+        return ImageCache(path)
+
+    shape = (num_rows, size, size, 3)
+    if os.path.exists(images_file) and np.load(images_file, mmap_mode='r').shape == shape:
+        images = np.load(images_file, mmap_mode='r+')
+    else:
+        # Grow the array, carrying over rows that are still valid without decoding them again
+        tmp_file = images_file + '.tmp'
+        images = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.uint8, shape=shape)
+        if os.path.exists(images_file):
+            old_images = np.load(images_file, mmap_mode='r')
+            images[:len(old_images)] = old_images[:num_rows]
+            del old_images
+        images.flush()
+        os.replace(tmp_file, images_file)
+
+    def load(name):
+        images[files[name][0]] = process_image_file(
+            os.path.join(image_dir, name), size, top_percent=top_percent, crop=crop)
+
+    print('Caching {} of {} images in {}'.format(len(stale), len(filenames), path))
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        list(executor.map(load, stale))
+    images.flush()
+    del images
+
+    # Only publish the index once the pixel data is on disk
+    params = {'size': size, 'top_percent': top_percent, 'crop': crop}
+    with open(index_file + '.tmp', 'w') as f:
+        json.dump({'params': params, 'files': files}, f)
+    os.replace(index_file + '.tmp', index_file)
+
+    return ImageCache(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='COVID-Net Preprocessed Image Cache')
+    parser.add_argument('--labelfile', default='labels/train_COVIDx9A.txt', type=str, help='Path to labels file')
+    parser.add_argument('--imagedir', default='data/train', type=str, help='Folder where the images are located')
+    parser.add_argument('--cachedir', default='cache', type=str, help='Folder to write the cache to')
+    parser.add_argument('--input_size', default=480, type=int, help='Size of input (ex: if 480x480, --input_size 480)')
+    parser.add_argument('--top_percent', default=0.08, type=float, help='Percent top crop from top of image')
+    parser.add_argument('--no_crop', action='store_true', help='Do not central crop (as for COVIDNet CXR-3)')
+    parser.add_argument('--num_workers', default=4, type=int, help='Number of decoding threads')
+
+    args = parser.parse_args()
+
+    build_cache(args.labelfile, args.imagedir, args.cachedir, size=args.input_size,
+                top_percent=args.top_percent, crop=not args.no_crop, num_workers=args.num_workers)
@@ -1,12 +1,17 @@
 import numpy as np
 import tensorflow as tf
-import os, argparse
+import os, sys, argparse
 import cv2
 
 from data import (
     process_image_file,
-    process_image_file_medusa,
+    process_image_file_dual,
+    read_image,
 )
+from batch_inference import ResultWriter, run_bulk
+from precision import PRECISIONS, load_model
+from export_graph import TFLiteSession
+from tta import average_views, select_views, tta_views, tta_views_dual
 
 # To remove TF Warnings
 tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
@@ -30,8 +35,32 @@ parser.add_argument('--top_percent', default=0.08, type=float, help='Percent top
 parser.add_argument('--is_severity_model', action='store_true', help='Add flag if training COVIDNet CXR-S model')
 parser.add_argument('--is_medusa_backbone', action='store_true', 
                     help='Add flag if training COVIDNet CXR-3 model, do not include for other versions')
+parser.add_argument('--imagedir', default=None, type=str, help='Score every PNG/JPEG image in this folder')
+parser.add_argument('--imageglob', default=None, type=str, help='Score every image matching this glob pattern')
+parser.add_argument('--imagelist', default=None, type=str, help='Score the images listed (one path per line) in this file')
+parser.add_argument('--output', default=None, type=str,
+                    help='CSV/JSONL file results are appended to in bulk mode, images already in it are skipped')
+parser.add_argument('--output_format', default='csv', choices=['csv', 'jsonl'], help='Format of the bulk mode output')
+parser.add_argument('--batch_size', default=16, type=int, help='Number of images per sess.run in bulk mode')
+parser.add_argument('--num_workers', default=4, type=int, help='Number of image decoding threads in bulk mode')
+parser.add_argument('--watch', action='store_true', help='Keep polling --imagedir/--imageglob for new images')
+parser.add_argument('--poll_interval', default=5., type=float, help='Seconds between polls in --watch mode')
+parser.add_argument('--frozen_graph', default=None, type=str,
+                    help='Path to a graph written by export_graph.py, used instead of the meta/ckpt files')
+parser.add_argument('--uint8_input', action='store_true',
+                    help='Feed uint8 images and normalize them on-graph instead of feeding float32 images')
+parser.add_argument('--precision', default='float32', choices=PRECISIONS,
+                    help='Compute precision, float16 applies to GPU ops and bfloat16 needs a TF build that supports it')
+parser.add_argument('--tflite', default=None, type=str,
+                    help='Path to an int8 model written by quantize.py, used instead of the meta/ckpt files')
+parser.add_argument('--tta', default=1, type=int,
+                    help='Average the predictions of this many test-time augmentation views (1 to 8, 1 disables it)')
 
 args = parser.parse_args()
+try:
+    select_views(args.tta, args.is_medusa_backbone)
+except ValueError as e:
+    parser.error(str(e))
 
 if args.is_severity_model:
     # For COVIDNet CXR-S training with COVIDxSev level 1 and level 2 air space seveirty grading
@@ -50,31 +79,62 @@ else:
         or 3 class detection of no pneumonia/non-COVID-19 pneumonia/COVID-19 pneumonia''')
 mapping_keys = list(mapping.keys())
 
-sess = tf.Session()
-tf.get_default_graph()
-saver = tf.train.import_meta_graph(os.path.join(args.weightspath, args.metaname))
-saver.restore(sess, os.path.join(args.weightspath, args.ckptname))
-
-graph = tf.get_default_graph()
-
-image_tensor = graph.get_tensor_by_name(args.in_tensorname)
-pred_tensor = graph.get_tensor_by_name(args.out_tensorname)
-
-if args.is_medusa_backbone:
-    x = process_image_file(args.imagepath, args.input_size, top_percent=0, crop=False)
-    x = x.astype('float32') / 255.0
-    medusa_image_tensor = graph.get_tensor_by_name(args.in_tensorname_medusa)
-    medusa_x = process_image_file_medusa(args.imagepath, args.input_size_medusa)
-    feed_dict = {
-                medusa_image_tensor: np.expand_dims(medusa_x, axis=0),
-                image_tensor: np.expand_dims(x, axis=0),
-            } 
+if args.tflite:
+    sess = TFLiteSession(args.tflite)
+    in_tensorname = args.in_tensorname
 else:
-    x = process_image_file(args.imagepath, args.input_size, top_percent=args.top_percent)
-    x = x.astype('float32') / 255.0
-    feed_dict = {image_tensor: np.expand_dims(x, axis=0)}
+    graph, sess, in_tensorname = load_model(args.weightspath, args.metaname, args.ckptname, args.in_tensorname,
+                                            args.input_size, uint8=args.uint8_input, precision=args.precision,
+                                            frozen_graph=args.frozen_graph)
 
-pred = sess.run(pred_tensor, feed_dict=feed_dict)
+
+def normalize(x):
+    # With --uint8_input the graph normalizes the images itself
+    return x if args.uint8_input and not args.tflite else x.astype('float32') / 255.0
+
+
+# Tensors are fed and fetched by name, which works for both tf.Session and TFLiteSession
+image_tensor = in_tensorname
+pred_tensor = args.out_tensorname
+medusa_image_tensor = args.in_tensorname_medusa
+
+
+def load_views(path):
+    'Returns the (tta, ...) normalized views of an image, and of its MEDUSA input for CXR-3 models'
+    if args.tta > 1:
+        img = read_image(path)
+        if args.is_medusa_backbone:
+            x, medusa_x = tta_views_dual(img, args.input_size, args.input_size_medusa, args.tta)
+            return normalize(x), medusa_x
+        return (normalize(tta_views(img, args.input_size, args.tta, top_percent=args.top_percent)),)
+    if args.is_medusa_backbone:
+        x, medusa_x = process_image_file_dual(path, args.input_size, args.input_size_medusa)
+        return normalize(x)[None], medusa_x[None]
+    return (normalize(process_image_file(path, args.input_size, top_percent=args.top_percent))[None],)
+
+
+def predict(inputs):
+    'Scores (n, tta, ...) batches of views in one run and averages the views of each image'
+    inputs = [x.reshape((-1,) + x.shape[2:]) for x in inputs]
+    feed_dict = {image_tensor: inputs[0]}
+    if args.is_medusa_backbone:
+        feed_dict[medusa_image_tensor] = inputs[1]
+    return average_views(sess.run(pred_tensor, feed_dict=feed_dict), args.tta)
+
+
+if args.imagedir or args.imageglob or args.imagelist:
+    writer = ResultWriter(args.output, mapping, fmt=args.output_format)
+    try:
+        run_bulk(load_views, predict, inv_mapping, writer, imagedir=args.imagedir, imagelist=args.imagelist,
+                 imageglob=args.imageglob, batch_size=args.batch_size, num_workers=args.num_workers,
+                 watch=args.watch, poll_interval=args.poll_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
+    sys.exit(0)
+
+pred = predict([np.expand_dims(x, axis=0) for x in load_views(args.imagepath)])
 
 print('Prediction: {}'.format(inv_mapping[pred.argmax(axis=1)[0]]))
 print('Confidence')
@@ -3,7 +3,7 @@ import tensorflow as tf
 import os, argparse
 import cv2
 
-from data import process_image_file
+from data import merge_pneumonia, process_image_file
 
 parser = argparse.ArgumentParser(description='COVID-Net-P Inference')
 parser.add_argument('--weightspath', default='models/COVIDNet-CXR4-A', type=str, help='Path to output folder')
@@ -35,8 +35,7 @@ x = process_image_file(args.imagepath, args.input_size, top_percent=args.top_per
 x = x.astype('float32') / 255.0
 pred = sess.run(pred_tensor, feed_dict={image_tensor: np.expand_dims(x, axis=0)})
 # Combining pneumonia and covid predictions into single pneumonia prediction.
-pred_pneumonia = np.array([pred[0][0], np.max([pred[0][1], pred[0][2]])])
-pred_pneumonia = pred_pneumonia / np.sum(pred_pneumonia)
+pred_pneumonia = merge_pneumonia(pred[0], {'normal': 0, 'pneumonia': 1, 'COVID-19': 2})
 
 print('Prediction: {}'.format(inv_mapping[pred_pneumonia.argmax()]))
 print('Confidence')
@@ -0,0 +1,145 @@
+"""Combined COVID-19, pneumonia and severity report from one pass over an image
+
+Replaces running inference.py --n_classes 3, inference_pneumonia.py and
+inference_severity.py one after the other: each image is decoded once and preprocessed
+once per distinct preprocessing (COVIDNet-CXR4-A and the SEV-GEO/OPC scorers share theirs),
+the classification model runs once and both the 3-class and the normal/pneumonia outputs
+are derived from its softmax, and the classification and severity models run concurrently
+on the shared input. Models are taken from the model registry (model_registry.py).
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+from data import merge_pneumonia, read_image
+from inference_severity import logits_to_score
+from model_registry import WarmModel, load_registry, model_exists, preprocess
+
+# To remove TF Warnings
+tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+DISCLAIMER = ('Do not use this prediction for self-diagnosis. You should check with your local authorities '
+              'for the latest advice on seeking medical assistance.')
+PNEUMONIA_CLASSES = ('normal', 'pneumonia', 'COVID-19')
+SEVERITY_NAMES = {'geo': 'geographic', 'opc': 'opacity'}
+
+
+def preprocessing_key(spec):
+    return spec['input_size'], spec['medusa_input_size'], spec['top_percent'], spec['crop']
+
+
+class MultiTaskReport:
+    """The classification model and the available severity scorers, restored once
+
+    severity maps 'geo'/'opc' to registry names, scorers whose files are missing are skipped.
+    """
+    def __init__(self, specs, classifier, severity):
+        self.specs = {'classification': specs[classifier]}
+        for task, name in severity.items():
+            if name and model_exists(specs[name]):
+                self.specs[task] = specs[name]
+        self.models = {task: WarmModel.from_spec(spec) for task, spec in self.specs.items()}
+        self.executor = ThreadPoolExecutor(max_workers=len(self.models))
+
+    def run(self, img):
+        'Report of a decoded BGR image'
+        start = time.time()
+        inputs = {}
+        for spec in self.specs.values():
+            key = preprocessing_key(spec)
+            if key not in inputs:
+                inputs[key] = [np.expand_dims(x, axis=0) for x in preprocess(spec, img)]
+        futures = {task: self.executor.submit(self.models[task].run, inputs[preprocessing_key(spec)])
+                   for task, spec in self.specs.items()}
+
+        mapping = self.specs['classification']['mapping']
+        pred = futures['classification'].result()[0]
+        inv_mapping = {i: cls for cls, i in mapping.items()}
+        report = {
+            'prediction': inv_mapping[int(pred.argmax())],
+            'confidence': {cls: float(pred[i]) for cls, i in mapping.items()},
+        }
+        if all(cls in mapping for cls in PNEUMONIA_CLASSES):
+            pneumonia = merge_pneumonia(pred, mapping)
+            report['pneumonia_prediction'] = ('normal', 'pneumonia')[int(pneumonia.argmax())]
+            report['pneumonia_confidence'] = {'normal': float(pneumonia[0]), 'pneumonia': float(pneumonia[1])}
+        for task, name in SEVERITY_NAMES.items():
+            if task in futures:
+                score = float(logits_to_score(futures[task].result())[0])
+                report[name + '_severity'] = score
+                report[name + '_extent_score'] = score * 8
+        report['latency_ms'] = (time.time() - start) * 1000.
+        return report
+
+    def close(self):
+        self.executor.shutdown()
+        for model in self.models.values():
+            model.close()
+
+
+def print_report(path, report):
+    print('Image: {}'.format(path))
+    print('Prediction: {}'.format(report['prediction']))
+    print('Confidence')
+    print(' '.join('{}: {:.3f}'.format(cls.capitalize(), p) for cls, p in report['confidence'].items()))
+    if 'pneumonia_prediction' in report:
+        print('Pneumonia prediction: {}'.format(report['pneumonia_prediction']))
+        print('Normal: {:.3f}, Pneumonia: {:.3f}'.format(report['pneumonia_confidence']['normal'],
+                                                         report['pneumonia_confidence']['pneumonia']))
+    if 'geographic_severity' in report:
+        print('Geographic severity: {:.3f}'.format(report['geographic_severity']))
+        print('Geographic extent score for right + left lung (0 - 8): {:.3f}'.format(report['geographic_extent_score']))
+        print('For each lung: 0 = no involvement; 1 = <25%; 2 = 25-50%; 3 = 50-75%; 4 = >75% involvement.')
+    if 'opacity_severity' in report:
+        print('Opacity severity: {:.3f}'.format(report['opacity_severity']))
+        print('Opacity extent score for right + left lung (0 - 8): {:.3f}'.format(report['opacity_extent_score']))
+        print('For each lung, the score is from 0 to 4, with 0 = no opacity and 4 = white-out.')
+    print('Latency: {:.1f} ms'.format(report['latency_ms']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='COVID-Net Multi-Task Report')
+    parser.add_argument('--imagepath', default=['assets/ex-covid.jpeg'], type=str, nargs='+',
+                        help='Full paths to the images to report on')
+    parser.add_argument('--classifier', default='COVIDNet-CXR4-A', type=str,
+                        help='Registry name of the classification model, the pneumonia output needs a 3-class model')
+    parser.add_argument('--geo', default='COVIDNet-SEV-GEO', type=str,
+                        help='Registry name of the geographic severity model, skipped if missing or empty')
+    parser.add_argument('--opc', default='COVIDNet-SEV-OPC', type=str,
+                        help='Registry name of the opacity severity model, skipped if missing or empty')
+    parser.add_argument('--registry', default=None, type=str,
+                        help='JSON file of models in addition to model_registry.MODELS, e.g. to change weightspath')
+    parser.add_argument('--json', action='store_true', help='Print one JSON report per line')
+
+    args = parser.parse_args()
+
+    specs = load_registry(args.registry)
+    for name in (args.classifier, args.geo, args.opc):
+        if name and name not in specs:
+            parser.error('Unknown model {}, expected one of {}'.format(name, ', '.join(sorted(specs))))
+    if specs[args.classifier]['task'] != 'classification':
+        parser.error('{} is not a classification model'.format(args.classifier))
+    for name in (args.geo, args.opc):
+        if name and specs[name]['task'] != 'severity':
+            parser.error('{} is not a severity model'.format(name))
+
+    report_models = MultiTaskReport(specs, args.classifier, {'geo': args.geo, 'opc': args.opc})
+    try:
+        for path in args.imagepath:
+            report = report_models.run(read_image(path))
+            if args.json:
+                print(json.dumps(dict(report, file=path)))
+            else:
+                print_report(path, report)
+    finally:
+        report_models.close()
+
+    if not args.json:
+        print('**DISCLAIMER**')
+        print(DISCLAIMER)
@@ -0,0 +1,363 @@
+"""Long-running COVID-Net inference service
+
+Serves the classification model given on the command line (COVIDNet-CXR, or CXR-3 with
+its MEDUSA input), the SEV-GEO/SEV-OPC severity models and the models of the registry
+(model_registry.MODELS and --registry). Models are loaded into their own graph and session
+on first use and kept open, and with --memory_budget_mb the least recently used idle
+models are closed to make room for others. Concurrent requests for the same model are
+coalesced into micro-batches: a batch is run as soon as it holds --max_batch_size images
+or the oldest request has waited --max_wait_ms.
+
+Endpoints (request body is the raw bytes of a PNG/JPEG image):
+    POST /predict         prediction and per-class confidence, as printed by inference.py
+    POST /severity        geographic/opacity severity, as printed by inference_severity.py
+    POST /pneumonia       normal/pneumonia prediction of a 3-class model (--pneumonia_model),
+                          as printed by inference_pneumonia.py
+    POST /models/<name>   the prediction or severity score of a registry model
+    GET  /metrics         queue depth, batch size histogram and p50/p99 latency per model,
+                          and the loaded models and memory use of the registry
+"""
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import cv2
+import numpy as np
+import tensorflow as tf
+
+from data import merge_pneumonia
+from inference_severity import logits_to_score
+from model_registry import ModelRegistry, load_registry, make_spec, model_exists, preprocess
+
+# To remove TF Warnings
+tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+DISCLAIMER = ('Do not use this prediction for self-diagnosis. You should check with your local authorities '
+              'for the latest advice on seeking medical assistance.')
+
+
+class RegistryModel:
+    'A model of a ModelRegistry, loaded (again) when a batch is run'
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def run(self, inputs):
+        return self.registry.run(self.name, inputs)
+
+
+class MicroBatcher:
+    'Coalesces concurrent requests into batches run on a single worker thread'
+
+    def __init__(self, model, max_batch_size=16, max_wait_ms=5., postprocess=None, num_latencies=10000):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.postprocess = postprocess
+        self.requests = queue.Queue()
+        self.batch_sizes = Counter()
+        self.latencies = deque(maxlen=num_latencies)
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, inputs):
+        'Queues one sample (a tuple of per-input arrays) and returns a Future of its output'
+        future = Future()
+        self.requests.put((inputs, future, time.time()))
+        return future
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        deadline = batch[0][2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                inputs = [np.stack(arrays) for arrays in zip(*[item[0] for item in batch])]
+                outputs = self.model.run(inputs)
+                if self.postprocess is not None:
+                    outputs = self.postprocess(outputs)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            now = time.time()
+            with self.lock:
+                self.batch_sizes[len(batch)] += 1
+                self.latencies.extend(now - item[2] for item in batch)
+            for i, (_, future, _) in enumerate(batch):
+                future.set_result(outputs[i])
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000.
+            batch_sizes = dict(sorted(self.batch_sizes.items()))
+        stats = {
+            'queue_depth': self.requests.qsize(),
+            'batch_size_histogram': {str(k): v for k, v in batch_sizes.items()},
+            'requests': int(sum(k * v for k, v in batch_sizes.items())),
+        }
+        if len(latencies):
+            stats['latency_ms'] = {
+                'p50': float(np.percentile(latencies, 50)),
+                'p99': float(np.percentile(latencies, 99)),
+            }
+        return stats
+
+
+class InferenceService:
+    'Holds the batchers of every loaded model and builds the response payloads'
+
+    def __init__(self, args):
+        self.args = args
+        self.batcher_kwargs = {'max_batch_size': args.max_batch_size, 'max_wait_ms': args.max_wait_ms}
+        specs = load_registry(args.registry)
+        specs.update(command_line_specs(args))
+        self.registry = ModelRegistry(specs, args.memory_budget_mb)
+        self.batchers = {}
+        self.lock = threading.Lock()
+        if args.preload:
+            for name in command_line_specs(args):
+                with self.registry.use(name):
+                    pass
+
+    def batcher(self, name):
+        'The micro-batcher of a registry model, created on its first request'
+        spec = self.registry.spec(name)
+        with self.lock:
+            if name not in self.batchers:
+                postprocess = logits_to_score if spec['task'] == 'severity' else None
+                self.batchers[name] = MicroBatcher(RegistryModel(self.registry, name), postprocess=postprocess,
+                                                   **self.batcher_kwargs)
+            return self.batchers[name]
+
+    def classify(self, name, img):
+        spec = self.registry.spec(name)
+        pred = self.batcher(name).submit(preprocess(spec, img)).result()
+        inv_mapping = {i: cls for cls, i in spec['mapping'].items()}
+        return {
+            'prediction': inv_mapping[int(pred.argmax())],
+            'confidence': {cls: float(pred[i]) for cls, i in spec['mapping'].items()},
+            'disclaimer': DISCLAIMER,
+        }
+
+    def predict(self, img):
+        return self.classify('classification', img)
+
+    def pneumonia(self, img):
+        name = self.args.pneumonia_model
+        spec = self.registry.spec(name)
+        mapping = spec['mapping'] or {}
+        if not all(cls in mapping for cls in ('normal', 'pneumonia', 'COVID-19')):
+            raise ValueError('The pneumonia model {} is not a normal/pneumonia/COVID-19 model'.format(name))
+        pred = merge_pneumonia(self.batcher(name).submit(preprocess(spec, img)).result(), mapping)
+        return {
+            'prediction': ('normal', 'pneumonia')[int(pred.argmax())],
+            'confidence': {'normal': float(pred[0]), 'pneumonia': float(pred[1])},
+            'disclaimer': DISCLAIMER,
+        }
+
+    def run_model(self, name, img):
+        spec = self.registry.spec(name)
+        if spec['task'] == 'classification':
+            return self.classify(name, img)
+        score = float(self.batcher(name).submit(preprocess(spec, img)).result())
+        return {'severity': score, 'extent_score': score * 8, 'disclaimer': DISCLAIMER}
+
+    def severity(self, img):
+        names = [name for name in ('geo', 'opc') if name in self.registry.specs]
+        if not names:
+            raise ValueError('No severity models are loaded')
+        # Both scorers share their preprocessing
+        inputs = preprocess(self.registry.spec(names[0]), img)
+        futures = {name: self.batcher(name).submit(inputs) for name in names}
+
+        payload = {}
+        if 'geo' in futures:
+            score = float(futures['geo'].result())
+            payload['geographic_severity'] = score
+            payload['geographic_extent_score'] = score * 8
+        if 'opc' in futures:
+            score = float(futures['opc'].result())
+            payload['opacity_severity'] = score
+            payload['opacity_extent_score'] = score * 8
+        payload['disclaimer'] = DISCLAIMER
+        return payload
+
+    def metrics(self):
+        with self.lock:
+            metrics = {name: batcher.stats() for name, batcher in self.batchers.items()}
+        metrics['registry'] = self.registry.stats()
+        return metrics
+
+    def close(self):
+        self.registry.close()
+
+
+def command_line_specs(args):
+    'Registry specs of the classification and severity models given by the arguments'
+    mapping, _ = get_mapping(args)
+    inputs = [args.in_tensorname]
+    if args.is_medusa_backbone:
+        inputs.append(args.in_tensorname_medusa)
+    specs = {'classification': make_spec({
+        'weightspath': args.weightspath, 'metaname': args.metaname, 'ckptname': args.ckptname,
+        'inputs': inputs, 'output': args.out_tensorname, 'input_size': args.input_size,
+        'medusa_input_size': args.input_size_medusa if args.is_medusa_backbone else None,
+        'top_percent': args.top_percent, 'mapping': mapping,
+    })}
+    for name, weightspath in (('geo', args.weightspath_geo), ('opc', args.weightspath_opc)):
+        if not weightspath:
+            continue
+        spec = make_spec({
+            'weightspath': weightspath, 'metaname': args.metaname_sev, 'ckptname': args.ckptname_sev,
+            'output': 'MLP/dense_1/MatMul:0', 'extra_feed': {'keras_learning_phase:0': False},
+            'input_size': args.input_size, 'top_percent': args.top_percent, 'task': 'severity',
+        })
+        # Severity models are optional, skipped if missing
+        if model_exists(spec):
+            specs[name] = spec
+    return specs
+
+
+def get_mapping(args):
+    if args.is_severity_model:
+        # For COVIDNet CXR-S training with COVIDxSev level 1 and level 2 air space seveirty grading
+        mapping = {'level2': 0, 'level1': 1}
+    elif args.n_classes == 2:
+        # For COVID-19 positive/negative detection
+        mapping = {'negative': 0, 'positive': 1}
+    elif args.n_classes == 3:
+        # For detection of no pneumonia/non-COVID-19 pneumonia/COVID-19 pneumonia
+        mapping = {'normal': 0, 'pneumonia': 1, 'COVID-19': 2}
+    else:
+        raise Exception('''COVID-Net currently only supports 2 class COVID-19 positive/negative detection
+            or 3 class detection of no pneumonia/non-COVID-19 pneumonia/COVID-19 pneumonia''')
+    inv_mapping = {i: cls for cls, i in mapping.items()}
+    return mapping, inv_mapping
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        def _send_json(self, code, payload):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self._send_json(200, service.metrics())
+            else:
+                self._send_json(404, {'error': 'Unknown endpoint {}'.format(self.path)})
+
+        def do_POST(self):
+            routes = {'/predict': service.predict, '/severity': service.severity, '/pneumonia': service.pneumonia}
+            if self.path.startswith('/models/'):
+                name = self.path[len('/models/'):]
+                route = lambda img: service.run_model(name, img)
+            elif self.path in routes:
+                route = routes[self.path]
+            else:
+                self._send_json(404, {'error': 'Unknown endpoint {}'.format(self.path)})
+                return
+
+            length = int(self.headers.get('Content-Length', 0))
+            data = np.frombuffer(self.rfile.read(length), dtype=np.uint8)
+            img = cv2.imdecode(data, cv2.IMREAD_COLOR) if len(data) else None
+            if img is None:
+                self._send_json(400, {'error': 'Request body is not a decodable image'})
+                return
+
+            try:
+                self._send_json(200, route(img))
+            except ValueError as e:
+                self._send_json(400, {'error': str(e)})
+            except Exception as e:
+                # e.g. a registry model whose checkpoint is missing, or a TensorFlow runtime error
+                self._send_json(500, {'error': '{}: {}'.format(type(e).__name__, e)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='COVID-Net Inference Server')
+    parser.add_argument('--host', default='127.0.0.1', type=str, help='Address to listen on')
+    parser.add_argument('--port', default=8000, type=int, help='Port to listen on')
+    parser.add_argument('--max_batch_size', default=16, type=int, help='Maximum number of images per sess.run')
+    parser.add_argument('--max_wait_ms', default=5., type=float,
+                        help='Maximum time a request waits for others to fill its batch')
+    parser.add_argument('--weightspath', default='models/COVIDNet-CXR-3', type=str,
+                        help='Path to model files, defaults to \'models/COVIDNet-CXR-3\'')
+    parser.add_argument('--metaname', default='model.meta', type=str, help='Name of ckpt meta file')
+    parser.add_argument('--ckptname', default='model', type=str, help='Name of model ckpts')
+    parser.add_argument('--n_classes', default=2, type=int, help='Number of detected classes, defaults to 2')
+    parser.add_argument('--in_tensorname', default='input_2:0', type=str, help='Name of input tensor to graph')
+    parser.add_argument('--in_tensorname_medusa', default='input_1:0', type=str,
+                        help='Name of input tensor to MEDUSA graph for COVIDNet-CXR-3')
+    parser.add_argument('--out_tensorname', default='softmax/Softmax:0', type=str, help='Name of output tensor from graph')
+    parser.add_argument('--input_size', default=480, type=int, help='Size of input (ex: if 480x480, --input_size 480)')
+    parser.add_argument('--input_size_medusa', default=256, type=int,
+                        help='Size of input to MEDUSA graph (ex: if 256x256, --input_size 256)')
+    parser.add_argument('--top_percent', default=0.08, type=float, help='Percent top crop from top of image')
+    parser.add_argument('--is_severity_model', action='store_true', help='Add flag if serving COVIDNet CXR-S model')
+    parser.add_argument('--is_medusa_backbone', action='store_true',
+                        help='Add flag if serving COVIDNet CXR-3 model, do not include for other versions')
+    parser.add_argument('--weightspath_geo', default='models/COVIDNet-SEV-GEO', type=str,
+                        help='Path to geographic severity model, skipped if missing')
+    parser.add_argument('--weightspath_opc', default='models/COVIDNet-SEV-OPC', type=str,
+                        help='Path to opacity severity model, skipped if missing')
+    parser.add_argument('--metaname_sev', default='model.meta', type=str, help='Name of severity ckpt meta file')
+    parser.add_argument('--ckptname_sev', default='model', type=str, help='Name of severity model ckpts')
+    parser.add_argument('--pneumonia_model', default='COVIDNet-CXR4-A', type=str,
+                        help='Registry name of the 3-class model behind /pneumonia, \'classification\' for the '
+                             'command-line model')
+    parser.add_argument('--registry', default=None, type=str,
+                        help='JSON file of models served at /models/<name>, in addition to model_registry.MODELS')
+    parser.add_argument('--memory_budget_mb', default=0, type=float,
+                        help='Memory budget of the loaded models, least recently used idle models are closed to '
+                             'stay within it (0 for no budget)')
+    parser.add_argument('--no_preload', dest='preload', action='store_false',
+                        help='Load the classification and severity models on their first request instead of at startup')
+
+    args = parser.parse_args()
+
+    service = InferenceService(args)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    print('Serving {} on http://{}:{}'.format(', '.join(service.registry.specs), args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    service.close()
@@ -1,8 +1,9 @@
 import numpy as np
 import tensorflow as tf
-import os, argparse
+import os, sys, argparse, csv
 
 from data import process_image_file
+from export_graph import TFLiteSession
 from collections import defaultdict
 
 def score_prediction(softmax, step_size):
@@ -10,10 +11,20 @@ def score_prediction(softmax, step_size):
     vals = np.expand_dims(vals, axis=0)
     return np.sum(softmax * vals, axis=-1)
 
+def logits_to_score(logits):
+    softmax = np.exp(logits) / np.sum(np.exp(logits), axis=-1, keepdims=True)
+    return score_prediction(softmax, 1 / 3.)
+
 class MetaModel:
+    """Severity scorer restored once and reused across calls
+
+    Call load() (or use as a context manager) to restore the checkpoint, then infer() or
+    infer_batch() any number of times, and close() to release the session.
+    """
     def __init__(self, meta_file, ckpt_file):
         self.meta_file = meta_file
         self.ckpt_file = ckpt_file
+        self.sess = None
 
         self.graph = tf.Graph()
         with self.graph.as_default():
@@ -22,27 +33,103 @@ class MetaModel:
             self.phase_tr = self.graph.get_tensor_by_name('keras_learning_phase:0')
             self.output_tr = self.graph.get_tensor_by_name('MLP/dense_1/MatMul:0')
 
-    def infer(self, image):
-        with tf.Session(graph=self.graph) as sess:
-            self.saver.restore(sess, self.ckpt_file)
-
-            outputs = defaultdict(list)
-            outs = sess.run(self.output_tr,
-                            feed_dict={
-                                self.input_tr: np.expand_dims(image, axis=0),
-                                self.phase_tr: False
-                            })
+    def load(self):
+        if self.sess is None:
+            self.sess = tf.Session(graph=self.graph)
+            self.saver.restore(self.sess, self.ckpt_file)
+        return self
+
+    def close(self):
+        if self.sess is not None:
+            self.sess.close()
+            self.sess = None
+
+    def __enter__(self):
+        return self.load()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def infer_batch(self, images, batch_size=16):
+        self.load()
+
+        outputs = defaultdict(list)
+        for start in range(0, len(images), batch_size):
+            outs = self.sess.run(self.output_tr,
+                                 feed_dict={
+                                     self.input_tr: images[start:start + batch_size],
+                                     self.phase_tr: False
+                                 })
             outputs['logits'].append(outs)
 
-            for k in outputs.keys():
-                outputs[k] = np.concatenate(outputs[k], axis=0)
+        for k in outputs.keys():
+            outputs[k] = np.concatenate(outputs[k], axis=0)
 
-            outputs['softmax'] = np.exp(outputs['logits']) / np.sum(
-                np.exp(outputs['logits']), axis=-1, keepdims=True)
-            outputs['score'] = score_prediction(outputs['softmax'], 1 / 3.)
+        outputs['score'] = logits_to_score(outputs['logits'])
 
         return outputs['score']
 
+    def infer(self, image):
+        return self.infer_batch(np.expand_dims(image, axis=0))
+
+class TFLiteModel(MetaModel):
+    'Severity scorer backed by an int8 model written by quantize.py --is_severity_scorer'
+    def __init__(self, tflite_file):
+        self.tflite_file = tflite_file
+        self.sess = None
+        self.input_tr = 'input_1:0'
+        self.phase_tr = 'keras_learning_phase:0'
+        self.output_tr = 'MLP/dense_1/MatMul:0'
+
+    def load(self):
+        if self.sess is None:
+            self.sess = TFLiteSession(self.tflite_file)
+        return self
+
+def load_scorer(weightspath, metaname, ckptname, tflite_name=None):
+    'Returns the (not yet loaded) scorer stored in weightspath, or None if there is none'
+    if tflite_name:
+        tflite_file = os.path.join(weightspath, tflite_name)
+        return TFLiteModel(tflite_file) if os.path.exists(tflite_file) else None
+    if os.path.exists(os.path.join(weightspath, metaname)):
+        return MetaModel(os.path.join(weightspath, metaname), os.path.join(weightspath, ckptname))
+    return None
+
+def list_images(imagedir=None, imagelist=None):
+    if imagelist:
+        with open(imagelist, 'r') as f:
+            return [l.strip() for l in f if l.strip()]
+    exts = ('.png', '.jpg', '.jpeg')
+    return sorted(os.path.join(imagedir, name) for name in os.listdir(imagedir)
+                  if name.lower().endswith(exts))
+
+def score_images(imagepaths, models, input_size, top_percent, batch_size, out):
+    """Scores images in chunks of batch_size with every loaded model, writing one CSV row per image
+
+    Unreadable images are reported on stderr and skipped.
+    """
+    names = list(models.keys())
+    # out may be stdout, which is not opened with newline='', so no \r\n line endings
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(['file'] + [field for name in names for field in (name, name + '_extent')])
+    for start in range(0, len(imagepaths), batch_size):
+        paths, images = [], []
+        for path in imagepaths[start:start + batch_size]:
+            try:
+                images.append(process_image_file(path, input_size, top_percent=top_percent))
+            except Exception as e:
+                print('Skipping {}: {}'.format(path, e), file=sys.stderr)
+                continue
+            paths.append(path)
+        if not paths:
+            continue
+        x = np.stack(images)
+        x = x.astype('float32') / 255.0
+        scores = [models[name].infer_batch(x, batch_size=batch_size) for name in names]
+        for i, path in enumerate(paths):
+            writer.writerow([path] + ['{:.3f}'.format(x) for score in scores for x in (score[i], score[i] * 8)])
+        out.flush()
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='COVID-Net Lung Severity Scoring')
     parser.add_argument('--weightspath_geo', default='models/COVIDNet-SEV-GEO', type=str, help='Path to output folder')
@@ -52,29 +139,54 @@ if __name__ == '__main__':
     parser.add_argument('--imagepath', default='assets/ex-covid.jpeg', type=str, help='Full path to image to perfom scoring on')
     parser.add_argument('--input_size', default=480, type=int, help='Size of input (ex: if 480x480, --input_size 480)')
     parser.add_argument('--top_percent', default=0.08, type=float, help='Percent top crop from top of image')
+    parser.add_argument('--imagedir', default=None, type=str,
+                        help='Score every PNG/JPEG image in this folder instead of --imagepath')
+    parser.add_argument('--imagelist', default=None, type=str,
+                        help='Score the images listed (one path per line) in this file instead of --imagepath')
+    parser.add_argument('--batch_size', default=16, type=int, help='Number of images per sess.run in bulk mode')
+    parser.add_argument('--output', default=None, type=str, help='CSV file for bulk mode scores, defaults to stdout')
+    parser.add_argument('--tflite_name', default=None, type=str,
+                        help='Name of the int8 model written by quantize.py in each weightspath (e.g. model_int8.tflite), '
+                             'used instead of the checkpoint')
 
     args = parser.parse_args()
 
+    if args.imagedir or args.imagelist:
+        models = {}
+        for name, weightspath in (('geo', args.weightspath_geo), ('opc', args.weightspath_opc)):
+            model = load_scorer(weightspath, args.metaname, args.ckptname, args.tflite_name)
+            if model is not None:
+                models[name] = model.load()
+
+        imagepaths = list_images(args.imagedir, args.imagelist)
+        out = open(args.output, 'w') if args.output else sys.stdout
+        try:
+            score_images(imagepaths, models, args.input_size, args.top_percent, args.batch_size, out)
+        finally:
+            if args.output:
+                out.close()
+            for model in models.values():
+                model.close()
+        sys.exit(0)
+
     x = process_image_file(args.imagepath, args.input_size, top_percent=args.top_percent)
     x = x.astype('float32') / 255.0
 
     # check if models exists
-    infer_geo = os.path.exists(os.path.join(args.weightspath_geo, args.metaname))
-    infer_opc = os.path.exists(os.path.join(args.weightspath_opc, args.metaname))
+    model_geo = load_scorer(args.weightspath_geo, args.metaname, args.ckptname, args.tflite_name)
+    model_opc = load_scorer(args.weightspath_opc, args.metaname, args.ckptname, args.tflite_name)
 
-    if infer_geo:
-        model_geo = MetaModel(os.path.join(args.weightspath_geo, args.metaname),
-                              os.path.join(args.weightspath_geo, args.ckptname))
-        output_geo = model_geo.infer(x)
+    if model_geo is not None:
+        with model_geo:
+            output_geo = model_geo.infer(x)
 
         print('Geographic severity: {:.3f}'.format(output_geo[0]))
         print('Geographic extent score for right + left lung (0 - 8): {:.3f}'.format(output_geo[0]*8))
         print('For each lung: 0 = no involvement; 1 = <25%; 2 = 25-50%; 3 = 50-75%; 4 = >75% involvement.')
 
-    if infer_opc:
-        model_opc = MetaModel(os.path.join(args.weightspath_opc, args.metaname),
-                              os.path.join(args.weightspath_opc, args.ckptname))
-        output_opc = model_opc.infer(x)
+    if model_opc is not None:
+        with model_opc:
+            output_opc = model_opc.infer(x)
 
         print('Opacity severity: {:.3f}'.format(output_opc[0]))
         print('Opacity extent score for right + left lung (0 - 8): {:.3f}'.format(output_opc[0]*8))
@@ -0,0 +1,191 @@
+"""tf.data input stage shared by train_tf.ipy and train_risknet.py
+
+Images are decoded, cropped and resized on-graph on parallel map threads, batched,
+augmented and converted to float32 on-graph, and prefetched. The batch tensors are
+connected directly to the model inputs with import_meta_graph(input_map=...), so
+training steps do not copy batches through feed_dict. Preprocessing follows
+data.process_image (BGR channel order, top crop, central crop, bilinear resize) and
+augmentation follows data.augment_batch, with the same AUGMENTATION_RANGES.
+"""
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from data import AUGMENTATION_RANGES, LabelIndex, balance_buckets
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+# Graph collection of the initializers of saveable input iterators, see input_tensors
+ITERATOR_INITIALIZERS = 'input_iterator_initializers'
+
+
+def decode_image(contents):
+    img = tf.cond(tf.image.is_jpeg(contents),
+                  lambda: tf.image.decode_jpeg(contents, channels=3),
+                  lambda: tf.image.decode_png(contents, channels=3))
+    # cv2.imread returns BGR, which is what the models are trained on
+    return tf.reverse(img, axis=[-1])
+
+
+def process_image(img, size, top_percent=0.08, crop=True):
+    'On-graph equivalent of data.process_image, returns a (size, size, 3) uint8 tensor'
+    shape = tf.shape(img)
+    offset = tf.cast(tf.cast(shape[0], tf.float64) * top_percent, tf.int32)
+    img = img[offset:]
+    if crop:
+        height, width = shape[0] - offset, shape[1]
+        crop_size = tf.minimum(height, width)
+        img = tf.image.crop_to_bounding_box(img, (height - crop_size) // 2, (width - crop_size) // 2,
+                                            crop_size, crop_size)
+    # half_pixel_centers matches the sampling grid of cv2.resize
+    img = tf.compat.v1.image.resize_bilinear(img[None], [size, size], half_pixel_centers=True)[0]
+    img = tf.cast(tf.round(img), tf.uint8)
+    img.set_shape([size, size, 3])
+    return img
+
+
+def load_images(dataset, size, top_percent=0.08, crop=True, num_parallel_calls=AUTOTUNE):
+    'Maps a dataset of (path, label) to (uint8 image, label)'
+    def load(path, label):
+        return process_image(decode_image(tf.io.read_file(path)), size, top_percent, crop), label
+    return dataset.map(load, num_parallel_calls=num_parallel_calls)
+
+
+def sample_augmentation_params(batch_size, img_shape, seed, ranges=AUGMENTATION_RANGES):
+    'On-graph equivalent of data.sample_augmentation_params, drawn from a stateless seed'
+    u = tf.random.stateless_uniform([10, batch_size], seed=seed, dtype=tf.float64)
+
+    def uniform(i, low, high):
+        return low + (high - low) * u[i]
+
+    ratio = img_shape[0] / img_shape[1]
+    new_ratio = uniform(0, max(ratio - ranges['ratio_delta'], 0.01), ratio + ranges['ratio_delta'])
+    use_ratio = u[1] < ranges['ratio_prob']
+    ones = tf.ones([batch_size], dtype=tf.float64)
+    return {
+        'ratio_x': tf.where(use_ratio, tf.minimum(1., new_ratio / ratio), ones),
+        'ratio_y': tf.where(use_ratio, tf.minimum(1., ratio / new_ratio), ones),
+        'theta': uniform(2, -ranges['rotation_range'], ranges['rotation_range']),
+        'tx': uniform(3, -ranges['width_shift_range'], ranges['width_shift_range']) * img_shape[1],
+        'ty': uniform(4, -ranges['height_shift_range'], ranges['height_shift_range']) * img_shape[0],
+        'zx': uniform(5, *ranges['zoom_range']),
+        'zy': uniform(6, *ranges['zoom_range']),
+        'flip': tf.logical_and(u[7] < 0.5, ranges['horizontal_flip']),
+        'brightness': uniform(8, *ranges['brightness_range']),
+    }
+
+
+def augmentation_transforms(params, img_shape):
+    """Same forward affine matrices as data.augmentation_matrices, inverted into the
+    output-to-input projective transforms expected by tf.contrib.image.transform"""
+    theta = params['theta'] * np.pi / 180.
+    cos, sin = tf.cos(theta), tf.sin(theta)
+    kx = params['ratio_x'] / params['zx']
+    ky = params['ratio_y'] / params['zy']
+    f = tf.where(params['flip'], -tf.ones_like(theta), tf.ones_like(theta))
+
+    a00, a01 = f * cos * kx, -f * sin * ky
+    a10, a11 = sin * kx, cos * ky
+    cx, cy = (img_shape[1] - 1) / 2., (img_shape[0] - 1) / 2.
+    t0 = cx - a00 * cx - a01 * cy + params['tx']
+    t1 = cy - a10 * cx - a11 * cy + params['ty']
+
+    det = a00 * a11 - a01 * a10
+    i00, i01, i10, i11 = a11 / det, -a01 / det, -a10 / det, a00 / det
+    zeros = tf.zeros_like(theta)
+    transforms = tf.stack([i00, i01, -(i00 * t0 + i01 * t1),
+                           i10, i11, -(i10 * t0 + i11 * t1), zeros, zeros], axis=1)
+    return tf.cast(transforms, tf.float32)
+
+
+def augment_images(images, seed, ranges=AUGMENTATION_RANGES):
+    'Augments a uint8 (N, H, W, C) batch tensor, returns float32 values in [0, 255]'
+    img_shape = images.shape.as_list()[1:3]
+    batch_size = tf.shape(images)[0]
+    params = sample_augmentation_params(batch_size, img_shape, seed, ranges)
+    images = tf.contrib.image.transform(tf.cast(images, tf.float32), augmentation_transforms(params, img_shape),
+                                        interpolation='BILINEAR')
+    brightness = tf.cast(tf.reshape(params['brightness'], [-1, 1, 1, 1]), tf.float32)
+    return tf.floor(tf.clip_by_value(images * brightness, 0., 255.))
+
+
+def prepare_batches(dataset, n_classes, class_weights, augment=False, seed=None, uint8=False):
+    """Maps batches of (uint8 images, labels) to (float32 images, one-hot labels, sample weights)
+
+    With uint8=True the images are left unnormalized uint8 for graphs that normalize them
+    on-graph (see precision.py).
+
+    Each batch is augmented with a stateless seed derived from seed and the batch index, so
+    the augmentation of a run is reproducible regardless of map parallelism.
+    """
+    if seed is None:
+        seed = np.random.randint(np.iinfo(np.int32).max)
+    class_weights = tf.constant(class_weights, dtype=tf.float32)
+
+    def prepare(step, images, labels):
+        if augment:
+            # Augmented values are whole numbers in [0, 255], so the uint8 cast is exact
+            images = augment_images(images, tf.stack([tf.cast(seed, tf.int64), step]))
+            images = tf.cast(images, tf.uint8) if uint8 else images / 255.
+        elif not uint8:
+            images = tf.cast(images, tf.float32) / 255.
+        return images, tf.one_hot(labels, n_classes), tf.gather(class_weights, labels)
+
+    dataset = tf.data.Dataset.zip((tf.data.experimental.Counter(), dataset))
+    return dataset.map(lambda step, batch: prepare(step, *batch), num_parallel_calls=AUTOTUNE)
+
+
+def balanced_dataset(data_dir, labels_file, batch_size=8, input_size=480, n_classes=2,
+                     mapping={'negative': 0, 'positive': 1}, covid_percent=0.5, class_weights=[1., 1.],
+                     top_percent=0.08, is_severity_model=False, augment=True, seed=None,
+                     num_parallel_calls=AUTOTUNE, prefetch=AUTOTUNE, uint8=False):
+    """Infinite dataset of covid-balanced training batches, and the number of batches per epoch
+
+    Like data.BalanceCovidDataset, every batch holds max(int(batch_size * covid_percent), 1)
+    covid samples and an epoch is one pass over the non-covid samples. Both classes are
+    shuffled and repeated independently and interleaved with a fixed per-batch pattern.
+    """
+    if seed is None:
+        seed = np.random.randint(np.iinfo(np.int32).max)
+    index = LabelIndex.load(labels_file)
+    targets = index.targets(mapping)
+    paths = np.array([os.path.join(data_dir, 'train', name) for name in index.filenames])
+
+    def class_dataset(rows, class_seed):
+        dataset = tf.data.Dataset.from_tensor_slices((paths[rows], targets[rows]))
+        return dataset.shuffle(len(rows), seed=class_seed, reshuffle_each_iteration=True).repeat()
+
+    noncovid_rows, covid_rows = balance_buckets(index, mapping, n_classes, is_severity_model)
+    covid_size = max(int(batch_size * covid_percent), 1)
+    pattern = tf.data.Dataset.from_tensor_slices(
+        tf.constant([0] * (batch_size - covid_size) + [1] * covid_size, dtype=tf.int64)).repeat()
+    dataset = tf.data.experimental.choose_from_datasets(
+        [class_dataset(noncovid_rows, seed), class_dataset(covid_rows, seed + 1)], pattern)
+
+    dataset = load_images(dataset, input_size, top_percent=top_percent, num_parallel_calls=num_parallel_calls)
+    dataset = dataset.batch(batch_size, drop_remainder=True)
+    dataset = prepare_batches(dataset, n_classes, class_weights, augment=augment, seed=seed, uint8=uint8)
+    steps_per_epoch = int(np.ceil(len(noncovid_rows) / float(batch_size)))
+    return dataset.prefetch(prefetch), steps_per_epoch
+
+
+def input_tensors(dataset, image_shape, saveable=False):
+    """Returns (images, labels, weights) tensors reading from dataset
+
+    images is a placeholder_with_default, so evaluation can still feed its own images to
+    it while training steps take the next batch from the pipeline.
+
+    With saveable=True the iterator position is saved and restored by tf.train.Saver, for
+    resuming training. The iterator must then be initialized by running the ops in the
+    ITERATOR_INITIALIZERS collection.
+    """
+    if saveable:
+        iterator = tf.compat.v1.data.make_initializable_iterator(dataset)
+        tf.compat.v1.add_to_collection(ITERATOR_INITIALIZERS, iterator.initializer)
+        tf.compat.v1.add_to_collection(tf.compat.v1.GraphKeys.SAVEABLE_OBJECTS,
+                                       tf.data.experimental.make_saveable_from_iterator(iterator))
+    else:
+        iterator = tf.compat.v1.data.make_one_shot_iterator(dataset)
+    images, labels, weights = iterator.get_next()
+    images = tf.compat.v1.placeholder_with_default(images, [None] + list(image_shape), name='images')
+    return images, labels, weights
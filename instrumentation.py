@@ -0,0 +1,127 @@
+"""Per-step timing of the training loops in train_tf.ipy and train_risknet.py
+
+TrainingProfiler times the phases of each step (waiting for the next batch, the training
+sess.run) and durations recorded from other threads (batch assembly in
+BalanceCovidDataset.load_batch, which runs on the PrefetchGenerator threads), and prints
+a per-epoch summary telling whether a run is input-bound or compute-bound. With a trace
+directory it also writes the host-side phases of every step as a Chrome trace per epoch,
+and every trace_every steps asks the session for a full op-level trace (RunMetadata),
+written as a Chrome trace as well. Open the traces in chrome://tracing or Perfetto. With
+the tf.data input pipeline the input wait happens inside the session, and shows up as
+IteratorGetNext in the op-level traces.
+
+When disabled, phase() returns a shared no-op context and nothing is recorded.
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+
+class _NoOp:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_OP = _NoOp()
+
+
+class TrainingProfiler:
+    def __init__(self, enabled=False, trace_dir=None, trace_every=0, batch_size=None):
+        self.enabled = enabled or bool(trace_dir)
+        self.trace_dir = trace_dir
+        self.trace_every = trace_every if trace_dir else 0
+        self.batch_size = batch_size
+        self.global_step = 0
+        self.lock = threading.Lock()
+        self._reset()
+        if trace_dir:
+            os.makedirs(trace_dir, exist_ok=True)
+
+    def _reset(self):
+        self.durations = defaultdict(list)
+        self.events = []
+        self.step_start = None
+        self.epoch_start = None
+
+    def record(self, name, seconds, start=None):
+        'Records a duration, can be called from any thread'
+        if not self.enabled:
+            return
+        with self.lock:
+            self.durations[name].append(seconds)
+            if self.trace_dir and start is not None:
+                self.events.append({'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                                    'ts': start * 1e6, 'dur': seconds * 1e6})
+
+    @contextlib.contextmanager
+    def _timed(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start, start)
+
+    def phase(self, name):
+        'Context manager timing one phase of the current step'
+        if not self.enabled:
+            return _NO_OP
+        if self.step_start is None:
+            self.step_start = time.time()
+            if self.epoch_start is None:
+                self.epoch_start = self.step_start
+        return self._timed(name)
+
+    def run_kwargs(self):
+        'Extra sess.run arguments, requesting a full trace on every trace_every-th step'
+        if self.trace_every and self.global_step % self.trace_every == 0:
+            return {'options': tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                    'run_metadata': tf.RunMetadata()}
+        return {}
+
+    def end_step(self, run_kwargs=None):
+        if not self.enabled:
+            return
+        if self.step_start is not None:
+            self.record('step', time.time() - self.step_start, self.step_start)
+            self.step_start = None
+        if run_kwargs and 'run_metadata' in run_kwargs:
+            trace = timeline.Timeline(run_kwargs['run_metadata'].step_stats).generate_chrome_trace_format()
+            with open(os.path.join(self.trace_dir, 'ops_step{:07d}.json'.format(self.global_step)), 'w') as f:
+                f.write(trace)
+        self.global_step += 1
+
+    def epoch_summary(self, epoch):
+        'Prints the per-phase timings of the epoch and writes its host trace'
+        if not self.enabled:
+            return
+        with self.lock:
+            durations, events = self.durations, self.events
+            elapsed = time.time() - self.epoch_start if self.epoch_start is not None else 0.
+            self._reset()
+
+        print('Epoch {:04d} step timings (mean / p50 / p95 ms):'.format(epoch + 1))
+        for name in sorted(durations):
+            values = np.array(durations[name]) * 1000.
+            print('    {:<16}{:>9.1f}{:>9.1f}{:>9.1f}  ({} samples)'.format(
+                name, values.mean(), np.percentile(values, 50), np.percentile(values, 95), len(values)))
+        steps = durations.get('step')
+        if steps:
+            step_time = np.sum(steps)
+            if 'data_wait' in durations:
+                print('    waiting for data: {:.1%} of step time'.format(np.sum(durations['data_wait']) / step_time))
+            if self.batch_size and elapsed:
+                print('    {:.2f} images/sec over {:.1f} s'.format(len(steps) * self.batch_size / elapsed, elapsed))
+
+        if self.trace_dir and events:
+            with open(os.path.join(self.trace_dir, 'host_epoch{:04d}.json'.format(epoch + 1)), 'w') as f:
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
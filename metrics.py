@@ -0,0 +1,118 @@
+"""Streaming classification metrics
+
+StreamingMetrics accumulates a confusion matrix, and optionally per-class score histograms
+(for one-vs-rest AUC) and confidence bins (for calibration), batch by batch. Its memory
+does not grow with the number of images, running metrics can be printed at any point of
+an evaluation, and accumulators of shards evaluated separately (e.g. in other processes)
+can be merged into one report.
+"""
+import numpy as np
+
+
+class StreamingMetrics:
+    """Confusion matrix with optional AUC and calibration bins
+
+    auc_bins > 0 keeps, per class, histograms of the predicted probability of that class for
+    samples of the class and for the others, from which a one-vs-rest AUC is computed (exact
+    up to the bin width). calibration_bins > 0 keeps the count, summed confidence and number
+    of correct predictions per bin of top-class probability.
+    """
+    def __init__(self, n_classes, auc_bins=0, calibration_bins=0):
+        self.n_classes = n_classes
+        self.matrix = np.zeros((n_classes, n_classes), dtype='int64')
+        self.auc_bins = auc_bins
+        self.calibration_bins = calibration_bins
+        if auc_bins:
+            # [class, negative/positive, bin]
+            self.score_hist = np.zeros((n_classes, 2, auc_bins), dtype='int64')
+        if calibration_bins:
+            self.calib_count = np.zeros(calibration_bins, dtype='int64')
+            self.calib_confidence = np.zeros(calibration_bins)
+            self.calib_correct = np.zeros(calibration_bins, dtype='int64')
+
+    def __len__(self):
+        return int(self.matrix.sum())
+
+    def update(self, y_true, outputs):
+        """Adds a batch, outputs being (N, n_classes) probabilities or (N,) predicted classes"""
+        y_true = np.asarray(y_true, dtype='int64')
+        outputs = np.asarray(outputs)
+        probs = outputs if outputs.ndim == 2 else None
+        pred = outputs.argmax(axis=1) if probs is not None else outputs.astype('int64')
+        # np.add.at would wrap negative indices around to the last class
+        for name, values in (('targets', y_true), ('predictions', pred)):
+            if len(values) and (values.min() < 0 or values.max() >= self.n_classes):
+                raise ValueError('{} must be class indices in [0, {})'.format(name.capitalize(), self.n_classes))
+        np.add.at(self.matrix, (y_true, pred), 1)
+
+        if probs is None:
+            if self.auc_bins or self.calibration_bins:
+                raise ValueError('AUC and calibration need probabilities, not predicted classes')
+            return
+        if self.auc_bins:
+            bins = np.clip((probs * self.auc_bins).astype('int64'), 0, self.auc_bins - 1)
+            positive = (y_true[:, None] == np.arange(self.n_classes)).astype('int64')
+            classes = np.broadcast_to(np.arange(self.n_classes), bins.shape)
+            np.add.at(self.score_hist, (classes, positive, bins), 1)
+        if self.calibration_bins:
+            confidence = probs.max(axis=1)
+            bins = np.clip((confidence * self.calibration_bins).astype('int64'), 0, self.calibration_bins - 1)
+            np.add.at(self.calib_count, bins, 1)
+            np.add.at(self.calib_confidence, bins, confidence)
+            np.add.at(self.calib_correct, bins, (pred == y_true).astype('int64'))
+
+    def merge(self, other):
+        'Adds the counts of another accumulator with the same settings'
+        if (other.n_classes, other.auc_bins, other.calibration_bins) != \
+                (self.n_classes, self.auc_bins, self.calibration_bins):
+            raise ValueError('Cannot merge metrics with different classes or bins')
+        self.matrix += other.matrix
+        if self.auc_bins:
+            self.score_hist += other.score_hist
+        if self.calibration_bins:
+            self.calib_count += other.calib_count
+            self.calib_confidence += other.calib_confidence
+            self.calib_correct += other.calib_correct
+        return self
+
+    def sensitivities(self):
+        totals = self.matrix.sum(axis=1)
+        return [self.matrix[i, i] / totals[i] if totals[i] else 0 for i in range(self.n_classes)]
+
+    def ppvs(self):
+        totals = self.matrix.sum(axis=0)
+        return [self.matrix[i, i] / totals[i] if totals[i] else 0 for i in range(self.n_classes)]
+
+    def aucs(self):
+        'One-vs-rest AUC per class, None for classes without positive or negative samples'
+        aucs = []
+        for negatives, positives in self.score_hist:
+            n_neg, n_pos = negatives.sum(), positives.sum()
+            if not n_neg or not n_pos:
+                aucs.append(None)
+                continue
+            # Positives ranked above negatives in lower bins, and half the ties within a bin
+            below = np.cumsum(negatives) - negatives
+            aucs.append(float((positives * (below + 0.5 * negatives)).sum() / (n_pos * n_neg)))
+        return aucs
+
+    def expected_calibration_error(self):
+        total = self.calib_count.sum()
+        if not total:
+            return 0.
+        return float(np.abs(self.calib_confidence - self.calib_correct).sum() / total)
+
+    def report(self, mapping):
+        """Prints the confusion matrix and per-class sensitivity and PPV (and AUC and calibration
+        error when enabled), returns (sensitivities, ppvs)"""
+        print(self.matrix.astype('float'))
+        class_acc, ppvs = self.sensitivities(), self.ppvs()
+        print('Sens', ', '.join('{}: {:.3f}'.format(cls.capitalize(), class_acc[i]) for cls, i in mapping.items()))
+        print('PPV', ', '.join('{}: {:.3f}'.format(cls.capitalize(), ppvs[i]) for cls, i in mapping.items()))
+        if self.auc_bins:
+            aucs = self.aucs()
+            print('AUC', ', '.join('{}: {}'.format(cls.capitalize(), 'n/a' if aucs[i] is None else '{:.3f}'.format(aucs[i]))
+                                   for cls, i in mapping.items()))
+        if self.calibration_bins:
+            print('ECE: {:.3f} ({} bins)'.format(self.expected_calibration_error(), self.calibration_bins))
+        return class_acc, ppvs
@@ -0,0 +1,257 @@
+"""Registry of served COVID-Net models, loaded lazily within a memory budget
+
+MODELS describes the released models: checkpoint files, input and output tensor names,
+input sizes, label mapping and preprocessing. load_registry adds the entries of a JSON
+file ({name: {field: value}}, fields as in SPEC_DEFAULTS) to them, overriding the fields
+of models already listed, e.g. to point weightspath somewhere else.
+
+ModelRegistry imports each model into its own tf.Graph and session on first use. It
+keeps the loaded models within a memory budget: when a model does not fit, idle models
+are closed, least recently used first. The memory of a model is estimated from the size
+of its checkpoint variables, or given as memory_mb in its spec.
+"""
+import contextlib
+import glob
+import json
+import os
+import threading
+from collections import Counter, OrderedDict
+
+import tensorflow as tf
+
+from data import process_image, process_image_dual
+
+SPEC_DEFAULTS = {
+    'weightspath': None,
+    'metaname': 'model.meta',
+    'ckptname': 'model',
+    # Fed in order with the outputs of preprocess, MEDUSA input second for CXR-3
+    'inputs': ['input_1:0'],
+    'output': None,
+    'input_size': 480,
+    # Set for COVIDNet CXR-3 models, whose second input is the MEDUSA image
+    'medusa_input_size': None,
+    'top_percent': 0.08,
+    'crop': True,
+    # classification: softmax outputs for mapping; severity: logits of a SEV-GEO/OPC scorer
+    'task': 'classification',
+    'mapping': None,
+    'extra_feed': {},
+    'memory_mb': None,
+}
+
+SEVERITY_SPEC = {
+    'output': 'MLP/dense_1/MatMul:0',
+    'extra_feed': {'keras_learning_phase:0': False},
+    'task': 'severity',
+}
+
+MODELS = {
+    'COVIDNet-CXR-2': {
+        'weightspath': 'models/COVIDNet-CXR-2',
+        'output': 'norm_dense_2/Softmax:0',
+        'mapping': {'negative': 0, 'positive': 1},
+    },
+    'COVIDNet-CXR-3': {
+        'weightspath': 'models/COVIDNet-CXR-3',
+        'inputs': ['input_2:0', 'input_1:0'],
+        'output': 'softmax/Softmax:0',
+        'medusa_input_size': 256,
+        'mapping': {'negative': 0, 'positive': 1},
+    },
+    'COVIDNet-CXR4-A': {
+        'weightspath': 'models/COVIDNet-CXR4-A',
+        'ckptname': 'model-18540',
+        'output': 'norm_dense_1/Softmax:0',
+        'mapping': {'normal': 0, 'pneumonia': 1, 'COVID-19': 2},
+    },
+    'COVIDNet-SEV-GEO': dict(SEVERITY_SPEC, weightspath='models/COVIDNet-SEV-GEO'),
+    'COVIDNet-SEV-OPC': dict(SEVERITY_SPEC, weightspath='models/COVIDNet-SEV-OPC'),
+}
+
+
+def make_spec(entry):
+    'Completes a registry entry with SPEC_DEFAULTS'
+    unknown = set(entry) - set(SPEC_DEFAULTS)
+    if unknown:
+        raise ValueError('Unknown model spec fields: {}'.format(', '.join(sorted(unknown))))
+    spec = dict(SPEC_DEFAULTS, **entry)
+    if not spec['weightspath'] or not spec['output']:
+        raise ValueError('Model specs need a weightspath and an output tensor')
+    if spec['task'] == 'classification' and not spec['mapping']:
+        raise ValueError('Classification model specs need a mapping')
+    if len(spec['inputs']) != (2 if spec['medusa_input_size'] else 1):
+        raise ValueError('Model specs need one input tensor, two with medusa_input_size')
+    return spec
+
+
+def load_registry(path=None, models=MODELS):
+    'Returns {name: spec} of the MODELS and of the JSON file at path'
+    entries = {name: dict(entry) for name, entry in models.items()}
+    if path:
+        with open(path) as f:
+            for name, entry in json.load(f).items():
+                entries.setdefault(name, {}).update(entry)
+    return {name: make_spec(entry) for name, entry in entries.items()}
+
+
+def preprocess(spec, img):
+    'Returns the normalized inputs of a model for a decoded BGR image, in spec inputs order'
+    if spec['medusa_input_size']:
+        x, medusa_x = process_image_dual(img, spec['input_size'], spec['medusa_input_size'])
+        return x.astype('float32') / 255.0, medusa_x
+    x = process_image(img, spec['input_size'], top_percent=spec['top_percent'], crop=spec['crop'])
+    return (x.astype('float32') / 255.0,)
+
+
+def estimate_memory(spec):
+    'Bytes a loaded model is expected to take, from memory_mb or the checkpoint variables'
+    if spec['memory_mb']:
+        return int(spec['memory_mb'] * 2 ** 20)
+    prefix = os.path.join(spec['weightspath'], spec['ckptname'])
+    files = glob.glob(prefix + '.data-*') + [os.path.join(spec['weightspath'], spec['metaname'])]
+    return sum(os.path.getsize(f) for f in files if os.path.exists(f))
+
+
+def model_exists(spec):
+    return os.path.exists(os.path.join(spec['weightspath'], spec['metaname']))
+
+
+class WarmModel:
+    'A checkpoint restored once into its own graph and session'
+
+    def __init__(self, meta_file, ckpt_file, input_tensors, output_tensor, extra_feed=None):
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            saver = tf.train.import_meta_graph(meta_file)
+            self.sess = tf.Session(graph=self.graph)
+            saver.restore(self.sess, ckpt_file)
+            self.input_trs = [self.graph.get_tensor_by_name(name) for name in input_tensors]
+            self.output_tr = self.graph.get_tensor_by_name(output_tensor)
+            self.extra_feed = {self.graph.get_tensor_by_name(name): value
+                               for name, value in (extra_feed or {}).items()}
+
+    @classmethod
+    def from_spec(cls, spec):
+        return cls(os.path.join(spec['weightspath'], spec['metaname']),
+                   os.path.join(spec['weightspath'], spec['ckptname']),
+                   spec['inputs'], spec['output'], spec['extra_feed'])
+
+    def run(self, inputs):
+        feed_dict = dict(self.extra_feed)
+        for tensor, batch in zip(self.input_trs, inputs):
+            feed_dict[tensor] = batch
+        return self.sess.run(self.output_tr, feed_dict=feed_dict)
+
+    def close(self):
+        self.sess.close()
+
+
+class ModelRegistry:
+    """Loads the models of specs on first use and evicts idle ones to stay within the budget
+
+    Models are used through use(name), a context manager yielding the loaded WarmModel.
+    Models in use are never evicted: a load that does not fit waits until enough of them
+    are released. A memory_budget_mb of 0 disables the budget.
+    """
+    def __init__(self, specs, memory_budget_mb=0):
+        self.specs = specs
+        self.budget = int(memory_budget_mb * 2 ** 20) if memory_budget_mb else None
+        # Loaded models, least recently used first, and their estimated sizes
+        self.models = OrderedDict()
+        self.sizes = {}
+        # Sizes reserved by the models being loaded
+        self.loading = {}
+        self.in_use = Counter()
+        self.loads = Counter()
+        self.evictions = Counter()
+        self.condition = threading.Condition()
+
+    def spec(self, name):
+        if name not in self.specs:
+            raise ValueError('Unknown model {}, expected one of {}'.format(name, ', '.join(sorted(self.specs))))
+        return self.specs[name]
+
+    @contextlib.contextmanager
+    def use(self, name):
+        model = self._acquire(name)
+        try:
+            yield model
+        finally:
+            with self.condition:
+                self.in_use[name] -= 1
+                self.condition.notify_all()
+
+    def run(self, name, inputs):
+        with self.use(name) as model:
+            return model.run(inputs)
+
+    def _used(self):
+        return sum(self.sizes.values()) + sum(self.loading.values())
+
+    def _make_room(self, size):
+        'Closes idle models, least recently used first, if that makes size fit in the budget'
+        if self.budget is None:
+            return True
+        idle = [name for name in self.models if not self.in_use[name]]
+        if self._used() - sum(self.sizes[name] for name in idle) + size > self.budget:
+            return False
+        for name in idle:
+            if self._used() + size <= self.budget:
+                break
+            self.models.pop(name).close()
+            del self.sizes[name]
+            self.evictions[name] += 1
+        return True
+
+    def _acquire(self, name):
+        spec = self.spec(name)
+        with self.condition:
+            while True:
+                if name in self.models:
+                    self.models.move_to_end(name)
+                    self.in_use[name] += 1
+                    return self.models[name]
+                if name not in self.loading:
+                    size = estimate_memory(spec)
+                    if self.budget is not None and size > self.budget:
+                        raise ValueError('Model {} needs {:.0f} MB, more than the memory budget of {:.0f} MB'.format(
+                            name, size / 2 ** 20, self.budget / 2 ** 20))
+                    if self._make_room(size):
+                        self.loading[name] = size
+                        break
+                self.condition.wait()
+
+        # Loaded outside the lock, so other models keep serving meanwhile
+        try:
+            model = WarmModel.from_spec(spec)
+        except Exception:
+            with self.condition:
+                del self.loading[name]
+                self.condition.notify_all()
+            raise
+        with self.condition:
+            del self.loading[name]
+            self.models[name] = model
+            self.sizes[name] = size
+            self.in_use[name] += 1
+            self.loads[name] += 1
+            self.condition.notify_all()
+        return model
+
+    def stats(self):
+        with self.condition:
+            return {
+                'memory_budget_mb': self.budget / 2 ** 20 if self.budget else None,
+                'memory_used_mb': self._used() / 2 ** 20,
+                'loaded': list(self.models),
+                'loads': dict(self.loads),
+                'evictions': dict(self.evictions),
+            }
+
+    def close(self):
+        with self.condition:
+            for model in self.models.values():
+                model.close()
+            self.models.clear()
+            self.sizes.clear()
@@ -0,0 +1,297 @@
+"""Synchronous data-parallel training across CPU worker processes
+
+Used by train_tf.ipy when --dp_workers is greater than 1. Every worker process imports the
+same graph and checkpoint, builds batches of bs / dp_workers samples from its own shard of
+the training split (with its share of the covid samples of a global batch, and the same
+class weights), and computes gradients.
+The coordinator (the calling process) averages the gradients of all workers every step
+and sends the average back, and each worker applies it with its own optimizer. Since all
+replicas start from the same weights and apply the same updates, they stay identical;
+worker 0 runs the per-epoch evaluation and writes checkpoints.
+
+The scaling efficiency printed every epoch is the throughput over num_workers times the
+throughput of a single worker training on full batches. That baseline is given as
+--dp_baseline_ips, or measured by a short calibration run of one worker before training.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+import tensorflow as tf
+
+from data import BalanceCovidDataset, LabelIndex, PrefetchGenerator
+from eval import eval
+from image_cache import build_cache
+
+
+def make_generator(args, mapping, class_weights, batch_size, num_shards=1, shard_index=0, seed=None,
+                   normalize=True, profiler=None, covid_size=None):
+    image_cache = None
+    if args.cache_dir:
+        image_cache = build_cache(args.trainfile, os.path.join(args.datadir, 'train'), args.cache_dir,
+                                  size=args.input_size, top_percent=args.top_percent)
+
+    generator = BalanceCovidDataset(data_dir=args.datadir,
+                                    csv_file=args.trainfile,
+                                    batch_size=batch_size,
+                                    input_shape=(args.input_size, args.input_size),
+                                    n_classes=args.n_classes,
+                                    mapping=mapping,
+                                    covid_percent=args.covid_percent,
+                                    class_weights=class_weights,
+                                    top_percent=args.top_percent,
+                                    is_severity_model=args.is_severity_model,
+                                    seed=seed,
+                                    image_cache=image_cache,
+                                    num_shards=num_shards,
+                                    shard_index=shard_index,
+                                    normalize=normalize,
+                                    profiler=profiler,
+                                    covid_size=covid_size)
+    if args.num_workers > 0:
+        generator = PrefetchGenerator(generator, num_workers=args.num_workers, max_prefetch=args.prefetch)
+    return generator
+
+
+def _worker(rank, conn):
+    num_workers, args, mapping, class_weights, run_path, calibration_steps = conn.recv()
+    seed = None if args.seed is None else args.seed + rank
+    # Split the covid samples of a global batch of args.bs across the workers, rounding each
+    # worker's share separately would change the class balance of the global batch
+    global_covid_size = max(int(args.bs * args.covid_percent), 1)
+    covid_size = global_covid_size // num_workers + (1 if rank < global_covid_size % num_workers else 0)
+    generator = make_generator(args, mapping, class_weights, args.bs // num_workers,
+                               num_shards=num_workers, shard_index=rank, seed=seed, covid_size=covid_size)
+    conn.send(len(generator))
+    steps_per_epoch = conn.recv()
+
+    # Split the cores between workers so they do not oversubscribe the machine
+    threads = max(1, (os.cpu_count() or 1) // num_workers)
+    config = tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=2)
+    with tf.Session(config=config) as sess:
+        saver = tf.train.import_meta_graph(os.path.join(args.weightspath, args.metaname))
+        graph = tf.get_default_graph()
+
+        image_tensor = graph.get_tensor_by_name(args.in_tensorname)
+        labels_tensor = graph.get_tensor_by_name(args.label_tensorname)
+        sample_weights = graph.get_tensor_by_name(args.weights_tensorname)
+        pred_tensor = graph.get_tensor_by_name(args.logit_tensorname)
+        training_tensor = graph.get_tensor_by_name(args.training_tensorname)
+
+        loss_op = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits_v2(
+            logits=pred_tensor, labels=labels_tensor)*sample_weights)
+        optimizer = tf.train.AdamOptimizer(learning_rate=args.lr)
+        grads_and_vars = [(tf.convert_to_tensor(g), v) for g, v in optimizer.compute_gradients(loss_op)
+                          if g is not None]
+        grad_tensors = [g for g, _ in grads_and_vars]
+        avg_grads = [tf.placeholder(g.dtype, g.shape) for g in grad_tensors]
+        apply_op = optimizer.apply_gradients(zip(avg_grads, [v for _, v in grads_and_vars]))
+
+        sess.run(tf.global_variables_initializer())
+        saver.restore(sess, os.path.join(args.weightspath, args.ckptname))
+
+        if calibration_steps:
+            # A single worker applying its own gradients, the first step warms the session up
+            step_times = []
+            for i in range(calibration_steps + 1):
+                start = time.time()
+                batch_x, batch_y, weights, is_training = next(generator)
+                grads = sess.run(grad_tensors, feed_dict={image_tensor: batch_x,
+                                                          labels_tensor: batch_y,
+                                                          sample_weights: weights,
+                                                          training_tensor: is_training})
+                sess.run(apply_op, feed_dict=dict(zip(avg_grads, grads)))
+                step_times.append(time.time() - start)
+            conn.send(args.bs / np.mean(step_times[1:]))
+
+        testfiles = LabelIndex.load(args.testfile) if rank == 0 and not calibration_steps else None
+        if rank == 0 and not calibration_steps:
+            saver.save(sess, os.path.join(run_path, 'model'))
+            print('Saved baseline checkpoint')
+            print('Baseline eval:')
+            eval(sess, graph, testfiles, os.path.join(args.datadir, 'test'),
+                 args.in_tensorname, args.out_tensorname, args.input_size, mapping, batch_size=args.eval_bs)
+
+        for epoch in range(0 if calibration_steps else args.epochs):
+            for i in range(steps_per_epoch):
+                start = time.time()
+                batch_x, batch_y, weights, is_training = next(generator)
+                data_time = time.time() - start
+
+                start = time.time()
+                grads = sess.run(grad_tensors, feed_dict={image_tensor: batch_x,
+                                                          labels_tensor: batch_y,
+                                                          sample_weights: weights,
+                                                          training_tensor: is_training})
+                compute_time = time.time() - start
+
+                conn.send((grads, data_time, compute_time))
+                sess.run(apply_op, feed_dict=dict(zip(avg_grads, conn.recv())))
+
+            if rank == 0:
+                loss = sess.run(loss_op, feed_dict={image_tensor: batch_x,
+                                                    labels_tensor: batch_y,
+                                                    sample_weights: weights})
+                print("Epoch:", '%04d' % (epoch + 1), "Minibatch loss=", "{:.9f}".format(loss))
+                eval(sess, graph, testfiles, os.path.join(args.datadir, 'test'),
+                     args.in_tensorname, args.out_tensorname, args.input_size, mapping, batch_size=args.eval_bs)
+                saver.save(sess, os.path.join(run_path, 'model'), global_step=epoch+1, write_meta_graph=False)
+                print('Saving checkpoint at epoch {}'.format(epoch + 1))
+
+    if args.num_workers > 0:
+        generator.close()
+    conn.close()
+
+
+def _print_epoch_stats(epoch, num_workers, batch_size, step_times, data_times, compute_times, baseline_ips=None):
+    step_time = np.mean(step_times)
+    images_per_sec = batch_size / step_time
+    print('Epoch {:04d} data-parallel stats: {:.2f} images/sec, {:.3f} s/step'.format(
+        epoch + 1, images_per_sec, step_time))
+    for rank in range(num_workers):
+        print('    worker {}: data wait {:.3f} s/step, compute {:.3f} s/step'.format(
+            rank, np.mean(data_times[rank]), np.mean(compute_times[rank])))
+    if baseline_ips:
+        print('    scaling efficiency: {:.1%} ({:.2f} images/sec vs {} x {:.2f} for one worker)'.format(
+            images_per_sec / (num_workers * baseline_ips), images_per_sec, num_workers, baseline_ips))
+    # Share of each step spent computing gradients rather than waiting on data, the slowest
+    # worker or the gradient exchange
+    print('    compute utilization: {:.1%} of step time'.format(np.mean(compute_times) / step_time))
+
+
+def _accept_workers(listener, procs, poll_interval=1.):
+    'Connections of the workers by rank, kills them all if one exits before connecting'
+    conns = [None] * len(procs)
+
+    def accept():
+        try:
+            for _ in procs:
+                conn = listener.accept()
+                conns[conn.recv()] = conn
+        except (OSError, EOFError):
+            pass
+
+    # Listener.accept has no timeout, so accept on a thread and watch the workers meanwhile
+    thread = threading.Thread(target=accept, daemon=True)
+    thread.start()
+    while thread.is_alive():
+        thread.join(poll_interval)
+        failed = [(rank, proc.poll()) for rank, proc in enumerate(procs)
+                  if conns[rank] is None and proc.poll() is not None]
+        if failed:
+            for proc in procs:
+                if proc.poll() is None:
+                    proc.kill()
+            listener.close()
+            raise RuntimeError('Data-parallel worker {} exited with code {} before connecting'.format(*failed[0]))
+    listener.close()
+    return conns
+
+
+def _start_workers(args, mapping, class_weights, run_path, num_workers, calibration_steps=0):
+    'Starts num_workers worker processes and returns them with their connections, by rank'
+    # Workers are separate interpreters rather than forked copies of this process (TensorFlow
+    # does not survive a fork, and spawning would re-run the calling .ipy script); they connect
+    # back to a local listener and receive their configuration over the connection
+    authkey = os.urandom(16)
+    listener = Listener(('localhost', 0), authkey=authkey)
+    env = dict(os.environ, COVIDNET_DP_AUTHKEY=authkey.hex())
+    procs = [subprocess.Popen([sys.executable, os.path.abspath(__file__), '--address',
+                               '{}:{}'.format(*listener.address), '--rank', str(rank)], env=env)
+             for rank in range(num_workers)]
+
+    conns = _accept_workers(listener, procs)
+    for conn in conns:
+        conn.send((num_workers, args, mapping, class_weights, run_path, calibration_steps))
+    return procs, conns
+
+
+def _calibrate(args, mapping, class_weights, run_path, steps):
+    'Images/sec of a single worker training on batches of args.bs for steps steps'
+    procs, conns = _start_workers(args, mapping, class_weights, run_path, 1, calibration_steps=steps)
+    try:
+        conns[0].send(conns[0].recv())
+        return conns[0].recv()
+    finally:
+        conns[0].close()
+        procs[0].wait()
+
+
+def train_data_parallel(args, mapping, class_weights, run_path, num_workers):
+    if args.bs % num_workers:
+        raise ValueError('Batch size {} is not divisible by {} data-parallel workers'.format(args.bs, num_workers))
+
+    if args.cache_dir:
+        # Fill the cache once up front, the workers then only find it up to date and map it
+        build_cache(args.trainfile, os.path.join(args.datadir, 'train'), args.cache_dir,
+                    size=args.input_size, top_percent=args.top_percent)
+
+    baseline_ips = args.dp_baseline_ips
+    if not baseline_ips and args.dp_calibration_steps:
+        # Run alone before the workers start, so it has the whole machine like a 1-worker run
+        print('Measuring single-worker throughput over {} steps'.format(args.dp_calibration_steps))
+        baseline_ips = _calibrate(args, mapping, class_weights, run_path, args.dp_calibration_steps)
+        print('Single-worker baseline: {:.2f} images/sec'.format(baseline_ips))
+
+    procs, conns = _start_workers(args, mapping, class_weights, run_path, num_workers)
+    try:
+        # Workers can have shards differing by one batch, all must run the same number of steps
+        steps_per_epoch = min(conn.recv() for conn in conns)
+        for conn in conns:
+            conn.send(steps_per_epoch)
+        print('Training started with {} data-parallel workers, {} steps per epoch'.format(
+            num_workers, steps_per_epoch))
+
+        for epoch in range(args.epochs):
+            step_times = []
+            data_times = [[] for _ in range(num_workers)]
+            compute_times = [[] for _ in range(num_workers)]
+            last = None
+            for i in range(steps_per_epoch):
+                grads = []
+                for rank, conn in enumerate(conns):
+                    worker_grads, data_time, compute_time = conn.recv()
+                    grads.append(worker_grads)
+                    data_times[rank].append(data_time)
+                    compute_times[rank].append(compute_time)
+
+                avg_grads = [np.mean(g, axis=0) for g in zip(*grads)]
+                for conn in conns:
+                    conn.send(avg_grads)
+
+                # The first step of an epoch also includes worker 0's evaluation, skip it
+                now = time.time()
+                if last is not None:
+                    step_times.append(now - last)
+                last = now
+
+            if step_times:
+                _print_epoch_stats(epoch, num_workers, args.bs, step_times, data_times, compute_times,
+                                   baseline_ips)
+    finally:
+        for conn in conns:
+            conn.close()
+        for proc in procs:
+            proc.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='COVID-Net Data-Parallel Training Worker')
+    parser.add_argument('--address', type=str, help='host:port of the coordinator started by train_tf.ipy')
+    parser.add_argument('--rank', type=int, help='Index of this worker')
+
+    args = parser.parse_args()
+
+    # To remove TF Warnings
+    tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+    host, port = args.address.rsplit(':', 1)
+    conn = Client((host, int(port)), authkey=bytes.fromhex(os.environ['COVIDNET_DP_AUTHKEY']))
+    conn.send(args.rank)
+    _worker(args.rank, conn)
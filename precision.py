@@ -0,0 +1,95 @@
+"""Reduced-precision input and compute options shared by the training, eval and inference scripts
+
+With --uint8_input images stay uint8 from decoding until they reach the graph, where a
+uint8 placeholder mapped onto the model input (import_meta_graph/import_graph_def
+input_map) casts and scales them, so batches fed to sess.run are 4x smaller than float32.
+--precision float16/bfloat16 turns on Grappler's automatic mixed precision rewrite, which
+runs eligible ops in reduced precision and keeps numerically sensitive ones in float32.
+"""
+import os
+
+import tensorflow as tf
+from tensorflow.core.protobuf import rewriter_config_pb2
+
+from export_graph import read_graph_def
+
+PRECISIONS = ('float32', 'float16', 'bfloat16')
+
+
+def session_config(precision='float32', config=None):
+    """ConfigProto enabling the mixed precision rewrite for precision
+
+    float16 applies to ops placed on a GPU. bfloat16 targets CPUs with AVX-512 BF16 and needs
+    a TensorFlow build that has the MKL mixed precision rewrite.
+    """
+    config = config or tf.ConfigProto()
+    rewrite_options = config.graph_options.rewrite_options
+    if precision == 'float16':
+        if not tf.test.is_gpu_available():
+            print('Warning: no GPU is visible, float16 precision has no effect and the model runs in float32')
+        rewrite_options.auto_mixed_precision = rewriter_config_pb2.RewriterConfig.ON
+    elif precision == 'bfloat16':
+        if not hasattr(rewrite_options, 'auto_mixed_precision_mkl'):
+            raise ValueError('bfloat16 compute is not supported by TensorFlow {}'.format(tf.__version__))
+        rewrite_options.auto_mixed_precision_mkl = rewriter_config_pb2.RewriterConfig.ON
+    elif precision != 'float32':
+        raise ValueError('Unknown precision {}, expected one of {}'.format(precision, ', '.join(PRECISIONS)))
+    return config
+
+
+def normalize_uint8(images):
+    'The on-graph equivalent of images.astype(float32) / 255.0'
+    return tf.cast(images, tf.float32) / 255.
+
+
+def uint8_input(input_size, channels=3, name='input_uint8'):
+    'Returns a uint8 image placeholder and its normalized float32 value'
+    images = tf.placeholder(tf.uint8, [None, input_size, input_size, channels], name=name)
+    return images, normalize_uint8(images)
+
+
+def load_model(weightspath, metaname, ckptname, in_tensorname, input_size, uint8=False, precision='float32',
+               frozen_graph=None, config=None):
+    """Loads a checkpoint (or a frozen graph) into a new graph and session
+
+    Returns (graph, sess, in_tensorname). With uint8=True the returned input tensor name is
+    the uint8 placeholder, which takes unnormalized uint8 images. config is an optional
+    ConfigProto the precision options are added to.
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        input_map = None
+        if uint8:
+            images, normalized = uint8_input(input_size)
+            input_map = {in_tensorname: normalized}
+            in_tensorname = images.name
+
+        sess = tf.Session(graph=graph, config=session_config(precision, config))
+        if frozen_graph:
+            tf.import_graph_def(read_graph_def(frozen_graph), input_map=input_map, name='')
+        else:
+            saver = tf.train.import_meta_graph(os.path.join(weightspath, metaname), input_map=input_map)
+            saver.restore(sess, os.path.join(weightspath, ckptname))
+    return graph, sess, in_tensorname
+
+
+def mixed_precision_optimizer(optimizer, precision='float32'):
+    'Wraps optimizer with loss scaling and the float16 graph rewrite for training'
+    if precision == 'float32':
+        return optimizer
+    if precision != 'float16':
+        raise ValueError('Only float16 mixed precision training is supported by TensorFlow {}'.format(tf.__version__))
+    return tf.train.experimental.enable_mixed_precision_graph_rewrite(optimizer)
+
+
+def print_metric_deltas(mapping, baseline, other, names=('float32', 'reduced')):
+    """Prints per-class sensitivity and PPV of two evaluations and their difference
+
+    baseline and other are (sensitivities, ppvs, images/sec) as returned by eval.eval.
+    """
+    print('{:<12}{:<8}{:>10}{:>10}{:>10}'.format('class', 'metric', names[0], names[1], 'delta'))
+    for cls, i in mapping.items():
+        for metric, j in (('Sens', 0), ('PPV', 1)):
+            a, b = baseline[j][i], other[j][i]
+            print('{:<12}{:<8}{:>10.3f}{:>10.3f}{:>+10.3f}'.format(cls, metric, a, b, b - a))
+    print('{:<20}{:>10.2f}{:>10.2f}{:>+10.2f}'.format('images/sec', baseline[2], other[2], other[2] - baseline[2]))
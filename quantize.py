@@ -0,0 +1,201 @@
+"""Post-training int8 quantization of COVID-Net checkpoints for CPU inference
+
+The checkpoint is frozen with export_graph.freeze_graph and converted to a TensorFlow Lite
+model whose weights and activations are quantized to int8, with activation ranges
+calibrated on a sample of the images of a labels file. The float checkpoint and the int8
+model are then both evaluated on a test labels file: classification models are compared
+with eval.print_metrics (per-class sensitivity/PPV deltas), severity scorers by the
+difference of their scores, together with per-image latency and model size.
+
+The int8 model is loaded with export_graph.TFLiteSession, which eval.py, inference.py and
+inference_severity.py can use in place of a tf.Session.
+"""
+import argparse
+import glob
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from data import LabelIndex, process_image_file, process_image_file_dual
+from eval import eval
+from export_graph import TFLiteSession, freeze_graph, node_name
+from inference_severity import logits_to_score
+from precision import load_model, print_metric_deltas
+
+# To remove TF Warnings
+tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+SEVERITY_INPUT = 'input_1:0'
+SEVERITY_OUTPUT = 'MLP/dense_1/MatMul:0'
+
+
+def calibration_images(labels_file, image_dir, preprocess, num_samples=200, seed=0):
+    'Yields the preprocessed inputs of num_samples images drawn at random from labels_file'
+    index = LabelIndex.load(labels_file)
+    rows = np.random.RandomState(seed).permutation(len(index))[:num_samples]
+    for row in rows:
+        yield preprocess(os.path.join(image_dir, index.filenames[row]))
+
+
+def convert_to_int8(graph_def, input_tensors, output_tensor, input_shapes, representative_inputs,
+                    full_integer=False):
+    """Converts a frozen GraphDef to an int8 TFLite flatbuffer
+
+    Inputs and outputs stay float32. Unless full_integer is set, ops without an int8 kernel
+    fall back to float instead of failing the conversion.
+    """
+    input_arrays = [node_name(name) for name in input_tensors]
+    with tempfile.TemporaryDirectory() as tmp:
+        graph_file = os.path.join(tmp, 'frozen_model.pb')
+        with tf.gfile.GFile(graph_file, 'wb') as f:
+            f.write(graph_def.SerializeToString())
+        converter = tf.lite.TFLiteConverter.from_frozen_graph(
+            graph_file, input_arrays, [node_name(output_tensor)],
+            input_shapes={name: [1] + list(shape) for name, shape in zip(input_arrays, input_shapes)})
+
+    def representative_dataset():
+        for inputs in representative_inputs():
+            yield [np.expand_dims(x, 0).astype('float32') for x in inputs]
+
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = tf.lite.RepresentativeDataset(representative_dataset)
+    if full_integer:
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    return converter.convert()
+
+
+def checkpoint_size(weightspath, ckptname):
+    return sum(os.path.getsize(f) for f in glob.glob(os.path.join(weightspath, ckptname + '.data-*')))
+
+
+def compare_scores(sess, int8_sess, images, input_tensor, output_tensor, phase_tensor='keras_learning_phase:0'):
+    'Severity scorers: returns the float and int8 scores and latencies (s/image) of images'
+    results = []
+    for s in (sess, int8_sess):
+        start = time.time()
+        logits = np.concatenate([s.run(output_tensor, feed_dict={input_tensor: x[None], phase_tensor: False})
+                                 for x in images])
+        results.append((logits_to_score(logits), (time.time() - start) / len(images)))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='COVID-Net Post-Training int8 Quantization')
+    parser.add_argument('--weightspath', default='models/COVIDNet-CXR-3', type=str,
+                        help='Path to model files, defaults to \'models/COVIDNet-CXR-3\'')
+    parser.add_argument('--metaname', default='model.meta', type=str, help='Name of ckpt meta file')
+    parser.add_argument('--ckptname', default='model', type=str, help='Name of model ckpts')
+    parser.add_argument('--n_classes', default=2, type=int, help='Number of detected classes, defaults to 2')
+    parser.add_argument('--in_tensorname', default='input_2:0', type=str, help='Name of input tensor to graph')
+    parser.add_argument('--in_tensorname_medusa', default='input_1:0', type=str,
+                        help='Name of input tensor to MEDUSA graph for COVIDNet-CXR-3')
+    parser.add_argument('--out_tensorname', default='softmax/Softmax:0', type=str, help='Name of output tensor from graph')
+    parser.add_argument('--input_size', default=480, type=int, help='Size of input (ex: if 480x480, --input_size 480)')
+    parser.add_argument('--input_size_medusa', default=256, type=int, help='Size of input to MEDUSA graph')
+    parser.add_argument('--top_percent', default=0.08, type=float, help='Percent top crop from top of image')
+    parser.add_argument('--is_severity_model', action='store_true', help='Add flag for COVIDNet CXR-S models')
+    parser.add_argument('--is_medusa_backbone', action='store_true',
+                        help='Add flag for COVIDNet CXR-3 models, do not include for other versions')
+    parser.add_argument('--is_severity_scorer', action='store_true',
+                        help='Quantize a COVIDNet-SEV-GEO/OPC scorer (uses its input/output tensors)')
+    parser.add_argument('--calibfile', default='labels/train_COVIDx9B.txt', type=str,
+                        help='Labels file whose images are sampled for calibration')
+    parser.add_argument('--calibfolder', default='data/train', type=str, help='Folder of the calibration images')
+    parser.add_argument('--num_calib', default=200, type=int, help='Number of calibration images')
+    parser.add_argument('--testfile', default='labels/test_COVIDx9B.txt', type=str,
+                        help='Labels file the float and int8 models are compared on')
+    parser.add_argument('--testfolder', default='data/test', type=str, help='Folder where test data is located')
+    parser.add_argument('--full_integer', action='store_true',
+                        help='Fail instead of falling back to float for ops without an int8 kernel')
+    parser.add_argument('--output', default=None, type=str,
+                        help='Path of the int8 model, defaults to <weightspath>/model_int8.tflite')
+    parser.add_argument('--no_eval', action='store_true', help='Only write the int8 model')
+
+    args = parser.parse_args()
+
+    output = args.output or os.path.join(args.weightspath, 'model_int8.tflite')
+    meta_file = os.path.join(args.weightspath, args.metaname)
+    ckpt_file = os.path.join(args.weightspath, args.ckptname)
+
+    constants = None
+    if args.is_severity_scorer:
+        input_tensors = [SEVERITY_INPUT]
+        output_tensor = SEVERITY_OUTPUT
+        input_shapes = [(args.input_size, args.input_size, 3)]
+        constants = {'keras_learning_phase:0': False}
+
+        def preprocess(path):
+            return (process_image_file(path, args.input_size, top_percent=args.top_percent) / 255.,)
+    elif args.is_medusa_backbone:
+        input_tensors = [args.in_tensorname, args.in_tensorname_medusa]
+        output_tensor = args.out_tensorname
+        input_shapes = [(args.input_size, args.input_size, 3), (args.input_size_medusa, args.input_size_medusa, 1)]
+
+        def preprocess(path):
+            x, medusa_x = process_image_file_dual(path, args.input_size, args.input_size_medusa)
+            return x / 255., medusa_x
+    else:
+        input_tensors = [args.in_tensorname]
+        output_tensor = args.out_tensorname
+        input_shapes = [(args.input_size, args.input_size, 3)]
+
+        def preprocess(path):
+            return (process_image_file(path, args.input_size, top_percent=args.top_percent) / 255.,)
+
+    graph_def = freeze_graph(meta_file, ckpt_file, input_tensors, [output_tensor], constants=constants)
+    int8_model = convert_to_int8(
+        graph_def, input_tensors, output_tensor, input_shapes,
+        lambda: calibration_images(args.calibfile, args.calibfolder, preprocess, args.num_calib),
+        full_integer=args.full_integer)
+    with open(output, 'wb') as f:
+        f.write(int8_model)
+    print('Wrote int8 model to {}'.format(output))
+
+    if args.no_eval:
+        sys.exit(0)
+
+    graph, sess, _ = load_model(args.weightspath, args.metaname, args.ckptname, args.in_tensorname, args.input_size)
+    int8_sess = TFLiteSession(output)
+    testfile = LabelIndex.load(args.testfile)
+
+    if args.is_severity_scorer:
+        images = [preprocess(os.path.join(args.testfolder, name))[0] for name in testfile.filenames]
+        (scores, latency), (int8_scores, int8_latency) = compare_scores(
+            sess, int8_sess, images, SEVERITY_INPUT, SEVERITY_OUTPUT)
+        diff = np.abs(int8_scores - scores)
+        print('Score difference on {} images: mean {:.4f}, max {:.4f} (extent 0-8: mean {:.3f})'.format(
+            len(images), diff.mean(), diff.max(), diff.mean() * 8))
+    else:
+        if args.is_severity_model:
+            mapping = {'level2': 0, 'level1': 1}
+        elif args.n_classes == 2:
+            mapping = {'negative': 0, 'positive': 1}
+        elif args.n_classes == 3:
+            mapping = {'normal': 0, 'pneumonia': 1, 'COVID-19': 2}
+        else:
+            raise Exception('''COVID-Net currently only supports 2 class COVID-19 positive/negative detection
+                or 3 class detection of no pneumonia/non-COVID-19 pneumonia/COVID-19 pneumonia''')
+
+        # One image per run on both models, so throughput is the inverse of per-image latency
+        results = []
+        for name, s in (('float32', sess), ('int8', int8_sess)):
+            print('{}:'.format(name))
+            results.append(eval(s, graph, testfile, args.testfolder, args.in_tensorname, args.out_tensorname,
+                                args.input_size, mapping, is_medusa_backbone=args.is_medusa_backbone,
+                                medusa_input_tensor=args.in_tensorname_medusa,
+                                medusa_input_size=args.input_size_medusa, batch_size=1))
+        print_metric_deltas(mapping, results[0], results[1], names=('float32', 'int8'))
+        latency, int8_latency = [1. / r[2] if r[2] else 0. for r in results]
+
+    sess.close()
+    int8_sess.close()
+
+    print('{:<10}{:>22}{:>16}'.format('', 'latency (ms/image)', 'size (MB)'))
+    print('{:<10}{:>22.2f}{:>16.1f}'.format('float32', latency * 1000,
+                                            checkpoint_size(args.weightspath, args.ckptname) / 2**20))
+    print('{:<10}{:>22.2f}{:>16.1f}'.format('int8', int8_latency * 1000, os.path.getsize(output) / 2**20))
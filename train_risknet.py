@@ -18,6 +18,7 @@ import argparse
 from collections import namedtuple
 import cv2
 import os
+import shutil
 from typing import List, Tuple, Dict, Any
 
 import numpy as np
@@ -25,7 +26,9 @@ import pandas as pd
 from sklearn.metrics import confusion_matrix
 import tensorflow as tf
 
-from data import BalanceDataGenerator
+from async_checkpoint import AsyncCheckpointer
+from input_pipeline import AUTOTUNE, input_tensors, load_images, prepare_batches
+from instrumentation import TrainingProfiler
 
 
 # We will create a checkpoint which has initial values for these variables
@@ -43,18 +46,17 @@ OUTPUT_TENSOR_NAME = "dense_3/Softmax:0"
 SAMPLE_WEIGHTS = "dense_3_sample_weights:0"
 
 
-def get_parse_fn(num_classes: int, augment: bool = False):
-    def parse_function(imagepath: str, label: int):
-        """Parse a single element of the stratification dataset"""
-        # TODO add augmentation here ideally
-        image_decoded = tf.image.resize_images(
-            tf.image.decode_jpeg(tf.io.read_file(imagepath), IMAGE_SHAPE[-1]), IMAGE_SHAPE[:2])
-        return (
-            tf.image.convert_image_dtype(image_decoded, dtype=tf.float32) / 255.0, # x
-            tf.one_hot(label, num_classes), # y
-            tf.convert_to_tensor(1.0, dtype=tf.float32), # sample_weights TODO: verify this is right
-        )
-    return parse_function
+def get_dataset(files: List[str], labels: List[int], num_classes: int, batch_size: int,
+                is_training: bool) -> tf.data.Dataset:
+    """Parallel decode/resize, augmentation (training only), batching and prefetch"""
+    dataset = tf.data.Dataset.from_tensor_slices((files, labels))
+    if is_training:
+        dataset = dataset.shuffle(len(files)).repeat()
+    dataset = load_images(dataset, IMAGE_SHAPE[0], top_percent=0., crop=False)
+    dataset = dataset.batch(batch_size, drop_remainder=is_training)
+    # sample weights are 1 for every class
+    dataset = prepare_batches(dataset, num_classes, [1.] * num_classes, augment=is_training)
+    return dataset.prefetch(AUTOTUNE)
 
 
 def parse_split(split_txt_path: str) -> Tuple[List[str], List[int]]:
@@ -78,8 +80,8 @@ def parse_split(split_txt_path: str) -> Tuple[List[str], List[int]]:
 
 
 def eval_net(sess: tf.Session, dataset_dict: Dict[str, Any], test_files: List[str],
-             test_labels: List[int]) -> None:
-    """Evaluate the network"""
+             test_labels: List[int], input_tensor: str = INPUT_TENSOR_NAME) -> Tuple[List[float], List[float]]:
+    """Evaluate the network, returns the per-class accuracies (sensitivities) and PPVs"""
     # Reset eval iterator
     sess.run(dataset_dict['iterator'].initializer)
 
@@ -88,11 +90,8 @@ def eval_net(sess: tf.Session, dataset_dict: Dict[str, Any], test_files: List[st
     num_evaled = 0
     while True:
         try:
-            images, labels, sample_weights = sess.run(dataset_dict['gn_op'])
-            pred = sess.run(
-                OUTPUT_TENSOR_NAME,
-                feed_dict={INPUT_TENSOR_NAME: images, SAMPLE_WEIGHTS: sample_weights}
-            )
+            images, labels, _ = sess.run(dataset_dict['gn_op'])
+            pred = sess.run(OUTPUT_TENSOR_NAME, feed_dict={input_tensor: images})
             preds.append(np.array(pred).argmax(axis=1))
             num_evaled += len(pred)
             all_labels.extend(np.array(labels).argmax(axis=1))
@@ -104,7 +103,25 @@ def eval_net(sess: tf.Session, dataset_dict: Dict[str, Any], test_files: List[st
     per_class_acc = [
         matrix[i,i]/np.sum(matrix[i,:]) if np.sum(matrix[i,:]) else 0 for i in range(len(matrix))
     ]
+    ppvs = [
+        matrix[i,i]/np.sum(matrix[:,i]) if np.sum(matrix[:,i]) else 0 for i in range(len(matrix))
+    ]
     print("confusion matrix:\n{}\nper-class accuracies:\n{}".format(matrix, per_class_acc))
+    return per_class_acc, ppvs
+
+
+def make_snapshot_eval(test_files: List[str], test_labels: List[int], num_classes: int, batch_size: int):
+    """eval_fn for AsyncCheckpointer, builds the test pipeline in the snapshot graph on first use"""
+    test = {}
+
+    def eval_snapshot(sess: tf.Session, graph: tf.Graph) -> Tuple[List[float], List[float]]:
+        if not test:
+            with tf.name_scope('input_pipeline'):
+                test_dataset = get_dataset(test_files, test_labels, num_classes, batch_size, False)
+                iterator = tf.compat.v1.data.make_initializable_iterator(test_dataset)
+                test.update(dataset=test_dataset, iterator=iterator, gn_op=iterator.get_next())
+        return eval_net(sess, test, test_files, test_labels)
+    return eval_snapshot
 
 
 if __name__ == "__main__":
@@ -138,7 +155,23 @@ if __name__ == "__main__":
                         help='Name of folder to store training checkpoints.')
     parser.add_argument('--chestxraydir', default='../covid-chestxray-dataset', type=str,
                         help='Path to the chestxray images directory for COVID-19 patients.')
+    parser.add_argument('--profile', action='store_true', help='Print per-epoch training step timings.')
+    parser.add_argument('--trace-dir', default=None, type=str,
+                        help='Write Chrome traces of the training steps here, implies --profile.')
+    parser.add_argument('--trace-every', default=0, type=int,
+                        help='Record an op-level trace of every N-th training step.')
+    parser.add_argument('--async-eval', action='store_true',
+                        help='Save and evaluate checkpoints on a weight snapshot in the background while '
+                        'training continues.')
+    parser.add_argument('--keep-best', default=0, type=int,
+                        help='With --async-eval, keep only the N checkpoints with the best --best-metric '
+                        '(0 keeps the 5 most recent).')
+    parser.add_argument('--best-metric', default='sens', type=str,
+                        help='Metric ranking checkpoints for --keep-best: sens or ppv (mean over classes), or '
+                        'sens:<class> / ppv:<class> with the class index, e.g. sens:0.')
     args = parser.parse_args()
+    if args.keep_best and not args.async_eval:
+        parser.error('--keep-best requires --async-eval')
 
     # Check inputs
     assert os.path.exists(args.input_weights_dir), "Missing file {}".format(args.input_weights_dir)
@@ -168,25 +201,6 @@ if __name__ == "__main__":
     print("collected {} training and {} test cases for transfer-learning".format(
         len(train_files), len(test_files)))
 
-    # Init augmentation fn - FIXME: we need a way to put this in a parse_fn for tf.data.dataset
-    # augmentation_fn = tf.keras.preprocessing.image.ImageDataGenerator(
-    #     featurewise_center=False,
-    #     featurewise_std_normalization=False,
-    #     rotation_range=10,
-    #     width_shift_range=0.1,
-    #     height_shift_range=0.1,
-    #     horizontal_flip=True,
-    #     brightness_range=(0.9, 1.1),
-    #     fill_mode='constant',
-    #     cval=0.,
-    # )
-    # < define generator from augmentation_fn + cv loads? >
-    # dataset = tf.data.Dataset.from_generator(lambda: generator,
-    #                                       output_types=(tf.float32, tf.float32, tf.float32),
-    #                                       output_shapes=([batch_size, 224, 224, 3],
-    #                                                      [batch_size, 3],
-    #                                                      [batch_size]))
-
     # Output path creation for this run with lr param in name
     train_dir = os.path.join(args.outputdir, args.name + '-lr' + str(args.lr))
     os.makedirs(args.outputdir, exist_ok=True)
@@ -197,8 +211,23 @@ if __name__ == "__main__":
     graph = tf.Graph()
     with tf.Session(graph=graph) as sess:
 
-        # Import meta graph
-        tf.train.import_meta_graph(os.path.join(args.input_weights_dir, args.input_meta_name))
+        # Define tf.datasets
+        datasets = {}
+        with tf.name_scope('input_pipeline'):
+            train_dataset = get_dataset(train_files, train_labels, num_classes, args.batch_size, True)
+            batch_x, batch_y, weights = input_tensors(train_dataset, IMAGE_SHAPE)
+            test_dataset = get_dataset(test_files, test_labels, num_classes, args.eval_batch_size, False)
+            iterator = tf.compat.v1.data.make_initializable_iterator(test_dataset)
+            datasets['test'] = {
+                'dataset': test_dataset,
+                'iterator': iterator,
+                'gn_op': iterator.get_next(),
+            }
+
+        # Import meta graph, reading training batches straight from the train dataset
+        tf.train.import_meta_graph(
+            os.path.join(args.input_weights_dir, args.input_meta_name),
+            input_map={INPUT_TENSOR_NAME: batch_x, "dense_3_target:0": batch_y, SAMPLE_WEIGHTS: weights})
 
         # Restore pre-trained vars which are not in our VARS_TO_FORGET list
         restore_vars_list, init_vars_list = [], []
@@ -212,30 +241,10 @@ if __name__ == "__main__":
         existing_vars = sess.graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
 
         # Get some I/O tensors
-        image_tensor = graph.get_tensor_by_name(INPUT_TENSOR_NAME)
-        labels_tensor = graph.get_tensor_by_name("dense_3_target:0")
-        sample_weights = graph.get_tensor_by_name(SAMPLE_WEIGHTS)
+        labels_tensor = batch_y
+        sample_weights = weights
         pred_tensor = graph.get_tensor_by_name("dense_3/MatMul:0")
 
-        # Define tf.datasets
-        datasets = {}
-        for is_training, files, labels in zip(
-                [True, False], [train_files, test_files], [train_labels, test_labels]):
-
-            dataset = tf.data.Dataset.from_tensor_slices((files, labels))
-            dataset = dataset.map(get_parse_fn(num_classes))
-            if is_training:
-                dataset = dataset.shuffle(15)
-            dataset = dataset.batch(args.batch_size if is_training else args.eval_batch_size)
-            if is_training:
-                dataset = dataset.repeat()
-            iterator = dataset.make_initializable_iterator()
-            datasets['train' if is_training else 'test'] = {
-                'dataset': dataset,
-                'iterator': iterator,
-                'gn_op': iterator.get_next(),
-            }
-
         # Define loss and optimizer
         loss_op = tf.reduce_mean(
             tf.nn.softmax_cross_entropy_with_logits_v2(
@@ -250,11 +259,14 @@ if __name__ == "__main__":
         sess.run(tf.variables_initializer(optim_vars + init_vars_list))
 
         # save base model
+        # The training graph reads from the input pipeline, so keep the original graph definition
         saver = tf.train.Saver()
-        saver.save(sess, os.path.join(train_dir, 'model'))
+        saver.save(sess, os.path.join(train_dir, 'model'), write_meta_graph=False)
+        shutil.copyfile(os.path.join(args.input_weights_dir, args.input_meta_name),
+                        os.path.join(train_dir, 'model.meta'))
         print('Saved pre-trained model with re-initialized output layers.')
         print('Baseline eval:')
-        eval_net(sess, datasets['test'], test_files, test_labels)
+        eval_net(sess, datasets['test'], test_files, test_labels, batch_x.name)
 
         # Training cycle
         # TODO: we need a training method that we can re-use. below very similar to train_tf.py
@@ -262,39 +274,38 @@ if __name__ == "__main__":
         print('Transfer Learning Started.')
         print('\ttrain samples: {}\n\ttest samples:  {}\n\tstratification: {}\n'.format(
             len(train_files), len(test_files), args.stratification))
-        sess.run(datasets['train']['iterator'].initializer)
         num_batches = len(train_files) // args.batch_size
         progbar = tf.keras.utils.Progbar(num_batches)
+        # Batches come from the tf.data pipeline inside the session, input waits show up as
+        # IteratorGetNext in the op-level traces
+        profiler = TrainingProfiler(enabled=args.profile, trace_dir=args.trace_dir, trace_every=args.trace_every,
+                                    batch_size=args.batch_size)
+        checkpointer = None
+        if args.async_eval:
+            checkpointer = AsyncCheckpointer(
+                sess, os.path.join(train_dir, 'model.meta'), train_dir,
+                make_snapshot_eval(test_files, test_labels, num_classes, args.eval_batch_size),
+                {str(i): i for i in range(num_classes)}, keep_best=args.keep_best, metric=args.best_metric)
         for epoch in range(args.epochs):
 
             # Train
             print("Fine-Tuning on 1 epoch = {} images.".format(len(train_files)))
             for i in range(num_batches):
-
-                batch_x, batch_y, weights = sess.run(datasets['train']['gn_op'])
-                sess.run(
-                    train_op,
-                    feed_dict={
-                        image_tensor: batch_x,
-                        labels_tensor: batch_y,
-                        sample_weights: weights,
-                    }
-                )
+                run_kwargs = profiler.run_kwargs()
+                with profiler.phase('session'):
+                    _, loss = sess.run([train_op, loss_op], **run_kwargs)
+                profiler.end_step(run_kwargs)
                 progbar.update(i + 1)
+            profiler.epoch_summary(epoch)
 
             # Evaluate + save
             if epoch % args.evaliterval == 0:
-                pred = sess.run(pred_tensor, feed_dict={image_tensor:batch_x})
-                loss = sess.run(
-                    loss_op,
-                    feed_dict={
-                        pred_tensor: pred,
-                        labels_tensor: batch_y,
-                        sample_weights: weights,
-                    }
-               )
                 print("Epoch:", '%04d' % (epoch + 1), "Minibatch loss=", "{:.9f}".format(loss))
-                eval_net(sess, datasets['test'], test_files, test_labels)
+                if checkpointer is not None:
+                    checkpointer.submit(epoch + 1)
+                    print('Queued checkpoint at epoch {} for saving and evaluation'.format(epoch + 1))
+                    continue
+                eval_net(sess, datasets['test'], test_files, test_labels, batch_x.name)
                 saver.save(
                     sess,
                     os.path.join(train_dir, 'model'),
@@ -303,4 +314,7 @@ if __name__ == "__main__":
                 )
                 print('Saving checkpoint at epoch {}'.format(epoch + 1))
 
+        if checkpointer is not None:
+            checkpointer.close()
+
     print("Transfer Learning Finished!\n\tcheckpoint: '{}'".format(train_dir))
@@ -0,0 +1,95 @@
+"""Resume checkpoints for train_tf.ipy
+
+A resume checkpoint is a full tf.train.Saver checkpoint of the training graph (model and
+optimizer variables, the global step and, with the tf.data pipeline, the input iterator
+position) in <run>/resume/, next to <checkpoint>.state.npz holding the epoch, the batch
+index within it, the run seed and, with the python pipeline, the sampling state of the
+BalanceCovidDataset: the batch index, the shuffled orders, the RNG state and the plans of
+the batches the PrefetchGenerator had sampled but not returned yet. Batch loading is a
+function of the plan, so a resumed run sees the same batches as an uninterrupted one.
+
+The state file is written before the checkpoint, so the latest checkpoint always has one.
+"""
+import glob
+import os
+
+import numpy as np
+import tensorflow as tf
+
+RESUME_DIR = 'resume'
+STATE_SUFFIX = '.state.npz'
+
+
+def latest_checkpoint(run_path):
+    'Prefix of the latest resume checkpoint of a run, None if there is none'
+    return tf.train.latest_checkpoint(os.path.join(run_path, RESUME_DIR))
+
+
+def save_state(prefix, epoch, batch, seed, generator=None):
+    arrays = {'epoch': epoch, 'batch': batch, 'seed': seed, 'has_generator': generator is not None}
+    if generator is not None:
+        state = generator.get_state()
+        _, keys, pos, has_gauss, cached_gaussian = state['rng']
+        arrays.update(n=state['n'], num_datasets=len(state['datasets']), rng_keys=keys, rng_pos=pos,
+                      rng_has_gauss=has_gauss, rng_cached_gaussian=cached_gaussian)
+        for i, rows in enumerate(state['datasets']):
+            arrays['dataset_{}'.format(i)] = rows
+        pending = state['pending']
+        arrays['pending_sizes'] = np.array([len(rows) for rows, _ in pending], dtype='int64')
+        arrays['pending_rows'] = np.concatenate([rows for rows, _ in pending]) if pending else np.zeros(0, 'int64')
+        arrays['pending_seeds'] = np.array([seed for _, seed in pending], dtype='int64')
+    tmp = prefix + STATE_SUFFIX + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, prefix + STATE_SUFFIX)
+
+
+def load_state(prefix):
+    """Returns {'epoch', 'batch', 'seed', 'generator'} of a resume checkpoint, where
+    generator is the state for BalanceCovidDataset/PrefetchGenerator.set_state or None"""
+    with np.load(prefix + STATE_SUFFIX) as f:
+        state = {'epoch': int(f['epoch']), 'batch': int(f['batch']), 'seed': int(f['seed']), 'generator': None}
+        if not f['has_generator']:
+            return state
+        rng = ('MT19937', f['rng_keys'], int(f['rng_pos']), int(f['rng_has_gauss']), float(f['rng_cached_gaussian']))
+        bounds = np.cumsum(f['pending_sizes'])[:-1]
+        pending_rows = np.split(f['pending_rows'], bounds) if len(f['pending_sizes']) else []
+        state['generator'] = {
+            'n': int(f['n']),
+            'datasets': [f['dataset_{}'.format(i)] for i in range(int(f['num_datasets']))],
+            'rng': rng,
+            'pending': [(rows, int(seed)) for rows, seed in zip(pending_rows, f['pending_seeds'])],
+        }
+    return state
+
+
+class ResumeCheckpointer:
+    """Writes resume checkpoints of every variable and saveable of the default graph
+
+    Create it after the optimizer, so its slots and the global step are included.
+    """
+    def __init__(self, run_path, seed, generator=None, max_to_keep=2):
+        self.dir = os.path.join(run_path, RESUME_DIR)
+        os.makedirs(self.dir, exist_ok=True)
+        self.seed = seed
+        self.generator = generator
+        self.global_step = tf.train.get_or_create_global_step()
+        self.saver = tf.train.Saver(max_to_keep=max_to_keep)
+
+    def save(self, sess, epoch, batch):
+        'Saves the state before batch (of the epoch counted from 0) is trained on'
+        step = sess.run(self.global_step)
+        prefix = os.path.join(self.dir, 'ckpt-{}'.format(step))
+        save_state(prefix, epoch, batch, self.seed, self.generator)
+        self.saver.save(sess, os.path.join(self.dir, 'ckpt'), global_step=step, write_meta_graph=False)
+        # The saver deletes its old checkpoints, drop their state files as well
+        kept = set(self.saver.last_checkpoints)
+        for path in glob.glob(os.path.join(self.dir, 'ckpt-*' + STATE_SUFFIX)):
+            if path[:-len(STATE_SUFFIX)] not in kept:
+                os.remove(path)
+
+    def restore(self, sess, prefix):
+        self.saver.restore(sess, prefix)
+        ckpt = tf.train.get_checkpoint_state(self.dir)
+        if ckpt is not None:
+            self.saver.recover_last_checkpoints(ckpt.all_model_checkpoint_paths)
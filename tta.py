@@ -0,0 +1,84 @@
+"""Test-time augmentation: deterministic views of an image whose predictions are averaged
+
+The views are fixed flips, zooms and shifts within the training augmentation ranges
+(data.AUGMENTATION_RANGES, applied with the same data.augmentation_matrices warp) and
+alternative top crops. The first k views of TTA_VIEWS are used, so k=4 is a subset of
+k=8. All views of a batch of images are scored in one sess.run and the softmax outputs
+are averaged per image with average_views.
+"""
+import cv2
+import numpy as np
+
+from data import augmentation_matrices, process_image, process_image_medusa
+
+# Ordered by expected benefit. Zooms and shifts are about half of the training ranges
+TTA_VIEWS = [
+    {},
+    {'flip': True},
+    {'zoom': 0.92},
+    {'top_percent': 0.04},
+    {'flip': True, 'zoom': 1.08},
+    {'shift': (0.05, 0.)},
+    {'shift': (0., 0.05)},
+    {'top_percent': 0.12},
+]
+
+
+def select_views(k, is_medusa_backbone=False):
+    'The first k views, without crop views for CXR-3 models, which take uncropped images'
+    views = [v for v in TTA_VIEWS if not (is_medusa_backbone and 'top_percent' in v)]
+    if not 1 <= k <= len(views):
+        raise ValueError('Test-time augmentation supports 1 to {} views'.format(len(views)))
+    return views[:k]
+
+
+def view_matrix(view, img_shape):
+    'Forward 2x3 affine matrix of a view, None if it has no geometric transform'
+    if not any(key in view for key in ('flip', 'zoom', 'shift')):
+        return None
+    zoom = view.get('zoom', 1.)
+    shift = view.get('shift', (0., 0.))
+    params = {
+        'ratio_x': np.ones(1), 'ratio_y': np.ones(1), 'theta': np.zeros(1),
+        'tx': np.array([shift[0] * img_shape[1]]), 'ty': np.array([shift[1] * img_shape[0]]),
+        'zx': np.array([zoom]), 'zy': np.array([zoom]), 'flip': np.array([view.get('flip', False)]),
+    }
+    return augmentation_matrices(params, img_shape)[0]
+
+
+def warp(img, matrix):
+    if matrix is None:
+        return img
+    warped = cv2.warpAffine(img, matrix, (img.shape[1], img.shape[0]), flags=cv2.INTER_LINEAR,
+                            borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    return warped.reshape(img.shape)
+
+
+def tta_views(img, size, k, top_percent=0.08, crop=True):
+    'Returns the (k, size, size, 3) uint8 views of a decoded BGR image'
+    crops = {}
+    views = []
+    for view in select_views(k):
+        view_top = view.get('top_percent', top_percent)
+        if view_top not in crops:
+            crops[view_top] = process_image(img, size, top_percent=view_top, crop=crop)
+        views.append(warp(crops[view_top], view_matrix(view, (size, size))))
+    return np.stack(views)
+
+
+def tta_views_dual(img, size, medusa_size, k):
+    'Returns the (k, ...) views of both COVIDNet CXR-3 inputs, see data.process_image_dual'
+    x = process_image(img, size, top_percent=0, crop=False)
+    gray = cv2.resize(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), (medusa_size, medusa_size))
+    views, medusa_views = [], []
+    for view in select_views(k, is_medusa_backbone=True):
+        views.append(warp(x, view_matrix(view, (size, size))))
+        medusa_views.append(process_image_medusa(warp(gray, view_matrix(view, (medusa_size, medusa_size))),
+                                                 medusa_size))
+    return np.stack(views), np.stack(medusa_views)
+
+
+def average_views(outputs, k):
+    'Averages (n * k, classes) outputs of n images with k consecutive views each'
+    outputs = np.asarray(outputs)
+    return outputs.reshape(-1, k, outputs.shape[-1]).mean(axis=1)